@@ -0,0 +1,74 @@
+import tempfile
+from os import path
+from typing import Dict, Optional
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from transformers import DonutProcessor, VisionEncoderDecoderModel
+from donut_distill.data.donut_dataset import DonutDataset, collate_fn_eval
+from donut_distill.data.preprocess_donut import write_shards
+from donut_distill.data.shard_dataset import DonutIterableDataset
+from benchmarks.common import DATASET_PATH, MAX_LENGTH, measure
+
+
+def build_datasets(processor: DonutProcessor, model: VisionEncoderDecoderModel, dataset_path: str = DATASET_PATH):
+    """
+    Builds the FUNSD train and validation datasets (the train dataset registers the key tokens).
+    """
+    dataset_kwargs = dict(
+        processor=processor,
+        model=model,
+        dataset_name_or_path=dataset_path,
+        max_length=MAX_LENGTH,
+        task_start_token="<s_funsd>",
+        task="funsd",
+    )
+    train_dataset = DonutDataset(split="train", **dataset_kwargs)
+    val_dataset = DonutDataset(split="test", **dataset_kwargs)
+    return train_dataset, val_dataset
+
+
+def run(
+    train_dataset: DonutDataset, val_dataset: DonutDataset, repeats: int = 5, dataset_path: Optional[str] = None
+) -> Dict[str, Dict[str, float]]:
+    """
+    Measures `DonutDataset.__getitem__` and collate throughput.
+    With `dataset_path`, the train split is also written as shards and streamed with `DonutIterableDataset`.
+    """
+    results = {}
+
+    for name, dataset in (("train", train_dataset), ("val", val_dataset)):
+        results[f"data/getitem_{name}"] = measure(
+            lambda: [dataset[idx] for idx in range(len(dataset))], repeats=repeats, warmup=1, items=len(dataset)
+        )
+
+    train_samples = [train_dataset[idx] for idx in range(len(train_dataset))]
+    val_samples = [val_dataset[idx] for idx in range(len(val_dataset))]
+    results["data/collate_train"] = measure(
+        lambda: default_collate(train_samples), repeats=repeats * 4, items=len(train_samples)
+    )
+    results["data/collate_eval"] = measure(
+        lambda: collate_fn_eval(val_samples), repeats=repeats * 4, items=len(val_samples)
+    )
+
+    # Full dataloader pass with the default settings of training
+    train_dataloader = DataLoader(train_dataset, batch_size=2, shuffle=False, num_workers=0)
+    results["data/dataloader_train_epoch"] = measure(
+        lambda: list(train_dataloader), repeats=repeats, warmup=1, items=len(train_dataset)
+    )
+
+    if dataset_path is not None:
+        shard_dir = tempfile.mkdtemp(prefix="donut_benchmark_shards_")
+        write_shards(dataset_path, shard_dir, split="train", samples_per_shard=4)
+        stream_dataset = DonutIterableDataset(
+            processor=train_dataset.processor,
+            model=train_dataset.model,
+            shard_dir=path.join(shard_dir, "train"),
+            max_length=MAX_LENGTH,
+            task_start_token=train_dataset.task_start_token,
+            shuffle_buffer=8,
+        )
+        stream_dataloader = DataLoader(stream_dataset, batch_size=2, num_workers=0)
+        results["data/dataloader_train_stream_epoch"] = measure(
+            lambda: list(stream_dataloader), repeats=repeats, warmup=1, items=len(stream_dataset)
+        )
+    return results
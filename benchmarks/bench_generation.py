@@ -0,0 +1,42 @@
+from typing import Dict, Sequence
+import torch
+from transformers import DonutProcessor, VisionEncoderDecoderModel
+from benchmarks.common import MAX_LENGTH, measure
+
+
+def run(
+    model: VisionEncoderDecoderModel,
+    processor: DonutProcessor,
+    pixel_values: torch.Tensor,
+    batch_sizes: Sequence[int] = (1, 2, 4),
+    repeats: int = 3,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Measures greedy `generate` latency for several batch sizes.
+
+    The random model rarely emits EOS, so every sequence runs to `MAX_LENGTH`, which makes the
+    numbers comparable between runs.
+    """
+    model.eval()
+    prompt_token_id = processor.tokenizer.convert_tokens_to_ids("<s_funsd>")
+    results = {}
+    for batch_size in batch_sizes:
+        batch = pixel_values[:1].repeat(batch_size, 1, 1, 1)
+        decoder_input_ids = torch.full((batch_size, 1), prompt_token_id, dtype=torch.long)
+
+        def generate():
+            with torch.no_grad():
+                model.generate(
+                    batch,
+                    decoder_input_ids=decoder_input_ids,
+                    max_length=MAX_LENGTH,
+                    min_length=MAX_LENGTH,
+                    pad_token_id=processor.tokenizer.pad_token_id,
+                    eos_token_id=processor.tokenizer.eos_token_id,
+                    use_cache=True,
+                    num_beams=1,
+                    bad_words_ids=[[processor.tokenizer.unk_token_id]],
+                )
+
+        results[f"generation/greedy_bs{batch_size}"] = measure(generate, repeats=repeats, warmup=1, items=batch_size)
+    return results
@@ -0,0 +1,101 @@
+from typing import Dict
+import torch
+from transformers import VisionEncoderDecoderModel
+from donut_distill.models.student import create_student_small
+from donut_distill.training.losses import calculate_loss_and_accuracy_distillation
+from donut_distill.training.utils import build_optimizer, build_param_groups, optimizer_state_bytes
+from benchmarks.common import STUDENT_DECODER_LAYER_MAP, measure
+
+
+def build_student(teacher: VisionEncoderDecoderModel, share_weights: bool = False) -> VisionEncoderDecoderModel:
+    return create_student_small(
+        teacher=teacher,
+        teacher_config=teacher.config,
+        encoder_layer_map=[],
+        decoder_layer_map=STUDENT_DECODER_LAYER_MAP,
+        share_weights=share_weights,
+    )
+
+
+def run(teacher: VisionEncoderDecoderModel, train_batch, repeats: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Measures forward and forward/backward step time of the teacher and the student,
+    a full distillation step (teacher forward, student forward/backward, distillation loss)
+    and the student's optimizer step per Adam implementation (with the optimizer state size).
+    """
+    pixel_values, decoder_input_ids, labels = train_batch
+    decoder_input_ids = decoder_input_ids[:, :-1]
+    labels = labels[:, 1:]
+    batch_size = pixel_values.shape[0]
+
+    student = build_student(teacher)
+    results = {
+        "model/student_create": measure(lambda: build_student(teacher), repeats=repeats, warmup=1),
+        "model/student_create_shared": measure(
+            lambda: build_student(teacher, share_weights=True), repeats=repeats, warmup=1
+        ),
+    }
+
+    for name, model in (("teacher", teacher), ("student", student)):
+        def forward():
+            with torch.no_grad():
+                model(pixel_values, decoder_input_ids=decoder_input_ids, labels=labels)
+
+        def forward_backward():
+            model.zero_grad(set_to_none=True)
+            model(pixel_values, decoder_input_ids=decoder_input_ids, labels=labels).loss.backward()
+
+        model.train()
+        results[f"model/{name}_forward"] = measure(forward, repeats=repeats, items=batch_size)
+        results[f"model/{name}_forward_backward"] = measure(forward_backward, repeats=repeats, items=batch_size)
+        model.eval()
+
+    def distillation_step():
+        student.zero_grad(set_to_none=True)
+        with torch.no_grad():
+            teacher_outputs = teacher(
+                pixel_values,
+                decoder_input_ids=decoder_input_ids,
+                labels=labels,
+                output_attentions=True,
+                output_hidden_states=True,
+            )
+        student_outputs = student(
+            pixel_values,
+            decoder_input_ids=decoder_input_ids,
+            labels=labels,
+            output_attentions=True,
+            output_hidden_states=True,
+        )
+        loss = calculate_loss_and_accuracy_distillation(
+            outputs=student_outputs,
+            teacher_outputs=teacher_outputs,
+            is_first_distillation_phase=True,
+            is_1phase_distillation=True,
+            decoder_layer_map=STUDENT_DECODER_LAYER_MAP,
+            device=torch.device("cpu"),
+        )
+        loss.backward()
+
+    student.train()
+    results["model/distillation_step"] = measure(distillation_step, repeats=repeats, items=batch_size)
+
+    # Optimizer steps on the gradients of one backward pass (the tiny lr keeps the weights nearly unchanged)
+    student.zero_grad(set_to_none=True)
+    student(pixel_values, decoder_input_ids=decoder_input_ids, labels=labels).loss.backward()
+    variants = [(implementation, ()) for implementation in ("for-loop", "foreach", "fused")]
+    variants.append(("foreach", ("encoder",)))
+    for implementation, freeze_modules in variants:
+        name = f"model/optimizer_{implementation}" + ("_frozen_encoder" if freeze_modules else "")
+        try:
+            optimizer = build_optimizer(
+                build_param_groups(student, freeze_modules=freeze_modules), lr=1e-12, implementation=implementation
+            )
+        except (RuntimeError, ValueError):
+            # Fused kernels aren't available on every device
+            continue
+        results[name] = measure(optimizer.step, repeats=repeats)
+        results[name]["state_mb"] = optimizer_state_bytes(optimizer) / 2**20
+    student.requires_grad_(True)
+    student.eval()
+    return results
@@ -0,0 +1,77 @@
+import random
+from typing import Dict, List
+from transformers import DonutProcessor
+from donut_distill.data.donut_dataset import DonutDataset
+from donut_distill.data.postprocess_donut import postprocess_donut_funsd, token2json, token2json_from_ids
+from donut_distill.evaluation.metrics import FunsdMetricAccumulator, calculate_metrics_docvqa, calculate_metrics_docvqa_batch
+from benchmarks.common import measure
+
+
+def _synthetic_docvqa(num_questions: int = 2000, seed: int = 0):
+    rng = random.Random(seed)
+    alphabet = "abcdefghij 0123456789"
+
+    def text() -> str:
+        return "".join(rng.choice(alphabet) for _ in range(rng.randrange(1, 20)))
+
+    ground_truths = [[text() for _ in range(rng.randrange(1, 4))] for _ in range(num_questions)]
+    predictions = [text() for _ in range(num_questions)]
+    return ground_truths, predictions
+
+
+def run(processor: DonutProcessor, val_dataset: DonutDataset, repeats: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Measures sequence parsing (HF `token2json` vs the fast parser) and metric computation.
+    """
+    sequences: List[str] = [sequence for sequences in val_dataset.gt_token_sequences for sequence in sequences]
+    token_ids = [processor.tokenizer(sequence, add_special_tokens=False).input_ids for sequence in sequences]
+    results = {
+        "postprocess/token2json_hf": measure(
+            lambda: [processor.token2json(sequence) for sequence in sequences], repeats=repeats, items=len(sequences)
+        ),
+        "postprocess/token2json_fast": measure(
+            lambda: [token2json(sequence, processor) for sequence in sequences], repeats=repeats, items=len(sequences)
+        ),
+        # Generated sequences arrive as ids, so decoding is part of the cost
+        "postprocess/decode_token2json_fast": measure(
+            lambda: [token2json(processor.tokenizer.decode(ids), processor) for ids in token_ids],
+            repeats=repeats,
+            items=len(token_ids),
+        ),
+        "postprocess/token2json_from_ids": measure(
+            lambda: [token2json_from_ids(ids, processor) for ids in token_ids], repeats=repeats, items=len(token_ids)
+        ),
+        "postprocess/funsd": measure(
+            lambda: [postprocess_donut_funsd(sequence, processor) for sequence in sequences],
+            repeats=repeats,
+            items=len(sequences),
+        ),
+    }
+
+    # FUNSD metrics: the ground truth against a shuffled copy of itself
+    rng = random.Random(0)
+    pairs = []
+    for gt_parses in val_dataset.gt_parses:
+        prediction = list(gt_parses[0])
+        rng.shuffle(prediction)
+        pairs.append((gt_parses[0], prediction[: int(0.8 * len(prediction))]))
+
+    def funsd_metrics():
+        accumulator = FunsdMetricAccumulator(fuzzy_threshold=0.2)
+        for ground_truth, prediction in pairs:
+            accumulator.update(ground_truth, prediction)
+        return accumulator.compute()
+
+    results["metrics/funsd_accumulator"] = measure(funsd_metrics, repeats=repeats, items=len(pairs))
+
+    # DocVQA metrics on synthetic answers
+    ground_truths, predictions = _synthetic_docvqa()
+    results["metrics/docvqa_per_sample"] = measure(
+        lambda: [calculate_metrics_docvqa(gold, pred) for gold, pred in zip(ground_truths, predictions)],
+        repeats=repeats,
+        items=len(predictions),
+    )
+    results["metrics/docvqa_batch"] = measure(
+        lambda: calculate_metrics_docvqa_batch(ground_truths, predictions), repeats=repeats, items=len(predictions)
+    )
+    return results
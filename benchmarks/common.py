@@ -0,0 +1,125 @@
+import json
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+import torch
+from transformers import (
+    DonutImageProcessor,
+    DonutProcessor,
+    DonutSwinConfig,
+    MBartConfig,
+    VisionEncoderDecoderConfig,
+    VisionEncoderDecoderModel,
+    XLMRobertaTokenizer,
+)
+
+# Bundled FUNSD samples (train/test splits with metadata.jsonl)
+DATASET_PATH = str(Path(__file__).resolve().parent.parent / "dataset_labeled_human")
+
+# Tiny synthetic model, small enough to benchmark on CPU
+INPUT_SIZE = (160, 128)
+MAX_LENGTH = 64
+TEACHER_DECODER_LAYERS = 4
+STUDENT_DECODER_LAYER_MAP = [0, 2]
+
+
+def measure(fn: Callable[[], object], repeats: int = 10, warmup: int = 2, items: int = 1) -> Dict[str, float]:
+    """
+    Calls `fn` `warmup` + `repeats` times and returns wall time statistics in milliseconds.
+
+    Args:
+        fn (Callable): The function to time.
+        repeats (int): Number of timed calls.
+        warmup (int): Number of untimed calls before.
+        items (int): Number of items one call processes, used for `items_per_s`.
+
+    Returns:
+        Dict[str, float]: mean_ms, std_ms, min_ms and items_per_s.
+    """
+    for _ in range(warmup):
+        fn()
+
+    times: List[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(1000 * (time.perf_counter() - start))
+
+    mean_ms = statistics.mean(times)
+    return {
+        "mean_ms": mean_ms,
+        "std_ms": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "min_ms": min(times),
+        "items_per_s": 1000 * items / mean_ms if mean_ms > 0 else 0.0,
+    }
+
+
+def _entity_texts(dataset_path: str) -> List[str]:
+    texts = []
+    for metadata_path in Path(dataset_path).glob("*/metadata.jsonl"):
+        with open(metadata_path, "r") as f:
+            for line in f:
+                ground_truth = json.loads(json.loads(line)["ground_truth"])
+                texts += [element["text"] for element in ground_truth["gt_parse"]["elements"]]
+    return texts
+
+
+def build_tiny_processor(dataset_path: str = DATASET_PATH, vocab_size: int = 400) -> DonutProcessor:
+    """
+    Trains a small sentencepiece vocabulary on the bundled samples, so no pretrained files are downloaded.
+    """
+    import sentencepiece as spm
+
+    work_dir = Path(tempfile.mkdtemp(prefix="donut_benchmark_"))
+    with open(work_dir / "corpus.txt", "w") as f:
+        f.write("\n".join(_entity_texts(dataset_path)))
+    spm.SentencePieceTrainer.train(
+        input=str(work_dir / "corpus.txt"),
+        model_prefix=str(work_dir / "spm"),
+        vocab_size=vocab_size,
+        character_coverage=1.0,
+        minloglevel=2,
+    )
+
+    tokenizer = XLMRobertaTokenizer(str(work_dir / "spm.model"))
+    image_processor = DonutImageProcessor(
+        size={"height": INPUT_SIZE[0], "width": INPUT_SIZE[1]}, do_align_long_axis=False
+    )
+    return DonutProcessor(image_processor=image_processor, tokenizer=tokenizer)
+
+
+def build_tiny_teacher(processor: DonutProcessor) -> VisionEncoderDecoderModel:
+    """
+    Builds a randomly initialized Donut model with the structure of the real one at a fraction of the size.
+    """
+    torch.manual_seed(0)
+    encoder_config = DonutSwinConfig(
+        image_size=list(INPUT_SIZE),
+        patch_size=4,
+        embed_dim=32,
+        depths=[2, 2, 6, 2],
+        num_heads=[1, 2, 4, 8],
+        window_size=4,
+    )
+    decoder_config = MBartConfig(
+        vocab_size=len(processor.tokenizer),
+        d_model=128,
+        decoder_layers=TEACHER_DECODER_LAYERS,
+        decoder_attention_heads=4,
+        decoder_ffn_dim=256,
+        max_position_embeddings=MAX_LENGTH + 2,
+        is_decoder=True,
+        add_cross_attention=True,
+        scale_embedding=True,
+        add_final_layer_norm=True,
+    )
+    config = VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder_config, decoder_config)
+    config.decoder_start_token_id = processor.tokenizer.bos_token_id
+    config.pad_token_id = processor.tokenizer.pad_token_id
+    config.eos_token_id = processor.tokenizer.eos_token_id
+
+    model = VisionEncoderDecoderModel(config=config)
+    model.eval()
+    return model
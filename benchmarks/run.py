@@ -0,0 +1,156 @@
+import json
+import platform
+import sys
+from datetime import datetime
+from typing import Any, Dict, Optional
+import torch
+import transformers
+from torch.utils.data.dataloader import default_collate
+from benchmarks import bench_data, bench_generation, bench_model, bench_postprocess
+from benchmarks.common import DATASET_PATH, build_tiny_processor, build_tiny_teacher
+import donut_distill.config.config as CONFIG
+
+SUITES = ("data", "model", "generation", "postprocess")
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def run_benchmarks(suites=SUITES, repeats: int = 5, dataset_path: str = DATASET_PATH) -> Dict[str, Dict[str, float]]:
+    """
+    Runs the selected benchmark suites on CPU.
+
+    Args:
+        suites (Sequence[str]): Subset of "data", "model", "generation" and "postprocess".
+        repeats (int): Timed repetitions per benchmark.
+        dataset_path (str): Dataset in the FUNSD format.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Benchmark name -> timing statistics (see `measure`).
+    """
+    CONFIG.VERBOSE = False
+    torch.manual_seed(0)
+    processor = build_tiny_processor(dataset_path)
+    teacher = build_tiny_teacher(processor)
+    # The train dataset adds the key tokens to the tokenizer and resizes the decoder
+    train_dataset, val_dataset = bench_data.build_datasets(processor, teacher, dataset_path)
+    train_batch = default_collate([train_dataset[idx] for idx in range(min(2, len(train_dataset)))])
+
+    results = {}
+    if "data" in suites:
+        results.update(bench_data.run(train_dataset, val_dataset, repeats=repeats, dataset_path=dataset_path))
+    if "model" in suites:
+        results.update(bench_model.run(teacher, train_batch, repeats=repeats))
+    if "generation" in suites:
+        results.update(bench_generation.run(teacher, processor, train_batch[0], repeats=max(1, repeats // 2)))
+    if "postprocess" in suites:
+        results.update(bench_postprocess.run(processor, val_dataset, repeats=repeats))
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float = 0.2,
+    min_delta_ms: float = 0.5,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Compares the mean times with a baseline.
+
+    A benchmark regresses if it is more than `threshold` (relative) and `min_delta_ms` (absolute)
+    slower than the baseline. The absolute margin keeps sub-millisecond benchmarks from flapping.
+
+    Args:
+        results (Dict): Results of `run_benchmarks`.
+        baseline (Dict): Results of an earlier run.
+        threshold (float): Allowed relative slowdown, e.g. 0.2 for 20%.
+        min_delta_ms (float): Allowed absolute slowdown in milliseconds.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Benchmark name -> baseline_ms, current_ms, ratio and regression.
+    """
+    comparison = {}
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        baseline_ms = baseline[name]["mean_ms"]
+        current_ms = stats["mean_ms"]
+        ratio = current_ms / baseline_ms if baseline_ms > 0 else float("inf")
+        comparison[name] = {
+            "baseline_ms": baseline_ms,
+            "current_ms": current_ms,
+            "ratio": ratio,
+            "regression": ratio > 1 + threshold and current_ms - baseline_ms > min_delta_ms,
+        }
+    return comparison
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path, "r") as f:
+        report = json.load(f)
+    # Accept full reports as well as bare result dicts
+    return report.get("results", report)
+
+
+def print_table(results: Dict[str, Dict[str, float]], comparison: Optional[Dict[str, Dict[str, Any]]] = None):
+    comparison = comparison or {}
+    print(f"{'benchmark':<40} {'mean ms':>10} {'std ms':>10} {'items/s':>10} {'vs base':>9}")
+    for name, stats in results.items():
+        line = f"{name:<40} {stats['mean_ms']:>10.2f} {stats['std_ms']:>10.2f} {stats['items_per_s']:>10.1f}"
+        if name in comparison:
+            line += f" {comparison[name]['ratio']:>8.2f}x"
+            if comparison[name]["regression"]:
+                line += "  REGRESSION"
+        print(line)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the CPU benchmark suite on tiny synthetic models")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repetitions per benchmark")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads (default: torch default)")
+    parser.add_argument("--dataset", type=str, default=DATASET_PATH, help="Dataset in the FUNSD format")
+    parser.add_argument("--output", type=str, default=None, help="Path for the JSON report")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON report of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown vs the baseline")
+    parser.add_argument("--min_delta_ms", type=float, default=0.5, help="Allowed absolute slowdown vs the baseline")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = run_benchmarks(args.suites, repeats=args.repeats, dataset_path=args.dataset)
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "results": results,
+    }
+
+    comparison = None
+    if args.baseline:
+        comparison = compare(results, load_baseline(args.baseline), args.threshold, args.min_delta_ms)
+        report["baseline"] = args.baseline
+        report["threshold"] = args.threshold
+        report["comparison"] = comparison
+        report["regressions"] = [name for name, entry in comparison.items() if entry["regression"]]
+
+    print_table(results, comparison)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved report to {args.output}")
+
+    # Non-zero exit code, so CI can fail on regressions
+    if comparison is not None and report["regressions"]:
+        print(f"Regressions: {', '.join(report['regressions'])}")
+        sys.exit(1)
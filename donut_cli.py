@@ -7,9 +7,23 @@ from PIL import Image
 import torch
 import re
 import json
+import argparse
+from donut_distill.models.helpers import load_inference_model
+from donut_distill.models.onnx_export import is_onnx_checkpoint
+from donut_distill.models.quantization import is_quantized_checkpoint
+from donut_distill.data.postprocess_donut import token2json
 
 if __name__ == "__main__":
-    donut_path = "result/donut_20241208_143816"
+    parser = argparse.ArgumentParser(description="Parse document images with a Donut checkpoint")
+    parser.add_argument("--donut_path", help="Directory with the model and processor", type=str, default="result/donut_20241208_143816")
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run fp32 checkpoints with dynamic int8 quantization on CPU (faster, may change predictions)",
+    )
+    args = parser.parse_args()
+
+    donut_path = args.donut_path
     model_path = os.path.join(donut_path, "model")
     processor_path = os.path.join(donut_path, "processor")
     # if not os.path.isdir(model_path):
@@ -18,8 +32,11 @@ if __name__ == "__main__":
 
     # donut_config = VisionEncoderDecoderConfig.from_pretrained(model_path)
     processor = DonutProcessor.from_pretrained(processor_path)
-    model = VisionEncoderDecoderModel.from_pretrained(model_path)
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    if is_onnx_checkpoint(model_path) or is_quantized_checkpoint(model_path):
+        device = "cpu"  # Quantized and ONNX checkpoints only run on CPU
+    # fp32 checkpoints are only quantized on request, as it changes the predictions
+    model = load_inference_model(model_path, quantize=args.quantize and device == "cpu")
     model.to(device)
     task_prompt = "<s_funsd>"
 
@@ -56,6 +73,6 @@ if __name__ == "__main__":
         for seq in processor.batch_decode(outputs.sequences):
             seq = seq.replace(processor.tokenizer.eos_token, "").replace(processor.tokenizer.pad_token, "")
             seq = re.sub(r"<.*?>", "", seq, count=1).strip()  # remove first task start token
-            output["predictions"].append(processor.token2json(seq))
+            output["predictions"].append(token2json(seq, processor))
 
         print(output)
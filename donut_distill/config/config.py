@@ -3,24 +3,42 @@ DISTILL = False
 RESULT_PATH= "./result/docvqa"
 VERBOSE= True
 LOG_INTERVAL = 10 # After how many steps the logger should log
+LOGGER = "wandb" # Metrics backend: "wandb", "tensorboard", "jsonl" (offline) or "none"
+LOG_DIR = "./result/logs" # Output directory of the tensorboard and jsonl backends
+PROFILE = False # Time the phases of each training step (data, h2d, forward, backward, optimizer) and log throughput
+PROFILE_DIR = "./result/profile" # Directory for torch.profiler traces
+PROFILE_TRACE_STEPS = None # Optional [start, end) step window for a torch.profiler trace, e.g. [20, 25]
 
 ''' transformer parameters '''
 MODEL_ID            = 'naver-clova-ix/donut-base'
 MAX_LENGTH          = 128
 INPUT_SIZE= [1280, 960] # when the input resolution differs from the pre-training setting, some weights will be newly initialized (but the model training would be okay)
 
+''' Inference parameters '''
+QUANTIZE_ENCODER = False # Also quantize the Swin encoder MLPs when dynamic int8 quantization is used
+
 ''' Dataset parameters '''
 DATASET= "./preprocessed_dataset_docvqa/" # loading datasets (from moldehub or path)
 DATASET_NAME_TRAINING="train"
 DATASET_NAME_VALIDATE="validation"
 SORT_JSON_KEY= False
 ALIGN_LONG_AXIS= False
+TRAIN_SHARDS = None # Directory with the tar shards of the training split (see write_shards), streamed instead of DATASET's training split
+SHUFFLE_BUFFER = 1000 # Samples in the shuffle buffer of each dataloader worker when streaming shards
+SHUFFLE_SEED = 42 # Seed of the shard order and shuffle buffers when streaming shards
+PACK_SEQUENCES = False # Train on several question/answer targets of the same page per decoder sequence (block-diagonal attention)
+PACK_MAX_LENGTH = None # Token budget of a packed sequence, None uses MAX_LENGTH
+PACK_MAX_SEGMENTS = None # Maximum number of targets per packed sequence, None only limits by tokens
 
 ''' Train parameters '''
 TRAIN_BATCH_SIZES=4
 ACCUMULATION_STEPS = 1
 LR= 3e-5
 GRADIENT_CLIP_VAL= 0.25
+OPTIMIZER = "adam" # "adam", "adamw" or "adamw8bit" (8-bit optimizer states, requires bitsandbytes and CUDA)
+OPTIMIZER_IMPLEMENTATION = "auto" # "auto" (fused if supported, else foreach), "fused", "foreach" or "for-loop"
+WEIGHT_DECAY = 0.0 # Not applied to biases, norms and relative position bias tables
+FREEZE_MODULES = [] # Parameter name prefixes to freeze, e.g. ["encoder"] to train only the student decoder
 
 NUM_NODES= 1
 NUM_WORKERS= 0
@@ -33,6 +51,13 @@ MAX_STEPS= -1
 VAL_BATCH_SIZES=1
 VAL_CHECK_INTERVAL = 0.2
 LIMIT_VAL_BATCHES = 1
+VAL_SUBSET_SEED = 42 # Seed of the fixed validation subset used during training when LIMIT_VAL_BATCHES < 1
+MATERIALIZE_VAL_SUBSET = False # Preprocess the validation subset once and keep it (pixel values included) in memory, ~15 MB per sample
+PREDICTION_CACHE_DIR = None # Optional directory to persist cached predictions of standalone evaluations (per model fingerprint)
+EARLY_EXIT_ON_ANSWER = False # DocVQA: end a sequence once </s_answer> is generated and drop it from the active batch (greedy only)
+CONSTRAINED_DECODING = False # Only allow well-formed <s_key>...</s_key> structures during generation and stop once they are closed
+FUZZY_MATCH_THRESHOLD = None # FUNSD: also report F1 with entities matched up to this normalized edit distance (e.g. 0.2)
+FUZZY_MATCH_ASSIGNMENT = "greedy" # FUNSD fuzzy matching: "greedy" or "optimal" (requires scipy)
 
 ''' Distillation parameters '''
 TEACHER_MODEL_PATH = 'result/docvqa/best_model'
@@ -42,3 +67,15 @@ ALPHA = 1 # Weight for self-attention loss.
 BETA = 1 # Weight for hidden states loss.
 GAMMA = 1 # Weight for logit-based loss.
 DELTA = 1 # Weight for cross-attention loss.
+EPSILON = 0 # Weight for the encoder output loss (pooled to a common grid if the student works at a lower resolution).
+DISTILLATION_PHASES = 1 # 1: attentions, hidden states and logits together, 2: intermediate layers first, then only the logits
+FIRST_PHASE_EPOCHS = 10 # Length of the intermediate phase with 2 phases
+FIRST_PHASE_STEPS = None # Length of the intermediate phase in steps (batches), overrides FIRST_PHASE_EPOCHS
+FIRST_PHASE_LR = None # Learning rate of the intermediate phase, None uses LR (the logit phase always uses LR)
+FIRST_PHASE_WARMUP_STEPS = None # Warmup of the intermediate phase, None uses WARMUP_STEPS (the logit phase always uses WARMUP_STEPS)
+ZETA = 0 # Weight for the hidden states loss of the mapped encoder blocks (only with an ENCODER_LAYER_MAP).
+ETA = 0 # Weight for the attention loss of the mapped encoder blocks (only with an ENCODER_LAYER_MAP).
+ENCODER_STAGE_WEIGHTS = None # Relative weight of each encoder stage in the ZETA/ETA losses, e.g. [1, 1, 2, 1], None weights them equally
+STUDENT_PRUNED_HEADS = None # Decoder heads of the teacher to remove from the student, e.g. {"self_attn": {0: [1, 5]}, "encoder_attn": {}} (see head_pruning.py)
+STUDENT_INPUT_SCALE = 1.0 # Input resolution of the student relative to INPUT_SIZE, e.g. 0.75 (rounded to multiples of 32)
+STUDENT_WINDOW_SIZE = None # Swin window size of the student (relative position biases are interpolated), None keeps the teacher's
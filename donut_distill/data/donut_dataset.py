@@ -1,14 +1,156 @@
+import hashlib
 import json
 import random
-from typing import Any, List
+from os import path
+from typing import Any, Callable, Iterable, List, Optional, Tuple
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from datasets import load_dataset
 from transformers import DonutProcessor, VisionEncoderDecoderModel
+from donut_distill.data.postprocess_donut import postprocess_donut_docvqa, postprocess_donut_funsd
 
 # https://github.com/NielsRogge/Transformers-Tutorials/blob/master/Donut/CORD/Fine_tune_Donut_on_a_custom_dataset_(CORD)_with_PyTorch_Lightning.ipynb
 
-added_tokens = []
+
+class SpecialTokenRegistry:
+    """
+    Set of the special tokens registered by the datasets, used by `json2token` to map values to
+    categorical tokens (a value "x" becomes "<x/>" if that token is registered).
+
+    The registry is filled in the main process while the datasets are built, the DataLoader workers
+    get a copy with their dataset and only read it (registering tokens in a worker raises, since the
+    workers' copies would diverge). It is saved next to the processor, so a checkpoint keeps the
+    same categorical tokens.
+
+    Args:
+        tokens (Iterable[str]): Initial tokens.
+    """
+
+    FILE_NAME = "special_tokens_registry.json"
+
+    def __init__(self, tokens: Iterable[str] = ()):
+        self._tokens = set(tokens)
+
+    def __contains__(self, token: str) -> bool:
+        return token in self._tokens
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __iter__(self):
+        return iter(self._tokens)
+
+    def add(self, tokens: Iterable[str]):
+        """Registers tokens, only allowed outside of DataLoader workers."""
+        if get_worker_info() is not None:
+            raise RuntimeError("Special tokens have to be registered before the DataLoader workers start")
+        self._tokens.update(tokens)
+
+    def categorical_token(self, value: str) -> str:
+        """Returns "<value/>" if it is a registered categorical token, else the value."""
+        token = f"<{value}/>"
+        return token if token in self._tokens else value
+
+    def save_pretrained(self, save_directory: str):
+        """Writes the registry to `FILE_NAME` in `save_directory` (e.g. next to the processor)."""
+        with open(path.join(save_directory, self.FILE_NAME), "w") as f:
+            json.dump(sorted(self._tokens), f, indent=2)
+
+    @classmethod
+    def from_pretrained(cls, directory: str) -> "SpecialTokenRegistry":
+        """Loads the registry saved in `directory`, an empty registry if there is none."""
+        registry_path = path.join(directory, cls.FILE_NAME)
+        if not path.isfile(registry_path):
+            return cls()
+        with open(registry_path, "r") as f:
+            return cls(json.load(f))
+
+
+# Registry of the datasets (and of `json2token` calls without a registry)
+default_registry = SpecialTokenRegistry()
+
+
+def json2token(
+    obj: Any,
+    sort_json_key: bool = True,
+    on_json_key: Optional[Callable[[str], None]] = None,
+    registry: Optional[SpecialTokenRegistry] = None,
+) -> str:
+    """
+    Convert a JSON object into a token sequence.
+
+    Handles different data structures:
+    - Dict: Recursively converts keys/values into a structured token format.
+    - List: Joins elements with a separator token.
+    - Other types: Converts to string and applies special token formatting.
+
+    Args:
+        obj (Any): The JSON object.
+        sort_json_key (bool): Whether to sort the keys (in reverse order).
+        on_json_key (Callable[[str], None], optional): Called for every key, e.g. to add its tokens to the tokenizer.
+        registry (SpecialTokenRegistry, optional): Registry of the categorical tokens, defaults to `default_registry`.
+
+    Returns:
+        str: The token sequence.
+    """
+    if registry is None:
+        registry = default_registry
+    if type(obj) is dict:
+        if len(obj) == 1 and "text_sequence" in obj:
+            return obj["text_sequence"]
+        else:
+            output = ""
+            if sort_json_key:
+                keys = sorted(obj.keys(), reverse=True)
+            else:
+                keys = obj.keys()
+            for k in keys:
+                if on_json_key is not None:
+                    on_json_key(k)
+                output += (
+                    rf"<s_{k}>"
+                    + json2token(obj[k], sort_json_key, on_json_key, registry)
+                    + rf"</s_{k}>"
+                )
+            return output
+    elif type(obj) is list:
+        return r"<sep/>".join(
+            [
+                json2token(item, sort_json_key, on_json_key, registry)
+                for item in obj
+            ]
+        )
+    else:
+        # for categorical special tokens
+        return registry.categorical_token(str(obj))
+
+
+def register_tokens(
+    processor: DonutProcessor,
+    model: VisionEncoderDecoderModel,
+    list_of_tokens: List[str],
+    registry: Optional[SpecialTokenRegistry] = None,
+):
+    """
+    Add special tokens to the tokenizer and the registry, and resize the model's embedding layer accordingly.
+    Tokens that are already part of the tokenizer (e.g. of a fine-tuned checkpoint) are registered too.
+    """
+    (default_registry if registry is None else registry).add(list_of_tokens)
+    newly_added_num = processor.tokenizer.add_tokens(list_of_tokens)
+    if newly_added_num > 0:
+        model.decoder.resize_token_embeddings(len(processor.tokenizer))
+        model.config.vocab_size = len(processor.tokenizer)
+
+
+def mask_labels(input_ids: torch.Tensor, pad_token_id: int, prompt_end_token_id: int, ignore_id: int = -100) -> torch.Tensor:
+    """
+    Creates the training labels of a target sequence: padding and the prompt (up to and including
+    the prompt end token) are set to `ignore_id`.
+    """
+    labels = input_ids.clone()
+    labels[labels == pad_token_id] = ignore_id
+    labels[: torch.nonzero(labels == prompt_end_token_id).sum() + 1] = ignore_id
+    return labels
 
 
 class DonutDataset(Dataset):
@@ -29,6 +171,7 @@ class DonutDataset(Dataset):
         prompt_end_token (str, optional): Token marking the end of the prompt (defaults to task_start_token).
         sort_json_key (bool): Whether to sort JSON keys before tokenization.
         task (str): Task name (used for specific behavior like DocVQA).
+        registry (SpecialTokenRegistry, optional): Registry of the special tokens, defaults to `default_registry`.
     """
 
     def __init__(
@@ -43,6 +186,7 @@ class DonutDataset(Dataset):
         prompt_end_token: str = None,
         sort_json_key: bool = True,
         task: str = "",
+        registry: Optional[SpecialTokenRegistry] = None,
     ):
         super().__init__()
 
@@ -57,10 +201,14 @@ class DonutDataset(Dataset):
         )
         self.sort_json_key = sort_json_key
         self.task = task
+        # Kept as an attribute, so DataLoader workers get the registry with the dataset
+        self.registry = default_registry if registry is None else registry
 
         # Load dataset from HuggingFace or local path
         self.dataset = load_dataset(dataset_name_or_path, split=self.split)
         self.dataset_length = len(self.dataset)
+        # Identifies the data, e.g. for caching predictions of standalone evaluations
+        self.cache_key = f"{self.split}-{self.dataset._fingerprint}"
 
         # Process ground truth token sequences
         self.gt_token_sequences = []
@@ -89,6 +237,21 @@ class DonutDataset(Dataset):
                 ]
             )
 
+        # Parse the ground truths once, so evaluation doesn't re-parse them on every pass
+        self.gt_parses = []
+        if self.split != "train":
+            for gt_token_sequences in self.gt_token_sequences:
+                if self.task == "docvqa":
+                    # Normalized answers of all ground truths
+                    self.gt_parses.append(
+                        [postprocess_donut_docvqa(sequence, self.processor) for sequence in gt_token_sequences]
+                    )
+                else:
+                    # Entity list per ground truth sequence
+                    self.gt_parses.append(
+                        [postprocess_donut_funsd(sequence, self.processor) for sequence in gt_token_sequences]
+                    )
+
         # Add special tokens for start/prompt end
         self.add_tokens([self.task_start_token, self.prompt_end_token])
         self.prompt_end_token_id = self.processor.tokenizer.convert_tokens_to_ids(
@@ -102,57 +265,25 @@ class DonutDataset(Dataset):
         sort_json_key: bool = True,
     ):
         """
-        Convert a JSON object into a token sequence.
+        Convert a JSON object into a token sequence (see `json2token`).
 
-        Handles different data structures:
-        - Dict: Recursively converts keys/values into a structured token format.
-        - List: Joins elements with a separator token.
-        - Other types: Converts to string and applies special token formatting.
+        With `update_special_tokens_for_json_key`, the <s_key>/</s_key> tokens of new keys are added to the tokenizer.
         """
-        if type(obj) is dict:
-            if len(obj) == 1 and "text_sequence" in obj:
-                return obj["text_sequence"]
-            else:
-                output = ""
-                if sort_json_key:
-                    keys = sorted(obj.keys(), reverse=True)
-                else:
-                    keys = obj.keys()
-                for k in keys:
-                    if update_special_tokens_for_json_key:
-                        self.add_tokens([rf"<s_{k}>", rf"</s_{k}>"])
-                    output += (
-                        rf"<s_{k}>"
-                        + self.json2token(
-                            obj[k], update_special_tokens_for_json_key, sort_json_key
-                        )
-                        + rf"</s_{k}>"
-                    )
-                return output
-        elif type(obj) is list:
-            return r"<sep/>".join(
-                [
-                    self.json2token(
-                        item, update_special_tokens_for_json_key, sort_json_key
-                    )
-                    for item in obj
-                ]
-            )
-        else:
-            obj = str(obj)
-            if f"<{obj}/>" in added_tokens:
-                obj = f"<{obj}/>"  # for categorical special tokens
-            return obj
+        return json2token(
+            obj,
+            sort_json_key=sort_json_key,
+            on_json_key=self._add_json_key_tokens if update_special_tokens_for_json_key else None,
+            registry=self.registry,
+        )
+
+    def _add_json_key_tokens(self, key: str):
+        self.add_tokens([rf"<s_{key}>", rf"</s_{key}>"])
 
     def add_tokens(self, list_of_tokens: List[str]):
         """
-        Add special tokens to the tokenizer and resize the model's embedding layer accordingly.
+        Add special tokens to the tokenizer and the registry, and resize the model's embedding layer accordingly.
         """
-        newly_added_num = self.processor.tokenizer.add_tokens(list_of_tokens)
-        if newly_added_num > 0:
-            self.model.decoder.resize_token_embeddings(len(self.processor.tokenizer))
-            self.model.config.vocab_size = len(self.processor.tokenizer)
-            added_tokens.extend(list_of_tokens)
+        register_tokens(self.processor, self.model, list_of_tokens, self.registry)
 
     def __len__(self) -> int:
         """
@@ -179,7 +310,8 @@ class DonutDataset(Dataset):
                 - pixel_values (Tensor): Preprocessed image.
                 - input_ids (Tensor): Tokenized ground truth sequence.
                 - prompt_end_index (int): Index marking the end of the prompt.
-                - target_sequence (str) or full ground truth sequence (str) for DocVQA.
+                - gt_parse (List[dict]): Entities of the selected target sequence, or
+                  gt_parses (List[str]): Normalized answers of all ground truths for DocVQA.
         """
         sample = self.dataset[idx]
 
@@ -190,7 +322,8 @@ class DonutDataset(Dataset):
         ).pixel_values.squeeze()
 
         # Select a ground truth token sequence (can be multiple for DocVQA)
-        target_sequence = random.choice(self.gt_token_sequences[idx])
+        target_idx = random.randrange(len(self.gt_token_sequences[idx]))
+        target_sequence = self.gt_token_sequences[idx][target_idx]
 
         # Tokenize the target sequence
         input_ids = self.processor.tokenizer(
@@ -204,12 +337,8 @@ class DonutDataset(Dataset):
 
         if self.split == "train":
             # Mask labels: ignore padding and prompt tokens
-            labels = input_ids.clone()
-            labels[labels == self.processor.tokenizer.pad_token_id] = (
-                self.ignore_id
-            )
-            labels[: torch.nonzero(labels == self.prompt_end_token_id).sum() + 1] = (
-                self.ignore_id
+            labels = mask_labels(
+                input_ids, self.processor.tokenizer.pad_token_id, self.prompt_end_token_id, self.ignore_id
             )
             return pixel_values, input_ids, labels
         else:
@@ -218,6 +347,65 @@ class DonutDataset(Dataset):
                 input_ids == self.prompt_end_token_id
             ).sum()
             if self.task == 'docvqa':
-                return pixel_values, input_ids, prompt_end_index, "\n".join(self.gt_token_sequences[idx])
+                return pixel_values, input_ids, prompt_end_index, self.gt_parses[idx]
             else:
-                return pixel_values, input_ids, prompt_end_index, target_sequence
+                return pixel_values, input_ids, prompt_end_index, self.gt_parses[idx][target_idx]
+
+
+class ValidationSubset(Dataset):
+    """
+    Fixed, seeded subset of a validation dataset.
+
+    The same samples are drawn for every validation pass, so results of mid-epoch validations
+    are comparable. With `materialize=True` every sample (pixel values included) is preprocessed
+    once at construction and kept in memory, so later passes only cost generation. Materialized
+    pixel values take about 15 MB per sample at 1280x960, so only use it for small subsets.
+
+    Args:
+        dataset (DonutDataset): The full validation dataset.
+        num_samples (int): Size of the subset.
+        seed (int): Seed for drawing the subset (and the target sequence of each sample).
+        materialize (bool): Whether to preprocess and keep all samples in memory.
+    """
+
+    def __init__(self, dataset: DonutDataset, num_samples: int, seed: int = 42, materialize: bool = False):
+        super().__init__()
+        self.dataset = dataset
+        rng = random.Random(seed)
+        self.indices = sorted(rng.sample(range(len(dataset)), min(num_samples, len(dataset))))
+
+        # Identifies the subset, e.g. for caching predictions
+        indices_hash = hashlib.sha1(str(self.indices).encode()).hexdigest()[:16]
+        self.cache_key = f"{dataset.split}-{seed}-{indices_hash}"
+
+        self.samples = None
+        if materialize:
+            # __getitem__ draws the target sequence with `random`, seed it without touching the global state
+            random_state = random.getstate()
+            random.seed(seed)
+            self.samples = [dataset[idx] for idx in self.indices]
+            random.setstate(random_state)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, idx: int):
+        if self.samples is not None:
+            return self.samples[idx]
+        return self.dataset[self.indices[idx]]
+
+
+def collate_fn_eval(batch: List[Tuple]) -> Tuple:
+    """
+    Collate function for validation batches.
+
+    Stacks the tensors and keeps the precomputed ground truth parses as a list per sample
+    (the default collate function would transpose the nested lists).
+    """
+    pixel_values, input_ids, prompt_end_indices, gt_parses = zip(*batch)
+    return (
+        torch.stack(pixel_values),
+        torch.stack(input_ids),
+        torch.stack(prompt_end_indices),
+        list(gt_parses),
+    )
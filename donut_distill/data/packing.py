@@ -0,0 +1,223 @@
+import hashlib
+import random
+from typing import Dict, List, Optional, Sequence
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.utils.data import Dataset
+from datasets import Image
+from transformers import VisionEncoderDecoderModel
+from donut_distill.data.donut_dataset import DonutDataset, mask_labels
+
+
+def page_groups(hf_dataset) -> List[List[int]]:
+    """
+    Groups the rows of a dataset by their page, without decoding the images.
+
+    The page is taken from the "page" column (written by `preprocess_docvqa`), datasets without it
+    are grouped by image file (or image bytes).
+
+    Args:
+        hf_dataset (datasets.Dataset): Dataset with an "image" and optionally a "page" column.
+
+    Returns:
+        List[List[int]]: Row indices per page, in dataset order.
+    """
+    if "page" in hf_dataset.column_names:
+        keys = hf_dataset["page"]
+    else:
+        images = hf_dataset.cast_column("image", Image(decode=False))["image"]
+        # Local image folders have paths, embedded images only bytes
+        keys = [image["path"] or hashlib.sha1(image["bytes"]).hexdigest() for image in images]
+
+    groups: Dict[str, List[int]] = {}
+    for idx, key in enumerate(keys):
+        groups.setdefault(key, []).append(idx)
+    return list(groups.values())
+
+
+def pack_rows(
+    groups: List[List[int]],
+    lengths: Sequence[int],
+    max_length: int,
+    max_segments: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    Greedily packs the rows of each page into sequences of at most `max_length` tokens.
+
+    Args:
+        groups (List[List[int]]): Row indices per page (see `page_groups`).
+        lengths (Sequence[int]): Token length of each row (longer rows are truncated to `max_length`).
+        max_length (int): Token budget of a packed sequence.
+        max_segments (int, optional): Maximum number of rows per packed sequence.
+
+    Returns:
+        List[List[int]]: Row indices per packed sequence, rows of one sequence share the page.
+    """
+    packs = []
+    for group in groups:
+        pack, pack_length = [], 0
+        for row in group:
+            length = min(lengths[row], max_length)
+            if pack and (pack_length + length > max_length or len(pack) == max_segments):
+                packs.append(pack)
+                pack, pack_length = [], 0
+            pack.append(row)
+            pack_length += length
+        if pack:
+            packs.append(pack)
+    return packs
+
+
+class PackedDonutDataset(Dataset):
+    """
+    Packs several question/answer targets of the same page into one decoder sequence.
+
+    DocVQA answers are short, so most of a padded `max_length` sequence is padding. Here each item
+    is one page with several of its rows concatenated, so the questions share one encoder pass and
+    one decoder pass. Each row becomes a segment with its own position ids (starting at 0), and
+    `packed_attention_mask` keeps the causal attention within the segments. Labels are masked per
+    segment like in `DonutDataset` (prompt up to `prompt_end_token`, padding).
+
+    Packs are built once with the longest ground truth of each row, so every drawn target fits.
+
+    Args:
+        dataset (DonutDataset): Training dataset to pack.
+        max_length (int, optional): Token budget of a packed sequence, defaults to the dataset's `max_length`.
+        max_segments (int, optional): Maximum number of rows per packed sequence.
+    """
+
+    def __init__(self, dataset: DonutDataset, max_length: Optional[int] = None, max_segments: Optional[int] = None):
+        super().__init__()
+        if dataset.split != "train":
+            raise ValueError("Only training datasets can be packed")
+        self.dataset = dataset
+        self.max_length = max_length or dataset.max_length
+
+        tokenizer = dataset.processor.tokenizer
+        lengths = [
+            max(len(input_ids) for input_ids in tokenizer(sequences, add_special_tokens=False)["input_ids"])
+            for sequences in dataset.gt_token_sequences
+        ]
+        self.packs = pack_rows(page_groups(dataset.dataset), lengths, self.max_length, max_segments)
+
+    def __len__(self) -> int:
+        return len(self.packs)
+
+    def __getitem__(self, idx: int):
+        """
+        Returns:
+            - pixel_values (Tensor): Preprocessed image of the page.
+            - input_ids (Tensor): Concatenated target sequences, padded to `max_length`.
+            - labels (Tensor): Labels with the prompt of every segment and the padding masked.
+            - position_ids (Tensor): Position of each token within its segment.
+            - segment_ids (Tensor): Segment of each token (1, 2, ...), 0 for padding.
+        """
+        dataset = self.dataset
+        tokenizer = dataset.processor.tokenizer
+        pack = self.packs[idx]
+
+        image = dataset.dataset[pack[0]]["image"].convert("RGB")
+        pixel_values = dataset.processor(image, random_padding=True, return_tensors="pt").pixel_values.squeeze()
+
+        input_ids = torch.full((self.max_length,), tokenizer.pad_token_id, dtype=torch.long)
+        labels = torch.full((self.max_length,), dataset.ignore_id, dtype=torch.long)
+        position_ids = torch.zeros(self.max_length, dtype=torch.long)
+        segment_ids = torch.zeros(self.max_length, dtype=torch.long)
+
+        offset = 0
+        for segment, row in enumerate(pack, start=1):
+            if offset == self.max_length:
+                break
+            target_sequence = random.choice(dataset.gt_token_sequences[row])
+            segment_input_ids = tokenizer(
+                target_sequence,
+                add_special_tokens=False,
+                max_length=self.max_length - offset,
+                truncation=True,
+                return_tensors="pt",
+            )["input_ids"].squeeze(0)
+
+            # Mask labels: ignore padding and prompt tokens (as in DonutDataset, per segment)
+            segment_labels = mask_labels(
+                segment_input_ids, tokenizer.pad_token_id, dataset.prompt_end_token_id, dataset.ignore_id
+            )
+
+            length = len(segment_input_ids)
+            input_ids[offset : offset + length] = segment_input_ids
+            labels[offset : offset + length] = segment_labels
+            position_ids[offset : offset + length] = torch.arange(length)
+            segment_ids[offset : offset + length] = segment
+            offset += length
+
+        return pixel_values, input_ids, labels, position_ids, segment_ids
+
+
+def packed_attention_mask(
+    segment_ids: torch.Tensor, model: VisionEncoderDecoderModel, output_attentions: bool = False
+) -> torch.Tensor:
+    """
+    Builds the block-diagonal causal decoder attention mask of packed sequences.
+
+    Tokens only attend to earlier tokens of their own segment. Padding only attends to itself, so
+    no row is fully masked. The format follows the attention path the decoder takes: a boolean
+    mask for SDPA, a 1/0 mask in the model's dtype otherwise (the decoder inverts it).
+
+    Args:
+        segment_ids (torch.Tensor): Segment of each decoder input token (batch, length), 0 for padding.
+        model (VisionEncoderDecoderModel): The model the mask is passed to as `decoder_attention_mask`.
+        output_attentions (bool): Whether the forward returns attentions (which disables SDPA).
+
+    Returns:
+        torch.Tensor: Mask of shape (batch, 1, length, length).
+    """
+    attn_implementation = model.config.decoder._attn_implementation
+    if attn_implementation == "flash_attention_2":
+        raise ValueError("Sequence packing needs a 4D attention mask, which flash_attention_2 does not support")
+
+    length = segment_ids.shape[1]
+    causal = torch.ones(length, length, dtype=torch.bool, device=segment_ids.device).tril()
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+    mask = same_segment & causal & (segment_ids[:, None, :] != 0)
+    mask |= torch.eye(length, dtype=torch.bool, device=segment_ids.device)
+    mask = mask[:, None]
+
+    if attn_implementation == "sdpa" and not output_attentions:
+        return mask
+    return mask.to(model.dtype)
+
+
+class SegmentPositions:
+    """
+    Replaces the decoder's position embeddings with per-segment positions of packed sequences.
+
+    MBart's learned position embedding only counts up from 0 over the whole sequence, so a forward
+    hook on it looks up the embeddings of the given `position_ids` instead. Without position ids
+    (e.g. during generation) the embedding is left unchanged.
+
+    Args:
+        model (VisionEncoderDecoderModel): Donut model whose decoder positions are replaced.
+    """
+
+    def __init__(self, model: VisionEncoderDecoderModel):
+        self.position_ids: Optional[torch.Tensor] = None
+        embed_positions = model.decoder.model.decoder.embed_positions
+        self._handle = embed_positions.register_forward_hook(self._hook)
+
+    def _hook(self, module: nn.Module, args, output):
+        if self.position_ids is None:
+            return None
+        return F.embedding(self.position_ids + module.offset, module.weight)
+
+    def set(self, position_ids: torch.Tensor):
+        """Sets the position ids (batch, length) of the next forward passes."""
+        self.position_ids = position_ids
+
+    def clear(self):
+        """Restores the default positions (call after each step, before validation)."""
+        self.position_ids = None
+
+    def remove(self):
+        """Removes the hook."""
+        self._handle.remove()
+        self.clear()
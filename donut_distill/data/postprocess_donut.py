@@ -1,8 +1,290 @@
-from typing import Dict, List, Union
+import re
+from typing import Any, Dict, List, Sequence, Set, Tuple, Union
+import torch
 from transformers import (
     DonutProcessor,
 )
 
+# Structural tokens of the Donut output format: <s_key>, </s_key> and <sep/>.
+# Keys end at the first ">" and can't span lines, like in `DonutProcessor.token2json`. Keys with a "<"
+# are left as text, which sends the sequence to the fallback (token2json's key regex would span tokens).
+STRUCTURE_TOKEN_PATTERN = re.compile(r"<s_([^<>\n]*)>|</s_([^<>\n]*)>|<sep/>")
+SEP_TOKEN = "<sep/>"
+
+# Item types produced by the tokenizers of the fast parser
+OPEN, CLOSE, SEP, TEXT = range(4)
+
+
+class MalformedSequenceError(ValueError):
+    """
+    Raised by the fast parser for sequences it can't parse exactly like `DonutProcessor.token2json`
+    (unbalanced or mismatched tags, a key nested in itself, ...). Callers fall back to `token2json`.
+    """
+
+
+class _ParserVocab:
+    """
+    Token information needed by the fast parser, cached per tokenizer.
+    """
+
+    def __init__(self, processor: DonutProcessor):
+        tokenizer = processor.tokenizer
+        self.added_vocab: Set[str] = set(tokenizer.get_added_vocab().keys())
+        self.structure_ids: Dict[int, Tuple[int, str]] = {}
+        for token in self.added_vocab:
+            match = STRUCTURE_TOKEN_PATTERN.fullmatch(token)
+            if match is None:
+                continue
+            open_key, close_key = match.groups()
+            if open_key is not None:
+                item = (OPEN, open_key)
+            elif close_key is not None:
+                item = (CLOSE, close_key)
+            else:
+                item = (SEP, SEP_TOKEN)
+            self.structure_ids[tokenizer.convert_tokens_to_ids(token)] = item
+        # EOS and PAD are removed before parsing, like the postprocessing functions do for strings
+        self.skip_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id}
+
+
+_parser_vocab_cache: Dict[int, Tuple[int, _ParserVocab]] = {}
+
+
+def _get_parser_vocab(processor: DonutProcessor) -> _ParserVocab:
+    # Invalidate the cache entry when tokens were added to the tokenizer
+    key = id(processor.tokenizer)
+    vocab_size = len(processor.tokenizer)
+    cached = _parser_vocab_cache.get(key)
+    if cached is None or cached[0] != vocab_size:
+        cached = (vocab_size, _ParserVocab(processor))
+        _parser_vocab_cache[key] = cached
+    return cached[1]
+
+
+def _tokenize_string(tokens: str) -> List[Tuple[int, str]]:
+    """
+    Splits a decoded sequence into (item type, value) items. The value is the key for
+    opening/closing tokens and the raw text otherwise.
+    """
+    parts = STRUCTURE_TOKEN_PATTERN.split(tokens)
+    items = []
+    if parts[0]:
+        items.append((TEXT, parts[0]))
+    # `split` returns [text, open key, close key, text, open key, close key, text, ...]
+    for idx in range(1, len(parts), 3):
+        open_key, close_key, text = parts[idx], parts[idx + 1], parts[idx + 2]
+        if open_key is not None:
+            items.append((OPEN, open_key))
+        elif close_key is not None:
+            items.append((CLOSE, close_key))
+        else:
+            items.append((SEP, SEP_TOKEN))
+        if text:
+            items.append((TEXT, text))
+    return items
+
+
+def _tokenize_ids(token_ids: Sequence[int], processor: DonutProcessor, vocab: _ParserVocab) -> List[Tuple[int, str]]:
+    """
+    Splits a token id sequence into (item type, value) items.
+    Only the text between structural tokens is decoded.
+    """
+    items = []
+    text_ids: List[int] = []
+    for token_id in token_ids:
+        if token_id in vocab.skip_ids:
+            continue
+        item = vocab.structure_ids.get(token_id)
+        if item is None:
+            text_ids.append(token_id)
+            continue
+        if text_ids:
+            items += _tokenize_string(processor.tokenizer.decode(text_ids))
+            text_ids = []
+        items.append(item)
+    if text_ids:
+        items += _tokenize_string(processor.tokenizer.decode(text_ids))
+    return items
+
+
+class _Node:
+    __slots__ = ("key", "groups", "current", "has_child", "last_was_element", "split", "raw_parts")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.groups: List[dict] = []  # Dicts separated by <sep/> directly after a child element
+        self.current: Dict[str, Any] = {}
+        self.has_child = False
+        self.last_was_element = False
+        self.split = False
+        self.raw_parts: List[str] = []  # Raw content, used if the node turns out to be a leaf
+
+    def finished_groups(self) -> List[dict]:
+        # Only the last group can be empty (e.g. a trailing <sep/>)
+        return [group for group in self.groups + [self.current] if group]
+
+
+def _leaf_value(content: str, added_vocab: Set[str]) -> Union[str, List[str]]:
+    leaves = []
+    for leaf in content.strip().split(SEP_TOKEN):
+        leaf = leaf.strip()
+        if leaf in added_vocab and leaf[0] == "<" and leaf[-2:] == "/>":
+            leaf = leaf[1:-2]  # for categorical special tokens
+        leaves.append(leaf)
+    return leaves[0] if len(leaves) == 1 else leaves
+
+
+def _check_text(text: str):
+    if "s_" in text and ("<s_" in text.lower() or "</s_" in text.lower()):
+        raise MalformedSequenceError("Text contains an incomplete structure token")
+
+
+def _parse_items(items: List[Tuple[int, str]], added_vocab: Set[str]) -> Union[dict, list]:
+    """
+    Single-pass, stack-based equivalent of `DonutProcessor.token2json` for well-formed sequences.
+
+    Raises:
+        MalformedSequenceError: If the result could differ from `token2json`.
+    """
+    # Opening tokens without a matching closing token further on (e.g. the task start token
+    # <s_docvqa>) are dropped by token2json
+    unclosed = [False] * len(items)
+    closed_keys: Set[str] = set()
+    for idx in range(len(items) - 1, -1, -1):
+        item_type, value = items[idx]
+        if item_type == CLOSE:
+            closed_keys.add(value)
+        elif item_type == OPEN:
+            unclosed[idx] = value not in closed_keys
+
+    root = _Node(key="")
+    stack = [root]
+    node = root
+    open_keys: Set[str] = set()
+
+    idx = 0
+    num_items = len(items)
+    while idx < num_items:
+        item_type, value = items[idx]
+        idx += 1
+
+        if item_type == TEXT:
+            _check_text(value)
+            node.raw_parts.append(value)
+            if value.strip():
+                node.last_was_element = False
+            continue
+
+        if item_type == SEP:
+            node.raw_parts.append(value)
+            if node.last_was_element:
+                # <sep/> right after a child element starts a new dict in the list
+                node.groups.append(node.current)
+                node.current = {}
+                node.split = True
+            node.last_was_element = False
+            continue
+
+        if item_type == OPEN:
+            if unclosed[idx - 1]:
+                # token2json removes every occurrence of an unclosed opening token from the sequence, so
+                # it only doesn't matter before the first element (a <sep/> after it would start a list)
+                if len(stack) > 1 or root.has_child:
+                    raise MalformedSequenceError(f"Key {value} is never closed")
+                node.last_was_element = False
+                continue
+            if value in open_keys:
+                raise MalformedSequenceError(f"Key {value} is nested in itself")
+
+            # Shortcut for the common <s_key>text</s_key> leaf
+            if idx + 1 < num_items and items[idx][0] == TEXT and items[idx + 1] == (CLOSE, value):
+                _check_text(items[idx][1])
+                node.current[value] = _leaf_value(items[idx][1], added_vocab)
+                node.has_child = True
+                node.last_was_element = True
+                idx += 2
+                continue
+
+            open_keys.add(value)
+            node = _Node(value)
+            stack.append(node)
+            continue
+
+        # Closing token
+        if len(stack) == 1 or node.key != value:
+            raise MalformedSequenceError(f"Unexpected closing token for key {value}")
+        stack.pop()
+        open_keys.discard(value)
+        parent = stack[-1]
+
+        if node.has_child:  # non-leaf node
+            groups = node.finished_groups()
+            if groups:
+                parent.current[value] = groups[0] if len(groups) == 1 else groups
+        else:  # leaf node
+            parent.current[value] = _leaf_value("".join(node.raw_parts), added_vocab)
+
+        parent.has_child = True
+        parent.last_was_element = True
+        node = parent
+
+    if len(stack) != 1:
+        raise MalformedSequenceError(f"Key {stack[-1].key} is never closed")
+    if not root.has_child:
+        # token2json returns the raw text here, which is only known for string inputs
+        raise MalformedSequenceError("Sequence contains no structure")
+
+    groups = root.finished_groups()
+    return groups if root.split else groups[0]
+
+
+def token2json(tokens: str, processor: DonutProcessor) -> Union[dict, list]:
+    """
+    Fast replacement for `processor.token2json`.
+
+    The sequence is parsed in a single pass with a stack instead of repeated regex searches
+    and recursion. Sequences the fast parser can't handle exactly like `token2json`
+    (malformed or without any structure) are passed on to `processor.token2json`.
+
+    Args:
+        tokens (str): Decoded token sequence.
+        processor (DonutProcessor): Processor of the model that generated the sequence.
+
+    Returns:
+        dict | list: The same JSON as `processor.token2json(tokens)`.
+    """
+    vocab = _get_parser_vocab(processor)
+    try:
+        return _parse_items(_tokenize_string(tokens), vocab.added_vocab)
+    except MalformedSequenceError:
+        return processor.token2json(tokens)
+
+
+def token2json_from_ids(token_ids: Union[Sequence[int], torch.Tensor], processor: DonutProcessor) -> Union[dict, list]:
+    """
+    Parses a generated token id sequence without decoding it to a string first.
+
+    Structural tokens are looked up by id, only the text between them is decoded. EOS and PAD
+    are ignored. The result equals `token2json` of the decoded sequence (the tokenizer may add
+    whitespace around special tokens when decoding, which `token2json` strips anyway).
+
+    Args:
+        token_ids (Sequence[int] | torch.Tensor): Token ids, e.g. one row of `outputs.sequences`.
+        processor (DonutProcessor): Processor of the model that generated the sequence.
+
+    Returns:
+        dict | list: The parsed JSON.
+    """
+    if isinstance(token_ids, torch.Tensor):
+        token_ids = token_ids.tolist()
+
+    vocab = _get_parser_vocab(processor)
+    try:
+        return _parse_items(_tokenize_ids(token_ids, processor, vocab), vocab.added_vocab)
+    except MalformedSequenceError:
+        tokens = processor.tokenizer.decode([token_id for token_id in token_ids if token_id not in vocab.skip_ids])
+        return processor.token2json(tokens)
+
 
 def postprocess_donut_funsd(
     outputs: Union[str, dict, list], processor: DonutProcessor, verbose: bool = False
@@ -16,7 +298,7 @@ def postprocess_donut_funsd(
     - Returns a structured list of extracted entities.
 
     Args:
-        outputs (str | dict | list): Model output, which can be a string, dictionary, or list.
+        outputs (str | torch.Tensor | dict | list): Model output, which can be a string, generated token ids, dictionary, or list.
         processor (DonutProcessor): Tokenizer processor used to decode model outputs.
         verbose (bool, optional): If True, prints intermediate JSON outputs. Default is False.
 
@@ -26,13 +308,20 @@ def postprocess_donut_funsd(
     """
     result = []
 
-    if isinstance(outputs, str):
+    if isinstance(outputs, torch.Tensor):
+        # Generated token ids are parsed without decoding the whole sequence
+        outputs = token2json_from_ids(outputs, processor)
+
+        if verbose:
+            print(outputs)
+
+    elif isinstance(outputs, str):
         # Remove special tokens (EOS and PAD)
         outputs = outputs.replace(processor.tokenizer.eos_token, "").replace(
             processor.tokenizer.pad_token, ""
         )
         # Convert tokenized output into JSON format
-        outputs = processor.token2json(outputs)
+        outputs = token2json(outputs, processor)
 
         if verbose:
             print(outputs)
@@ -63,7 +352,7 @@ def postprocess_donut_funsd(
 
 
 def postprocess_donut_docvqa(
-    outputs: str, processor: DonutProcessor, verbose: bool = False
+    outputs: Union[str, torch.Tensor], processor: DonutProcessor, verbose: bool = False
 ) -> str:
     """
     Postprocess the output of the Donut model for the DocVQA (Document Visual Question Answering) task.
@@ -74,22 +363,28 @@ def postprocess_donut_docvqa(
     - Extracts and returns the answer field in lowercase.
 
     Args:
-        outputs (str): The raw model output as a tokenized string.
+        outputs (str | torch.Tensor): The raw model output as a tokenized string or as generated token ids.
         processor (DonutProcessor): Tokenizer processor used for decoding.
         verbose (bool, optional): If True, prints intermediate processing steps. Default is False.
 
     Returns:
         str: The extracted answer in lowercase, or an empty string if not found.
     """
-    # Remove special tokens (EOS and PAD)
-    outputs = outputs.replace(processor.tokenizer.eos_token, "").replace(
-        processor.tokenizer.pad_token, ""
-    )
+    if isinstance(outputs, torch.Tensor):
+        # Generated token ids are parsed without decoding the whole sequence
+        outputs_json: Dict[str, str] = token2json_from_ids(outputs, processor)
+    else:
+        # Remove special tokens (EOS and PAD)
+        outputs = outputs.replace(processor.tokenizer.eos_token, "").replace(
+            processor.tokenizer.pad_token, ""
+        )
+
+        # Convert tokenized output to JSON format
+        outputs_json: Dict[str, str] = token2json(outputs, processor)
 
-    # Convert tokenized output to JSON format
-    outputs_json: Dict[str, str] = processor.token2json(outputs)
-    
     if verbose:
+        if isinstance(outputs, torch.Tensor):
+            outputs = processor.tokenizer.decode(outputs)
         print("Unprocessed:", outputs)
         print("Json:", outputs_json)
 
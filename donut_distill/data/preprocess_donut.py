@@ -1,10 +1,17 @@
+import io
 import json
+import os
 from os import listdir, path
 from pathlib import Path
 import shutil
+import tarfile
 from tqdm import tqdm
 from datasets import DatasetDict, load_dataset
-from typing import Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Union
+from donut_distill.data.donut_dataset import json2token
+
+# Index of a sharded split (see `write_shards` and `DonutIterableDataset`)
+SHARD_INDEX_FILE = "index.json"
 
 def preprocess_annotations_links_funsd(annotation_path: str) -> Dict[str, List[Dict[str, Union[str, List[str]]]]]:
     """
@@ -200,6 +207,10 @@ def preprocess_docvqa(
     - Organizes images and metadata into structured output directories.
     - Copies relevant images to the output location.
 
+    The image folder loader keeps only one row per file name, so every question gets its own image
+    file (a hard link to the page image where possible) and the page is stored in the "page" column
+    (used to pack the questions of a page, see `PackedDonutDataset`).
+
     Args:
         annotations_path (str): Path to the directory containing JSON annotation files.
         images_path (str): Path to the directory containing images.
@@ -245,6 +256,8 @@ def preprocess_docvqa(
         for datapoint in tqdm(data, desc=f"Processing {dataset_split} set"):
             image_path = path.join(images_path, datapoint["image"])
             image_name = path.basename(image_path)
+            image_stem, image_extension = path.splitext(image_name)
+            question_image_name = f"{image_stem}_{datapoint['questionId']}{image_extension}"
 
             question = datapoint["question"]
             answers = datapoint["answers"]
@@ -254,19 +267,100 @@ def preprocess_docvqa(
 
             # Store metadata for this sample
             file_metadata = {
-                "file_name": image_name,
+                "file_name": question_image_name,
+                "page": image_name,
                 "ground_truth": json.dumps({"gt_parses": gt_parses}),
             }
 
             metadata_file.write(json.dumps(file_metadata) + "\n")  # Write to metadata file
 
-            # Copy the corresponding image to the output directory
-            shutil.copy(image_path, output_directory)
+            # Link (or copy) the corresponding image to the output directory
+            question_image_path = path.join(output_directory, question_image_name)
+            if not path.exists(question_image_path):
+                try:
+                    os.link(image_path, question_image_path)
+                except OSError:
+                    shutil.copy(image_path, question_image_path)
 
         # Close the metadata file after processing all samples
         metadata_file.close()
 
 
+def _add_tar_member(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(
+    dataset_path: str,
+    output_path: str,
+    split: str = "train",
+    samples_per_shard: int = 1000,
+) -> Dict[str, Any]:
+    """
+    Writes a preprocessed split (images + metadata.jsonl) as sequential tar shards for `DonutIterableDataset`.
+
+    This function:
+    - Reads the metadata of the split line by line (nothing is indexed up front).
+    - Stores every sample as two consecutive tar members, `<key>.json` (the metadata row) and
+      `<key><image extension>` (the image bytes), so a shard can be read as a stream.
+    - Starts a new shard every `samples_per_shard` samples.
+    - Writes an index with the shards, their sample counts and the JSON keys of the ground truths
+      (so their <s_key>/</s_key> tokens can be added without reading the shards).
+
+    Args:
+        dataset_path (str): Preprocessed dataset with one directory (images + metadata.jsonl) per split.
+        output_path (str): Output directory, the shards are written to `output_path/split`.
+        split (str): Split to convert.
+        samples_per_shard (int): Number of samples per shard.
+
+    Returns:
+        Dict[str, Any]: The index (also written to `SHARD_INDEX_FILE`).
+    """
+    split_directory = path.join(dataset_path, split)
+    output_directory = path.join(output_path, split)
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    json_keys = set()
+    tar = None
+    with open(path.join(split_directory, "metadata.jsonl"), "r") as metadata_file:
+        for sample_idx, line in enumerate(tqdm(metadata_file, desc=f"Writing {split} shards")):
+            if sample_idx % samples_per_shard == 0:
+                # Start a new shard
+                if tar is not None:
+                    tar.close()
+                shard_name = f"shard-{len(shards):05d}.tar"
+                tar = tarfile.open(path.join(output_directory, shard_name), "w")
+                shards.append({"path": shard_name, "num_samples": 0})
+
+            metadata = json.loads(line)
+            ground_truth = json.loads(metadata["ground_truth"])
+            for gt_json in ground_truth.get("gt_parses", [ground_truth.get("gt_parse")]):
+                json2token(gt_json, on_json_key=json_keys.add)
+
+            key = f"{sample_idx:09d}"
+            image_name = metadata.pop("file_name")
+            with open(path.join(split_directory, image_name), "rb") as image_file:
+                image_bytes = image_file.read()
+            _add_tar_member(tar, f"{key}.json", json.dumps(metadata).encode("utf-8"))
+            _add_tar_member(tar, f"{key}{path.splitext(image_name)[1].lower()}", image_bytes)
+            shards[-1]["num_samples"] += 1
+
+    if tar is not None:
+        tar.close()
+
+    index = {
+        "shards": shards,
+        "num_samples": sum(shard["num_samples"] for shard in shards),
+        "json_keys": sorted(json_keys),
+    }
+    with open(path.join(output_directory, SHARD_INDEX_FILE), "w") as index_file:
+        json.dump(index, index_file, indent=2)
+    return index
+
+
 if __name__ == "__main__":
     # test_directory = "dataset/testing_data"
     # train_directory = "dataset/training_data"
@@ -282,5 +376,7 @@ if __name__ == "__main__":
 
     preprocess_docvqa("docvqa/queries", "docvqa", "preprocessed_dataset_docvqa_small", 50, 10)
 
+    # write_shards("preprocessed_dataset_docvqa", "sharded_dataset_docvqa", "train")
+
     # create_subset("preprocessed_dataset_docvqa", "preprocessed_dataset_docvqa_small", 50, 10)
 
@@ -0,0 +1,290 @@
+import io
+import json
+import math
+import random
+import tarfile
+from os import path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import DonutProcessor, VisionEncoderDecoderModel
+from donut_distill.data.donut_dataset import (
+    SpecialTokenRegistry,
+    default_registry,
+    json2token,
+    mask_labels,
+    register_tokens,
+)
+from donut_distill.data.preprocess_donut import SHARD_INDEX_FILE
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def read_shard(shard_path: str) -> Iterator[Tuple[bytes, Dict[str, Any]]]:
+    """
+    Reads the samples of a shard written by `write_shards` sequentially.
+
+    Yields:
+        Tuple[bytes, Dict[str, Any]]: Image bytes and metadata row of each sample.
+    """
+    sample_key, image_bytes, metadata = None, None, None
+    with tarfile.open(shard_path, "r|") as tar:
+        for member in tar:
+            key, extension = path.splitext(member.name)
+            if key != sample_key:
+                sample_key, image_bytes, metadata = key, None, None
+            data = tar.extractfile(member).read()
+            if extension == ".json":
+                metadata = json.loads(data)
+            elif extension in IMAGE_EXTENSIONS:
+                image_bytes = data
+            if image_bytes is not None and metadata is not None:
+                yield image_bytes, metadata
+                sample_key, image_bytes, metadata = None, None, None
+
+
+def shuffle_buffer(samples: Iterator, buffer_size: int, rng: random.Random) -> Iterator:
+    """
+    Shuffles a stream with a buffer: each sample is swapped with a random one of the last `buffer_size`.
+    """
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        idx = rng.randrange(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def consumed_samples_per_worker(
+    samples_per_worker: List[int], num_batches: int, batch_size: int, drop_last: bool = False
+) -> Tuple[List[int], int]:
+    """
+    Computes how many samples each worker contributed to the first `num_batches` batches.
+
+    A DataLoader over an IterableDataset takes its batches from the workers in turn and skips
+    exhausted workers, so the split is determined by the number of samples of each worker.
+
+    Args:
+        samples_per_worker (List[int]): Number of samples each worker yields in the epoch.
+        num_batches (int): Number of batches consumed.
+        batch_size (int): Batch size of the DataLoader.
+        drop_last (bool): Whether the DataLoader drops incomplete batches.
+
+    Returns:
+        Tuple[List[int], int]: Consumed samples per worker and the worker of the next batch.
+    """
+    round_up = math.floor if drop_last else math.ceil
+    batches_per_worker = [round_up(num_samples / batch_size) for num_samples in samples_per_worker]
+    consumed_batches = [0] * len(samples_per_worker)
+    worker_id = 0
+    while num_batches > 0 and consumed_batches != batches_per_worker:
+        if consumed_batches[worker_id] < batches_per_worker[worker_id]:
+            consumed_batches[worker_id] += 1
+            num_batches -= 1
+        worker_id = (worker_id + 1) % len(samples_per_worker)
+    consumed_samples = [
+        min(batches * batch_size, num_samples)
+        for batches, num_samples in zip(consumed_batches, samples_per_worker)
+    ]
+    return consumed_samples, worker_id
+
+
+class DonutIterableDataset(IterableDataset):
+    """
+    Streaming training dataset for Donut, reading the tar shards written by `write_shards`.
+
+    In contrast to `DonutDataset`, nothing but the shard index is loaded up front, so corpora that
+    don't fit an image folder index can be used. Samples are produced like by `DonutDataset` in
+    training (pixel_values, input_ids, labels).
+
+    - The shard order is shuffled per epoch (`set_epoch`), then the shards are split between the
+      DataLoader workers (each worker reads `shards[worker_id::num_workers]`).
+    - Each worker shuffles its stream with a buffer of `shuffle_buffer` samples.
+    - Everything is seeded by (seed, epoch, worker), so an epoch can be resumed after a given number
+      of batches (`state_dict` / `load_state_dict`): the consumed samples are skipped before decoding,
+      and the worker streams are rotated so the DataLoader continues with the same batch order.
+
+    Use more shards than workers, workers without shards yield nothing.
+
+    Args:
+        processor (DonutProcessor): Processor to handle images and tokenization.
+        model (VisionEncoderDecoderModel): Model whose tokenizer may be extended.
+        shard_dir (str): Directory with the shards and their index of a split.
+        max_length (int): Maximum number of tokens for target sequences.
+        ignore_id (int): Token ID to be ignored in loss computation (default: -100).
+        task_start_token (str): Special token indicating the start of the task.
+        prompt_end_token (str, optional): Token marking the end of the prompt (defaults to task_start_token).
+        sort_json_key (bool): Whether to sort JSON keys before tokenization.
+        shuffle (bool): Whether to shuffle the shards and samples.
+        shuffle_buffer (int): Size of the shuffle buffer of each worker.
+        seed (int): Seed of the shuffling and the target sequence selection.
+        registry (SpecialTokenRegistry, optional): Registry of the special tokens, defaults to `default_registry`.
+    """
+
+    def __init__(
+        self,
+        processor: DonutProcessor,
+        model: VisionEncoderDecoderModel,
+        shard_dir: str,
+        max_length: int,
+        ignore_id: int = -100,
+        task_start_token: str = "<s>",
+        prompt_end_token: str = None,
+        sort_json_key: bool = True,
+        shuffle: bool = True,
+        shuffle_buffer: int = 1000,
+        seed: int = 42,
+        registry: Optional[SpecialTokenRegistry] = None,
+    ):
+        super().__init__()
+
+        self.processor = processor
+        self.model = model
+        self.shard_dir = shard_dir
+        self.max_length = max_length
+        self.ignore_id = ignore_id
+        self.task_start_token = task_start_token
+        self.prompt_end_token = prompt_end_token if prompt_end_token else task_start_token
+        self.sort_json_key = sort_json_key
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.resume_state: Optional[Dict[str, int]] = None
+        # Kept as an attribute, so DataLoader workers get the registry with the dataset
+        self.registry = default_registry if registry is None else registry
+
+        with open(path.join(shard_dir, SHARD_INDEX_FILE), "r") as f:
+            self.index = json.load(f)
+
+        # Add the JSON key tokens from the index (instead of scanning all ground truths) and start/prompt end
+        for key in self.index["json_keys"]:
+            register_tokens(self.processor, self.model, [rf"<s_{key}>", rf"</s_{key}>"], self.registry)
+        register_tokens(self.processor, self.model, [self.task_start_token, self.prompt_end_token], self.registry)
+        self.prompt_end_token_id = self.processor.tokenizer.convert_tokens_to_ids(self.prompt_end_token)
+
+    def __len__(self) -> int:
+        """
+        Return the total number of samples in the dataset.
+
+        With several DataLoader workers, `len(DataLoader)` underestimates the number of batches (every
+        worker ends with its own incomplete batch), use `num_batches` for that.
+        """
+        return self.index["num_samples"]
+
+    def num_batches(self, batch_size: int, num_workers: int = 0, drop_last: bool = False) -> int:
+        """
+        Number of batches a DataLoader gets from the current epoch.
+
+        Each worker batches its own shards, so the count depends on the samples per worker, which
+        changes with the shard order of the epoch (by up to `num_workers - 1` batches).
+
+        Args:
+            batch_size (int): Batch size of the DataLoader.
+            num_workers (int): Number of DataLoader workers (0 reads in the main process).
+            drop_last (bool): Whether the DataLoader drops incomplete batches.
+
+        Returns:
+            int: Number of batches of the epoch.
+        """
+        round_up = math.floor if drop_last else math.ceil
+        samples_per_worker = self._samples_per_worker(self._epoch_shards(), max(1, num_workers))
+        return sum(round_up(num_samples / batch_size) for num_samples in samples_per_worker)
+
+    def set_epoch(self, epoch: int):
+        """
+        Sets the epoch, which seeds the shard order and the shuffle buffers. A resume state of another epoch is dropped.
+        """
+        self.epoch = epoch
+        if self.resume_state is not None and self.resume_state["epoch"] != epoch:
+            self.resume_state = None
+
+    def state_dict(self, num_batches: int, batch_size: int) -> Dict[str, int]:
+        """
+        Returns the position in the current epoch after `num_batches` batches.
+        """
+        return {"epoch": self.epoch, "seed": self.seed, "num_batches": num_batches, "batch_size": batch_size}
+
+    def load_state_dict(self, state: Dict[str, int]):
+        """
+        Resumes from a position of `state_dict`: the next iteration continues its epoch after its batches.
+        The DataLoader has to use the same number of workers and batch size as before.
+        """
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.resume_state = dict(state)
+
+    def _epoch_shards(self) -> List[Dict[str, Any]]:
+        shards = list(self.index["shards"])
+        if self.shuffle:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(shards)
+        return shards
+
+    @staticmethod
+    def _samples_per_worker(epoch_shards: List[Dict[str, Any]], num_workers: int) -> List[int]:
+        return [sum(shard["num_samples"] for shard in epoch_shards[idx::num_workers]) for idx in range(num_workers)]
+
+    def __iter__(self):
+        """
+        Iterates over the samples of this worker's shards.
+
+        Yields:
+            - pixel_values (Tensor): Preprocessed image.
+            - input_ids (Tensor): Tokenized ground truth sequence.
+            - labels (Tensor): Masked labels for loss computation.
+        """
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info else (1, 0)
+        epoch_shards = self._epoch_shards()
+
+        num_skip = 0
+        if self.resume_state is not None and self.resume_state["epoch"] == self.epoch:
+            # The DataLoader starts with worker 0 again, so worker 0 takes over the stream of the worker
+            # whose batch came next and every worker skips the samples its stream contributed before
+            samples_per_worker = self._samples_per_worker(epoch_shards, num_workers)
+            consumed_samples, next_worker = consumed_samples_per_worker(
+                samples_per_worker, self.resume_state["num_batches"], self.resume_state["batch_size"]
+            )
+            worker_id = (worker_id + next_worker) % num_workers
+            num_skip = consumed_samples[worker_id]
+
+        shards = epoch_shards[worker_id::num_workers]
+        rng = random.Random(f"{self.seed}-{self.epoch}-{worker_id}")
+
+        samples = (sample for shard in shards for sample in read_shard(path.join(self.shard_dir, shard["path"])))
+        if self.shuffle:
+            samples = shuffle_buffer(samples, self.shuffle_buffer, rng)
+
+        for sample_idx, (image_bytes, metadata) in enumerate(samples):
+            # Draw the target sequence for skipped samples too, so the rng stays in sync
+            ground_truth = json.loads(metadata["ground_truth"])
+            gt_jsons = ground_truth["gt_parses"] if "gt_parses" in ground_truth else [ground_truth["gt_parse"]]
+            gt_json = rng.choice(gt_jsons)
+            if sample_idx < num_skip:
+                continue
+            yield self._encode(image_bytes, gt_json)
+
+    def _encode(self, image_bytes: bytes, gt_json: Dict[str, Any]):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        pixel_values = self.processor(image, random_padding=True, return_tensors="pt").pixel_values.squeeze()
+
+        target_sequence = (
+            json2token(gt_json, sort_json_key=self.sort_json_key, registry=self.registry)
+            + self.processor.tokenizer.eos_token
+        )
+        input_ids = self.processor.tokenizer(
+            target_sequence,
+            add_special_tokens=False,
+            max_length=self.max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt",
+        )["input_ids"].squeeze(0)
+
+        # Mask labels: ignore padding and prompt tokens
+        labels = mask_labels(input_ids, self.processor.tokenizer.pad_token_id, self.prompt_end_token_id, self.ignore_id)
+        return pixel_values, input_ids, labels
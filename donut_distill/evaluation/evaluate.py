@@ -1,4 +1,4 @@
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -8,33 +8,83 @@ from transformers import (
 )
 from torch.nn.utils.rnn import pad_sequence
 import donut_distill.config.config as CONFIG
-from donut_distill.evaluation.metrics import calculate_metrics_docvqa, calculate_metrics_funsd
-from transformers import GenerationConfig
+from donut_distill.evaluation.prediction_cache import PredictionCache
+from donut_distill.evaluation.metrics import FunsdMetricAccumulator, calculate_metrics_docvqa_batch, calculate_metrics_funsd
+from transformers import GenerationConfig, LogitsProcessorList
 from donut_distill.data.postprocess_donut import postprocess_donut_docvqa, postprocess_donut_funsd
+from donut_distill.models.generation import DonutStructureLogitsProcessor, generate_with_early_exit
+from donut_distill.models.student import scale_pixel_values
 import numpy as np
 
 
-def evaluate_docvqa(
+def count_decode_steps(generated_ids: torch.Tensor, pad_token_id: int) -> torch.Tensor:
+    """
+    Counts the generated (non-padding) tokens of each sequence, excluding the prompt.
+    """
+    return (generated_ids != pad_token_id).sum(dim=-1)
+
+
+def prepare_logits_processor(processor: DonutProcessor) -> LogitsProcessorList:
+    """
+    Returns the logits processors used for generation during evaluation.
+    """
+    logits_processor = LogitsProcessorList()
+    if CONFIG.CONSTRAINED_DECODING:
+        logits_processor.append(DonutStructureLogitsProcessor(processor))
+    return logits_processor
+
+
+def use_early_exit(model: VisionEncoderDecoderModel, generation_config: Optional[GenerationConfig]) -> bool:
+    """
+    Returns True if DocVQA sequences are stopped once the answer is complete (greedy PyTorch generation only).
+    """
+    return (
+        CONFIG.EARLY_EXIT_ON_ANSWER
+        and isinstance(model, VisionEncoderDecoderModel)
+        and (generation_config is None or (generation_config.num_beams == 1 and not generation_config.do_sample))
+    )
+
+
+def generate_docvqa_predictions(
     model: VisionEncoderDecoderModel,
     processor: DonutProcessor,
     device: torch.device,
     val_dataloader: DataLoader,
     generation_config: Optional[GenerationConfig],
-):
-    val_metrics = {"exact_match": [], "anls": []}
+    limit_batches: Optional[int] = None,
+    input_scale: float = 1.0,
+) -> Dict[str, list]:
+    """
+    Generates and postprocesses the answers for the DocVQA validation samples.
+
+    Args:
+        model (VisionEncoderDecoderModel): The model to evaluate.
+        processor (DonutProcessor): The processor of the model.
+        device (torch.device): Device for the inputs.
+        val_dataloader (DataLoader): Validation dataloader.
+        generation_config (GenerationConfig, optional): Generation settings.
+        limit_batches (int, optional): Only use the first `limit_batches` batches.
+        input_scale (float): Resize the images for a student with reduced input resolution (see `create_student_reduced_resolution`).
+
+    Returns:
+        Dict[str, list]: Per sample "predictions", "ground_truths", "prompts" and "decode_steps".
+    """
+    val_outputs = {"predictions": [], "ground_truths": [], "prompts": [], "decode_steps": []}
 
     model.eval()
+    logits_processor = prepare_logits_processor(processor)
 
-    num_val_batches = len(val_dataloader)
+    # Stop each sequence once the answer is complete, the rest of the output is discarded by postprocessing
+    early_exit = use_early_exit(model, generation_config)
+    answer_end_token_id = processor.tokenizer.convert_tokens_to_ids("</s_answer>")
 
-    limit_batches = max(1, int(num_val_batches * CONFIG.LIMIT_VAL_BATCHES))
     with torch.no_grad():
         for i, batch in enumerate(tqdm(val_dataloader, desc="Validate")):
-            if i >= limit_batches:
+            if limit_batches is not None and i >= limit_batches:
                 break
 
             pixel_values, decoder_input_ids, prompt_end_idxs, answers_list = batch
-            pixel_values = pixel_values.to(device)
+            pixel_values = scale_pixel_values(pixel_values.to(device), input_scale)
 
             decoder_prompts = pad_sequence(
                 [
@@ -46,57 +96,148 @@ def evaluate_docvqa(
 
             decoded_prompts = processor.tokenizer.batch_decode(decoder_prompts)
 
-            outputs = model.generate(
-                pixel_values,
-                decoder_input_ids=decoder_prompts,
-                max_length=CONFIG.MAX_LENGTH,
-                pad_token_id=processor.tokenizer.pad_token_id,
-                eos_token_id=processor.tokenizer.eos_token_id,
-                use_cache=True,
-                bad_words_ids=[[processor.tokenizer.unk_token_id]],
-                return_dict_in_generate=True,
-                generation_config=generation_config,
-            )
+            if early_exit:
+                sequences, decode_steps = generate_with_early_exit(
+                    model,
+                    pixel_values,
+                    decoder_input_ids=decoder_prompts,
+                    stop_token_id=answer_end_token_id,
+                    max_length=CONFIG.MAX_LENGTH,
+                    pad_token_id=processor.tokenizer.pad_token_id,
+                    eos_token_id=processor.tokenizer.eos_token_id,
+                    bad_words_ids=[[processor.tokenizer.unk_token_id]],
+                    logits_processor=logits_processor,
+                )
+                val_outputs["decode_steps"].extend(decode_steps.tolist())
+            else:
+                outputs = model.generate(
+                    pixel_values,
+                    decoder_input_ids=decoder_prompts,
+                    max_length=CONFIG.MAX_LENGTH,
+                    pad_token_id=processor.tokenizer.pad_token_id,
+                    eos_token_id=processor.tokenizer.eos_token_id,
+                    use_cache=True,
+                    bad_words_ids=[[processor.tokenizer.unk_token_id]],
+                    logits_processor=logits_processor,
+                    return_dict_in_generate=True,
+                    generation_config=generation_config,
+                )
+                sequences = outputs.sequences
+                val_outputs["decode_steps"].extend(
+                    count_decode_steps(
+                        sequences[:, decoder_prompts.shape[1]:],
+                        processor.tokenizer.pad_token_id,
+                    ).tolist()
+                )
+
+            # Token ids are parsed directly, without decoding the full sequences first
+            # Ground truth answers are already parsed and normalized by the dataset
+            for pred, answer_list in zip(sequences.cpu(), answers_list):
+                val_outputs["predictions"].append(postprocess_donut_docvqa(pred, processor, verbose=CONFIG.VERBOSE))
+                val_outputs["ground_truths"].append(answer_list)
+            val_outputs["prompts"].extend(decoded_prompts)
+
+    return val_outputs
+
+
+def summarize_docvqa(val_outputs: Dict[str, list]) -> Dict[str, float]:
+    """
+    Scores the outputs of `generate_docvqa_predictions` (possibly concatenated from several workers).
+    """
+    # Score the whole validation pass at once
+    metrics = calculate_metrics_docvqa_batch(val_outputs["ground_truths"], val_outputs["predictions"])
+
+    if CONFIG.VERBOSE:
+        for idx, (pred, answer_list, prompt) in enumerate(
+            zip(val_outputs["predictions"], val_outputs["ground_truths"], val_outputs["prompts"])
+        ):
+            print(f"Prompt: {prompt}")
+            print(f"Prediction: {pred}")
+            print(f"\tAnswers: {answer_list}")
+            print(f"\texact_match: {metrics['exact_match'][idx]}")
+            print(f"\tanls: {metrics['anls'][idx]}")
+
+    results = {
+        "eval/accuracy": np.mean(metrics["exact_match"]),
+        "eval/anls": np.mean(metrics["anls"]),
+        # Compare runs with and without EARLY_EXIT_ON_ANSWER for the steps it saves
+        "eval/decode_steps": np.mean(val_outputs["decode_steps"]),
+    }
 
-            predictions = processor.tokenizer.batch_decode(outputs.sequences)
+    return results
 
-            for pred, answers, prompt in zip(predictions, answers_list, decoded_prompts):
-                answer_list = answers.split("\n")
-                answer_list = [postprocess_donut_docvqa(ans, processor) for ans in answer_list]
-                pred = postprocess_donut_docvqa(pred, processor, verbose=CONFIG.VERBOSE)
 
-                metric = calculate_metrics_docvqa(answer_list, pred)
-                val_metrics["anls"].append(metric["anls"])
-                val_metrics["exact_match"].append(float(metric["exact_match"]))
+def evaluate_docvqa(
+    model: VisionEncoderDecoderModel,
+    processor: DonutProcessor,
+    device: torch.device,
+    val_dataloader: DataLoader,
+    generation_config: Optional[GenerationConfig],
+    limit_val_batches: Optional[float] = None,
+    prediction_cache: Optional[PredictionCache] = None,
+    input_scale: float = 1.0,
+):
+    """
+    Evaluates the model on DocVQA (ANLS and exact match).
+
+    Args:
+        limit_val_batches (float, optional): Fraction of the batches to use, defaults to
+            `CONFIG.LIMIT_VAL_BATCHES`. Pass 1.0 if the dataloader already holds the subset.
+        prediction_cache (PredictionCache, optional): Reuses the outputs of an unchanged model
+            on the same fixed validation subset (see `ValidationSubset`).
+        input_scale (float): Resize the images for a student with reduced input resolution.
+    """
+    if limit_val_batches is None:
+        limit_val_batches = CONFIG.LIMIT_VAL_BATCHES
+    limit_batches = max(1, int(len(val_dataloader) * limit_val_batches))
+
+    # Only fixed subsets of the whole dataset can be cached
+    cache_key = None
+    if prediction_cache is not None and limit_batches >= len(val_dataloader):
+        dataset_key = getattr(val_dataloader.dataset, "cache_key", None)
+        if dataset_key is not None and input_scale != 1:
+            dataset_key = f"{dataset_key}-scale{input_scale}"
+        cache_key = prediction_cache.key(model, generation_config, dataset_key)
+
+    val_outputs = prediction_cache.get(cache_key) if prediction_cache is not None else None
+    if val_outputs is None:
+        val_outputs = generate_docvqa_predictions(
+            model,
+            processor,
+            device,
+            val_dataloader,
+            generation_config,
+            limit_batches=limit_batches,
+            input_scale=input_scale,
+        )
+        if prediction_cache is not None:
+            prediction_cache.put(cache_key, val_outputs)
 
-                if CONFIG.VERBOSE:
-                    print(f"Prompt: {prompt}")
-                    print(f"Prediction: {pred}")
-                    print(f"\tAnswers: {answer_list}")
-                    print(f"\texact_match: {metric['exact_match']}")
-                    print(f"\tanls: {metric['anls']}")
-
-    return {
-        "eval/accuracy": np.mean(val_metrics["exact_match"]),
-        "eval/anls": np.mean(val_metrics["anls"]),
-    }
+    return summarize_docvqa(val_outputs)
 
 
-def evaluate_funsd(
+def accumulate_funsd(
     model: VisionEncoderDecoderModel,
     processor: DonutProcessor,
     device: torch.device,
     val_dataloader: DataLoader,
     generation_config: Optional[GenerationConfig] = None,
-):
+) -> FunsdMetricAccumulator:
+    """
+    Generates the FUNSD predictions and collects their metric counts.
+    Accumulators of several workers can be merged before calling `compute()`.
+    """
     if generation_config == None:
         # Default generation config TODO:
         generation_config = GenerationConfig(early_stopping=True, num_beams=1)
 
-    val_metrics = {"f1": [], "recall": [], "precision": []}
+    val_metrics = FunsdMetricAccumulator(
+        fuzzy_threshold=CONFIG.FUZZY_MATCH_THRESHOLD, fuzzy_assignment=CONFIG.FUZZY_MATCH_ASSIGNMENT
+    )
     # num_samples = len(val_dataloader.dataset) // 3
 
     model.eval()
+    logits_processor = prepare_logits_processor(processor)
     with torch.no_grad():
         for batch in tqdm(val_dataloader, desc="Validate"):
             # for batch in tqdm(itertools.islice(val_dataloader, num_samples // val_dataloader.batch_size), desc="Validate"): #TODO: REMOVE
@@ -119,38 +260,41 @@ def evaluate_funsd(
                 eos_token_id=processor.tokenizer.eos_token_id,
                 use_cache=True,
                 bad_words_ids=[[processor.tokenizer.unk_token_id]],
+                logits_processor=logits_processor,
                 return_dict_in_generate=True,
                 generation_config=generation_config,
             )
 
-            predictions = processor.tokenizer.batch_decode(outputs.sequences)
-
-            for pred, answer in zip(predictions, answers):
-                answer = postprocess_donut_funsd(answer, processor)
+            # Ground truth entities are already parsed by the dataset
+            for pred, answer in zip(outputs.sequences.cpu(), answers):
                 if CONFIG.VERBOSE:
                     print("\n----------------------------------------\n")
                     print("Prediction unverarbeitet:")
                 pred = postprocess_donut_funsd(pred, processor, verbose=CONFIG.VERBOSE)
 
-                f1_score, recall, precision = calculate_metrics_funsd(answer, pred)
-                val_metrics["f1"].append(f1_score)
-                val_metrics["recall"].append(recall)
-                val_metrics["precision"].append(precision)
+                val_metrics.update(answer, pred)
 
                 if CONFIG.VERBOSE:
+                    f1_score, recall, precision = calculate_metrics_funsd(answer, pred)
                     print(f"\nPrediction: {pred}")
                     print(f"\n\tAnswer: {answer}")
                     print(f"\n\tF1-Score: {f1_score}")
                     print(f"\n\tRecall: {recall}")
                     print(f"\n\tPrecsion: {precision}")
 
-    val_metrics["f1"] = np.mean(val_metrics["f1"])
-    val_metrics["recall"] = np.mean(val_metrics["recall"])
-    val_metrics["precision"] = np.mean(val_metrics["precision"])
-
     return val_metrics
 
 
+def evaluate_funsd(
+    model: VisionEncoderDecoderModel,
+    processor: DonutProcessor,
+    device: torch.device,
+    val_dataloader: DataLoader,
+    generation_config: Optional[GenerationConfig] = None,
+):
+    return accumulate_funsd(model, processor, device, val_dataloader, generation_config).compute()
+
+
 def evaluate_step_funsd(batch, batch_idx, processor, model, generation_config):
     pixel_values, decoder_input_ids, prompt_end_idxs, answers = batch
 
@@ -169,15 +313,13 @@ def evaluate_step_funsd(batch, batch_idx, processor, model, generation_config):
         eos_token_id=processor.tokenizer.eos_token_id,
         use_cache=True,
         bad_words_ids=[[processor.tokenizer.unk_token_id]],
+        logits_processor=prepare_logits_processor(processor),
         return_dict_in_generate=True,
         generation_config=generation_config,
     )
 
-    predictions = processor.tokenizer.batch_decode(outputs.sequences)
-
     f1_scores = []
-    for pred, answer in zip(predictions, answers):
-        answer = postprocess_donut_funsd(answer, processor)
+    for pred, answer in zip(outputs.sequences.cpu(), answers):
         pred = postprocess_donut_funsd(pred, processor)
 
         f1_score, recall, precision = calculate_metrics_funsd(answer, pred)
@@ -0,0 +1,204 @@
+import math
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+import editdistance
+import numpy as np
+
+# Length of the character n-grams used to prune candidate pairs
+NGRAM_SIZE = 2
+# Cost of an invalid pair in the optimal assignment, larger than any sum of valid costs
+_INVALID_COST = 1e6
+
+
+def normalize_entity_text(text: str) -> str:
+    """
+    Lowercases the text and collapses whitespace (like the ANLS normalization).
+    """
+    return " ".join(text.strip().lower().split())
+
+
+def _ngrams(text: str) -> Counter:
+    return Counter(text[i : i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1))
+
+
+def _within_threshold(distance: int, longest: int, threshold: float) -> bool:
+    # The same comparison as the final check, so the bounds agree with it up to the float rounding
+    return (distance / longest if longest else 0.0) <= threshold
+
+
+def _max_distance(longest: int, threshold: float) -> int:
+    """
+    Largest edit distance d with `_within_threshold(d, longest, threshold)`.
+    `floor(threshold * longest)` can be off by one in floating point, so it is corrected in both directions.
+    """
+    distance = max(0, math.floor(threshold * longest))
+    while distance < longest and _within_threshold(distance + 1, longest, threshold):
+        distance += 1
+    while distance > 0 and not _within_threshold(distance, longest, threshold):
+        distance -= 1
+    return distance
+
+
+class EntityIndex:
+    """
+    Index over the gold entity texts of one page for finding fuzzy match candidates.
+
+    Candidates are pruned in two steps before an edit distance is computed:
+    - length buckets: a normalized distance <= threshold bounds the length ratio of both texts,
+    - n-gram count filter: every edit destroys at most `NGRAM_SIZE` n-grams, so texts within
+      distance d share at least max(len) - NGRAM_SIZE + 1 - NGRAM_SIZE * d n-grams.
+
+    Both filters never drop a pair within the threshold (the bounds use the same comparison as the
+    final check instead of rounding `threshold * length`).
+
+    Args:
+        texts (List[str]): Normalized gold texts.
+        threshold (float): Maximum normalized edit distance of a match.
+    """
+
+    def __init__(self, texts: List[str], threshold: float):
+        self.texts = texts
+        self.threshold = threshold
+        self.length_buckets: Dict[int, List[int]] = defaultdict(list)
+        self.ngram_index: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for idx, text in enumerate(texts):
+            self.length_buckets[len(text)].append(idx)
+            for ngram, count in _ngrams(text).items():
+                self.ngram_index[ngram].append((idx, count))
+
+    def candidates(self, text: str) -> List[Tuple[int, float]]:
+        """
+        Returns (gold index, normalized edit distance) for all gold texts within the threshold.
+        """
+        length = len(text)
+
+        shared_ngrams: Counter = Counter()
+        for ngram, count in _ngrams(text).items():
+            for idx, gold_count in self.ngram_index.get(ngram, ()):
+                shared_ngrams[idx] += min(count, gold_count)
+
+        results = []
+        for gold_length, bucket in self.length_buckets.items():
+            longest = max(length, gold_length)
+            # d >= |len_a - len_b|, so the length difference alone must be within the threshold
+            if not _within_threshold(abs(length - gold_length), longest, self.threshold):
+                continue
+            max_distance = _max_distance(longest, self.threshold)
+            for idx in bucket:
+                if shared_ngrams[idx] < longest - NGRAM_SIZE + 1 - NGRAM_SIZE * max_distance:
+                    continue
+
+                distance = editdistance.eval(text, self.texts[idx])
+                if _within_threshold(distance, longest, self.threshold):
+                    results.append((idx, distance / longest if longest else 0.0))
+        return results
+
+
+def _assign_greedy(pairs: List[Tuple[float, int, int]]) -> List[Tuple[int, int]]:
+    matched_predictions, matched_golds, matches = set(), set(), []
+    for _, prediction_idx, gold_idx in sorted(pairs):
+        if prediction_idx in matched_predictions or gold_idx in matched_golds:
+            continue
+        matched_predictions.add(prediction_idx)
+        matched_golds.add(gold_idx)
+        matches.append((prediction_idx, gold_idx))
+    return matches
+
+
+def _assign_optimal(pairs: List[Tuple[float, int, int]]) -> List[Tuple[int, int]]:
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        raise ImportError("Optimal fuzzy matching requires scipy (pip install scipy)")
+
+    if not pairs:
+        return []
+
+    # Only rows/columns that take part in at least one valid pair
+    prediction_ids = sorted({prediction_idx for _, prediction_idx, _ in pairs})
+    gold_ids = sorted({gold_idx for _, _, gold_idx in pairs})
+    rows = {idx: row for row, idx in enumerate(prediction_ids)}
+    columns = {idx: column for column, idx in enumerate(gold_ids)}
+
+    # Maximizes the number of matches first, then minimizes the summed distance
+    cost = np.full((len(prediction_ids), len(gold_ids)), _INVALID_COST)
+    for distance, prediction_idx, gold_idx in pairs:
+        cost[rows[prediction_idx], columns[gold_idx]] = distance
+
+    matches = []
+    for row, column in zip(*linear_sum_assignment(cost)):
+        if cost[row, column] < _INVALID_COST:
+            matches.append((prediction_ids[row], gold_ids[column]))
+    return matches
+
+
+def match_entities(
+    ground_truth: List[dict],
+    predictions: List[dict],
+    threshold: float = 0.2,
+    strict: bool = False,
+    assignment: str = "greedy",
+) -> List[Tuple[int, int]]:
+    """
+    Pairs predicted and gold entities whose normalized texts are within a normalized edit distance.
+
+    Exact matches are paired first. The remaining entities are matched through an `EntityIndex`
+    and assigned one-to-one, either greedily (closest pairs first) or optimally (maximum number
+    of matches with minimal total distance, requires scipy).
+
+    Args:
+        ground_truth (List[dict]): Gold entities ({"text": ..., "label": ...}).
+        predictions (List[dict]): Predicted entities.
+        threshold (float): Maximum normalized edit distance of a match.
+        strict (bool): Only pair entities with the same label.
+        assignment (str): "greedy" or "optimal".
+
+    Returns:
+        List[Tuple[int, int]]: Matched (prediction index, gold index) pairs.
+    """
+    if assignment not in ("greedy", "optimal"):
+        raise ValueError(f"Unknown assignment: {assignment}")
+
+    def entity_key(item: dict) -> Tuple[str, str]:
+        label = item.get("label", "") if strict else ""
+        return normalize_entity_text(item.get("text", "")), label
+
+    prediction_keys = [entity_key(item) if isinstance(item, dict) else None for item in predictions]
+    gold_keys = [entity_key(item) if isinstance(item, dict) else None for item in ground_truth]
+
+    # Exact matches don't need the index
+    gold_by_key: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+    for gold_idx, key in enumerate(gold_keys):
+        if key is not None:
+            gold_by_key[key].append(gold_idx)
+
+    matches = []
+    unmatched_predictions = []
+    for prediction_idx, key in enumerate(prediction_keys):
+        if key is None:
+            continue
+        if gold_by_key.get(key):
+            matches.append((prediction_idx, gold_by_key[key].pop(0)))
+        else:
+            unmatched_predictions.append(prediction_idx)
+
+    # Fuzzy matches, per label in strict mode
+    unmatched_golds: Dict[str, List[int]] = defaultdict(list)
+    for key, gold_ids in gold_by_key.items():
+        unmatched_golds[key[1]].extend(gold_ids)
+
+    pairs = []
+    for label, gold_ids in unmatched_golds.items():
+        index = EntityIndex([gold_keys[gold_idx][0] for gold_idx in gold_ids], threshold)
+        for prediction_idx in unmatched_predictions:
+            text, prediction_label = prediction_keys[prediction_idx]
+            if prediction_label != label:
+                continue
+            for position, distance in index.candidates(text):
+                pairs.append((distance, prediction_idx, gold_ids[position]))
+
+    if assignment == "greedy":
+        matches += _assign_greedy(pairs)
+    else:
+        matches += _assign_optimal(pairs)
+    return matches
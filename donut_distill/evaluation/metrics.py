@@ -1,5 +1,9 @@
 from anls import anls_score
-from typing import List
+from collections import Counter
+from typing import Dict, List, Optional
+import editdistance
+import numpy as np
+from donut_distill.evaluation.fuzzy_matching import match_entities
 
 def calculate_metrics_funsd(ground_truth, predictions, strict=False):
     
@@ -26,6 +30,165 @@ def calculate_metrics_funsd(ground_truth, predictions, strict=False):
 
     return f1_score, recall, precision
 
+def calculate_metrics_funsd_fuzzy(ground_truth, predictions, threshold=0.2, strict=False, assignment="greedy"):
+    """
+    Like `calculate_metrics_funsd`, but an entity also counts as found if its normalized text is
+    within `threshold` normalized edit distance of an unmatched gold entity (see `match_entities`).
+
+    Args:
+        ground_truth (List[dict]): Gold entities.
+        predictions (List[dict]): Predicted entities.
+        threshold (float): Maximum normalized edit distance of a match.
+        strict (bool): Only match entities with the same label.
+        assignment (str): "greedy" or "optimal" one-to-one assignment.
+
+    Returns:
+        Tuple[float, float, float]: f1_score, recall, precision
+    """
+    true_positives = len(match_entities(ground_truth, predictions, threshold, strict, assignment))
+
+    recall = true_positives / len(ground_truth) if true_positives != 0 else 0
+    precision = true_positives / len(predictions) if true_positives != 0 else 0
+    f1_score = 2 * (precision * recall) / (precision + recall + 1e-9)
+
+    return f1_score, recall, precision
+
+
+def _precision_recall_f1(true_positives: int, num_predictions: int, num_ground_truth: int):
+    precision = true_positives / num_predictions if true_positives != 0 else 0
+    recall = true_positives / num_ground_truth if true_positives != 0 else 0
+    f1_score = 2 * (precision * recall) / (precision + recall + 1e-9)
+    return precision, recall, f1_score
+
+
+class FunsdMetricAccumulator:
+    """
+    Streaming FUNSD metrics over a whole validation pass.
+
+    Only counts are kept (per label and in total), so memory doesn't grow with the number of
+    documents. Accumulators of parallel evaluation workers can be combined with `merge`.
+
+    Reported metrics:
+    - f1/recall/precision: mean of the per-document scores of `calculate_metrics_funsd` (text matching)
+    - micro_*: corpus-level scores with text matching
+    - strict_micro_*: corpus-level scores with (text, label) matching
+    - macro_f1: mean of the per-label F1 scores (strict matching)
+    - <label>/precision, <label>/recall, <label>/f1: per-label scores (strict matching)
+    - fuzzy_f1/fuzzy_recall/fuzzy_precision: mean of the per-document scores of
+      `calculate_metrics_funsd_fuzzy`, only if `fuzzy_threshold` is set
+
+    Args:
+        fuzzy_threshold (float, optional): Normalized edit distance for fuzzy matching.
+        fuzzy_assignment (str): "greedy" or "optimal" assignment for fuzzy matching.
+    """
+
+    def __init__(self, fuzzy_threshold: Optional[float] = None, fuzzy_assignment: str = "greedy"):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.fuzzy_assignment = fuzzy_assignment
+        self.num_documents = 0
+        self.document_sums = {"f1": 0.0, "recall": 0.0, "precision": 0.0}
+        if fuzzy_threshold is not None:
+            self.document_sums.update({"fuzzy_f1": 0.0, "fuzzy_recall": 0.0, "fuzzy_precision": 0.0})
+        self.true_positives = 0
+        self.num_predictions = 0
+        self.num_ground_truth = 0
+        self.label_true_positives: Counter = Counter()
+        self.label_predictions: Counter = Counter()
+        self.label_ground_truth: Counter = Counter()
+
+    def update(self, ground_truth: List[dict], predictions: List[dict]):
+        """
+        Adds the entities of one document.
+        """
+        f1_score, recall, precision = calculate_metrics_funsd(ground_truth, predictions)
+        self.num_documents += 1
+        self.document_sums["f1"] += f1_score
+        self.document_sums["recall"] += recall
+        self.document_sums["precision"] += precision
+
+        if self.fuzzy_threshold is not None:
+            f1_score, recall, precision = calculate_metrics_funsd_fuzzy(
+                ground_truth, predictions, self.fuzzy_threshold, assignment=self.fuzzy_assignment
+            )
+            self.document_sums["fuzzy_f1"] += f1_score
+            self.document_sums["fuzzy_recall"] += recall
+            self.document_sums["fuzzy_precision"] += precision
+
+        ground_truth = Counter(
+            (item.get("text", ""), item.get("label", "")) for item in ground_truth if isinstance(item, dict)
+        )
+        predictions = Counter(
+            (item.get("text", ""), item.get("label", "")) for item in predictions if isinstance(item, dict)
+        )
+
+        # Text matching
+        ground_truth_texts: Counter = Counter()
+        prediction_texts: Counter = Counter()
+        for (text, _), count in ground_truth.items():
+            ground_truth_texts[text] += count
+        for (text, _), count in predictions.items():
+            prediction_texts[text] += count
+        self.true_positives += sum((ground_truth_texts & prediction_texts).values())
+        self.num_predictions += sum(prediction_texts.values())
+        self.num_ground_truth += sum(ground_truth_texts.values())
+
+        # Strict (text, label) matching per label
+        for (_, label), count in (ground_truth & predictions).items():
+            self.label_true_positives[label] += count
+        for (_, label), count in predictions.items():
+            self.label_predictions[label] += count
+        for (_, label), count in ground_truth.items():
+            self.label_ground_truth[label] += count
+
+    def merge(self, other: "FunsdMetricAccumulator") -> "FunsdMetricAccumulator":
+        """
+        Adds the counts of another accumulator (e.g. from another evaluation worker).
+        """
+        self.num_documents += other.num_documents
+        for key, value in other.document_sums.items():
+            self.document_sums[key] = self.document_sums.get(key, 0.0) + value
+        self.true_positives += other.true_positives
+        self.num_predictions += other.num_predictions
+        self.num_ground_truth += other.num_ground_truth
+        self.label_true_positives.update(other.label_true_positives)
+        self.label_predictions.update(other.label_predictions)
+        self.label_ground_truth.update(other.label_ground_truth)
+        return self
+
+    def compute(self) -> Dict[str, float]:
+        """
+        Returns all metrics as a flat dict.
+        """
+        results = {
+            key: value / self.num_documents if self.num_documents else 0.0
+            for key, value in self.document_sums.items()
+        }
+
+        precision, recall, f1_score = _precision_recall_f1(
+            self.true_positives, self.num_predictions, self.num_ground_truth
+        )
+        results.update({"micro_f1": f1_score, "micro_recall": recall, "micro_precision": precision})
+
+        precision, recall, f1_score = _precision_recall_f1(
+            sum(self.label_true_positives.values()),
+            sum(self.label_predictions.values()),
+            sum(self.label_ground_truth.values()),
+        )
+        results.update({"strict_micro_f1": f1_score, "strict_micro_recall": recall, "strict_micro_precision": precision})
+
+        labels = sorted(self.label_ground_truth.keys() | self.label_predictions.keys())
+        label_f1_scores = []
+        for label in labels:
+            precision, recall, f1_score = _precision_recall_f1(
+                self.label_true_positives[label], self.label_predictions[label], self.label_ground_truth[label]
+            )
+            results.update({f"{label}/precision": precision, f"{label}/recall": recall, f"{label}/f1": f1_score})
+            label_f1_scores.append(f1_score)
+        results["macro_f1"] = float(np.mean(label_f1_scores)) if label_f1_scores else 0.0
+
+        return results
+
+
 def calculate_metrics_docvqa(ground_truths: List[str], prediction: str):
     exact_match = prediction in ground_truths 
     anls = anls_score(prediction=prediction, gold_labels=ground_truths, threshold=0.5)
@@ -34,3 +197,70 @@ def calculate_metrics_docvqa(ground_truths: List[str], prediction: str):
         "anls": anls,
         "exact_match": exact_match,
     }
+
+
+def _normalize_anls(text: str) -> str:
+    # Same normalization as `anls_score`: not case sensitive, but space sensitive
+    return " ".join(text.strip().lower().split())
+
+
+def calculate_metrics_docvqa_batch(
+    ground_truths: List[List[str]], predictions: List[str], threshold: float = 0.5
+) -> Dict[str, np.ndarray]:
+    """
+    Computes ANLS and exact match for all predictions of a validation pass at once.
+
+    All (prediction, gold answer) pairs are flattened into one array. The edit distances come
+    from `editdistance`, the normalization, threshold and the maximum per question are NumPy
+    reductions. The scores are identical to calling `calculate_metrics_docvqa` per question.
+
+    Args:
+        ground_truths (List[List[str]]): Gold answers per question.
+        predictions (List[str]): One predicted answer per question.
+        threshold (float): Normalized Levenshtein distance from which a pair scores 0.
+
+    Returns:
+        Dict[str, np.ndarray]: Per question "anls" (float) and "exact_match" (bool) scores.
+    """
+    if len(ground_truths) != len(predictions):
+        raise ValueError("Expected one list of gold answers per prediction")
+    if any(len(gold_labels) == 0 for gold_labels in ground_truths):
+        raise ValueError("Every question needs at least one gold answer")
+    if len(predictions) == 0:
+        return {"anls": np.zeros(0), "exact_match": np.zeros(0, dtype=bool)}
+
+    # Flatten to one (prediction, gold answer) pair per entry
+    pair_predictions = []
+    pair_golds = []
+    for prediction, gold_labels in zip(predictions, ground_truths):
+        prediction = _normalize_anls(prediction)
+        pair_predictions += [prediction] * len(gold_labels)
+        pair_golds += [_normalize_anls(gold_label) for gold_label in gold_labels]
+
+    distances = np.fromiter(
+        (editdistance.eval(prediction, gold) for prediction, gold in zip(pair_predictions, pair_golds)),
+        dtype=np.float64,
+        count=len(pair_golds),
+    )
+    # `anls` measures the lengths of the upper-cased strings
+    lengths = np.fromiter(
+        (max(len(prediction.upper()), len(gold.upper())) for prediction, gold in zip(pair_predictions, pair_golds)),
+        dtype=np.float64,
+        count=len(pair_golds),
+    )
+
+    normalized_distances = np.divide(distances, lengths, out=np.zeros_like(distances), where=lengths > 0)
+    similarities = np.where(normalized_distances < threshold, 1 - normalized_distances, 0.0)
+
+    # Best gold answer per question
+    offsets = np.cumsum([0] + [len(gold_labels) for gold_labels in ground_truths[:-1]])
+    anls = np.maximum.reduceat(similarities, offsets)
+
+    exact_match = np.array(
+        [prediction in gold_labels for prediction, gold_labels in zip(predictions, ground_truths)], dtype=bool
+    )
+
+    return {
+        "anls": anls,
+        "exact_match": exact_match,
+    }
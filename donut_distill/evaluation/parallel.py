@@ -0,0 +1,183 @@
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from transformers import DonutProcessor, GenerationConfig
+import donut_distill.config.config as CONFIG
+from donut_distill.config.loader import load_config
+
+
+def shard_indices(num_samples: int, num_shards: int) -> List[List[int]]:
+    """
+    Splits the sample indices into `num_shards` contiguous shards of (almost) equal size.
+    Concatenating the shards gives back the original order.
+    """
+    bounds = np.linspace(0, num_samples, num_shards + 1).astype(int)
+    return [list(range(start, end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _evaluate_shard(
+    config_path: Optional[str],
+    model_path: str,
+    task: str,
+    indices: List[int],
+    num_threads: int,
+) -> Any:
+    """
+    Worker: loads its own model copy and evaluates the validation samples at `indices`.
+
+    Returns the raw per-sample outputs (DocVQA) or the metric counts (FUNSD), so the runner
+    can merge them exactly.
+    """
+    from donut_distill.evaluation.evaluate import accumulate_funsd, generate_docvqa_predictions
+    from donut_distill.models.helpers import load_inference_model
+    from donut_distill.training.utils import prepare_val_dataloader
+
+    # Workers are spawned, so the config has to be loaded again
+    if config_path:
+        load_config(config_path)
+    CONFIG.VERBOSE = False
+    torch.set_num_threads(num_threads)
+
+    processor = DonutProcessor.from_pretrained(model_path)
+    # ONNX Runtime sessions don't follow torch.set_num_threads
+    model = load_inference_model(model_path, num_threads=num_threads)
+    model.eval()
+
+    val_dataloader = prepare_val_dataloader(model, processor, task=task)
+    shard_dataloader = DataLoader(
+        Subset(val_dataloader.dataset, indices),
+        batch_size=val_dataloader.batch_size,
+        shuffle=False,
+        num_workers=0,
+        collate_fn=val_dataloader.collate_fn,
+    )
+
+    generation_config = GenerationConfig(early_stopping=True, num_beams=1)
+    device = torch.device("cpu")
+    if task == "docvqa":
+        return generate_docvqa_predictions(model, processor, device, shard_dataloader, generation_config)
+    return accumulate_funsd(model, processor, device, shard_dataloader, generation_config)
+
+
+def num_eval_samples(num_samples: int, task: str) -> int:
+    """
+    Number of validation samples the single-process evaluation would use (DocVQA honors `LIMIT_VAL_BATCHES`).
+    """
+    if task != "docvqa":
+        return num_samples
+    num_batches = (num_samples + CONFIG.VAL_BATCH_SIZES - 1) // CONFIG.VAL_BATCH_SIZES
+    limit_batches = max(1, int(num_batches * CONFIG.LIMIT_VAL_BATCHES))
+    return min(num_samples, limit_batches * CONFIG.VAL_BATCH_SIZES)
+
+
+def evaluate_parallel(
+    model_path: str,
+    task: str,
+    num_samples: int,
+    num_workers: int,
+    threads_per_worker: Optional[int] = None,
+    config_path: Optional[str] = None,
+) -> Tuple[Dict[str, float], float]:
+    """
+    Evaluates a checkpoint on CPU with the validation set sharded across worker processes.
+
+    Each worker loads its own model copy and uses `threads_per_worker` intra-op threads.
+    DocVQA outputs are concatenated in sample order and scored once, FUNSD metric counts are
+    merged, so the metrics are the same as those of `evaluate_docvqa`/`evaluate_funsd` on the
+    same samples.
+
+    Args:
+        model_path (str): Checkpoint (model and processor), see `load_inference_model`.
+        task (str): "docvqa" or "funsd".
+        num_samples (int): Size of the validation set.
+        num_workers (int): Number of worker processes.
+        threads_per_worker (int, optional): Threads per worker. Defaults to the available cores divided by `num_workers`.
+        config_path (str, optional): Config file the workers load.
+
+    Returns:
+        Tuple[Dict[str, float], float]: The metrics and the samples per second.
+    """
+    from donut_distill.evaluation.evaluate import summarize_docvqa
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+    shards = [shard for shard in shard_indices(num_eval_samples(num_samples, task), num_workers) if shard]
+    args = [(config_path, model_path, task, shard, threads_per_worker) for shard in shards]
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(len(shards)) as pool:
+        shard_results = pool.starmap(_evaluate_shard, args)
+    elapsed = time.perf_counter() - start
+
+    if task == "docvqa":
+        val_outputs = {key: [] for key in shard_results[0]}
+        for shard_result in shard_results:
+            for key, values in shard_result.items():
+                val_outputs[key].extend(values)
+        results = summarize_docvqa(val_outputs)
+    else:
+        accumulator = shard_results[0]
+        for shard_result in shard_results[1:]:
+            accumulator.merge(shard_result)
+        results = accumulator.compute()
+
+    num_evaluated = sum(len(shard) for shard in shards)
+    return {key: float(value) for key, value in results.items()}, num_evaluated / elapsed
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from donut_distill.models.helpers import load_inference_model
+    from donut_distill.training.utils import prepare_val_dataloader
+
+    parser = argparse.ArgumentParser(description="Evaluate a Donut checkpoint with the validation set sharded across CPU processes")
+    parser.add_argument("--config", help="Path to the config file", type=str, default=None)
+    parser.add_argument("--model_path", help="Checkpoint to evaluate (model and processor)", type=str, required=True)
+    parser.add_argument("--task", choices=["docvqa", "funsd"], default="docvqa")
+    parser.add_argument("--num_workers", help="Maximum number of worker processes", type=int, default=os.cpu_count())
+    parser.add_argument("--threads_per_worker", help="Intra-op threads per worker (default: cores / workers)", type=int, default=None)
+    parser.add_argument("--scaling", action="store_true", help="Report samples/s for 1, 2, 4, ... up to num_workers workers")
+    parser.add_argument("--output", help="Optional path for the JSON report", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.config:
+        load_config(args.config)
+
+    # Size of the validation set, built the same way the workers build it
+    processor = DonutProcessor.from_pretrained(args.model_path)
+    num_samples = len(prepare_val_dataloader(load_inference_model(args.model_path), processor, task=args.task).dataset)
+
+    worker_counts = [args.num_workers]
+    if args.scaling:
+        worker_counts = sorted({2**i for i in range(args.num_workers.bit_length()) if 2**i <= args.num_workers} | {args.num_workers})
+
+    report = {"num_samples": num_eval_samples(num_samples, args.task), "runs": []}
+    for num_workers in worker_counts:
+        metrics, samples_per_second = evaluate_parallel(
+            args.model_path,
+            args.task,
+            num_samples,
+            num_workers,
+            threads_per_worker=args.threads_per_worker,
+            config_path=args.config,
+        )
+        report["runs"].append(
+            {"num_workers": num_workers, "samples_per_second": samples_per_second, "metrics": metrics}
+        )
+        print(f"{num_workers} workers: {samples_per_second:.2f} samples/s")
+
+    base = report["runs"][0]["samples_per_second"]
+    for run in report["runs"]:
+        run["speedup"] = run["samples_per_second"] / base
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
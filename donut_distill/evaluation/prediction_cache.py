@@ -0,0 +1,89 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Optional
+import torch
+from torch import nn
+from transformers import GenerationConfig
+import donut_distill.config.config as CONFIG
+
+
+def model_fingerprint(model: nn.Module) -> Optional[str]:
+    """
+    Hashes the names and raw bytes of all tensors in the model's state dict.
+
+    Returns None for models whose state can't be hashed this way (e.g. ONNX Runtime sessions
+    or packed quantized weights), so their predictions are never cached.
+    """
+    if not isinstance(model, nn.Module):
+        return None
+
+    digest = hashlib.blake2b(digest_size=16)
+    for name, tensor in model.state_dict().items():
+        if not isinstance(tensor, torch.Tensor):
+            return None
+        if tensor.is_quantized:
+            tensor = tensor.int_repr()
+        digest.update(name.encode())
+        digest.update(str(tensor.dtype).encode())
+        digest.update(tensor.detach().contiguous().view(-1).view(torch.uint8).cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Caches DocVQA validation outputs (see `generate_docvqa_predictions`) per model fingerprint,
+    generation settings and validation subset.
+
+    Evaluating an unchanged checkpoint again (e.g. rerunning a standalone evaluation) then doesn't
+    need any generation. Entries are kept in memory and, if `cache_dir` is given, also stored as
+    JSON files. The fingerprint copies and hashes the whole state dict, so don't use the cache
+    where the weights change between evaluations (e.g. validation during training).
+
+    Args:
+        cache_dir (str | Path, optional): Directory to persist the entries in.
+    """
+
+    def __init__(self, cache_dir: Optional[str | Path] = None):
+        self.entries: Dict[str, Dict[str, list]] = {}
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, model: nn.Module, generation_config: Optional[GenerationConfig], dataset_key: Optional[str]) -> Optional[str]:
+        """
+        Returns the cache key, or None if the outputs can't be cached.
+        """
+        if dataset_key is None:
+            return None
+        fingerprint = model_fingerprint(model)
+        if fingerprint is None:
+            return None
+
+        settings = {
+            "generation_config": generation_config.to_diff_dict() if generation_config is not None else None,
+            "max_length": CONFIG.MAX_LENGTH,
+            "early_exit": CONFIG.EARLY_EXIT_ON_ANSWER,
+            "constrained_decoding": CONFIG.CONSTRAINED_DECODING,
+            "dataset": dataset_key,
+        }
+        settings_hash = hashlib.blake2b(json.dumps(settings, sort_keys=True, default=str).encode(), digest_size=8)
+        return f"{fingerprint}-{settings_hash.hexdigest()}"
+
+    def get(self, key: Optional[str]) -> Optional[Dict[str, list]]:
+        if key is None:
+            return None
+        if key not in self.entries and self.cache_dir is not None:
+            path = self.cache_dir / f"{key}.json"
+            if path.is_file():
+                with open(path, "r") as f:
+                    self.entries[key] = json.load(f)
+        return self.entries.get(key)
+
+    def put(self, key: Optional[str], val_outputs: Dict[str, list]):
+        if key is None:
+            return
+        self.entries[key] = val_outputs
+        if self.cache_dir is not None:
+            with open(self.cache_dir / f"{key}.json", "w") as f:
+                json.dump(val_outputs, f)
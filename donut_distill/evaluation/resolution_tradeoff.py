@@ -0,0 +1,139 @@
+from typing import Any, Dict, List, Optional, Sequence
+import torch
+from transformers import DonutProcessor, GenerationConfig, VisionEncoderDecoderModel
+from donut_distill.evaluation.evaluate import evaluate_docvqa
+from donut_distill.evaluation.prediction_cache import PredictionCache
+from donut_distill.models.architecture_search import measure_latency
+from donut_distill.models.student import create_student_reduced_resolution, scale_pixel_values
+
+
+def evaluate_resolution_tradeoff(
+    model: VisionEncoderDecoderModel,
+    processor: DonutProcessor,
+    val_dataloader,
+    input_scales: Sequence[float],
+    window_sizes: Sequence[Optional[int]] = (None,),
+    limit_val_batches: Optional[float] = None,
+    decode_steps: int = 32,
+    repeats: int = 3,
+    prediction_cache: Optional[PredictionCache] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Measures CPU latency and DocVQA ANLS of a model run at reduced input resolutions and window sizes.
+
+    Each variant is built with `create_student_reduced_resolution` (sharing the weights, without
+    retraining), so the results show how much accuracy a resolution costs before distillation.
+    Checkpoints distilled at a reduced resolution can be evaluated at `input_scales=[1.0]`.
+
+    Args:
+        model (VisionEncoderDecoderModel): The model at its native resolution.
+        processor (DonutProcessor): Its processor, the dataloader must produce images at the native resolution.
+        val_dataloader (DataLoader): DocVQA validation dataloader.
+        input_scales (Sequence[float]): Input scales to evaluate.
+        window_sizes (Sequence[int | None]): Swin window sizes to evaluate, None keeps the model's.
+        limit_val_batches (float, optional): Fraction of the validation batches (default: `CONFIG.LIMIT_VAL_BATCHES`).
+        decode_steps (int): Generated tokens per latency measurement.
+        repeats (int): Timed generations per variant.
+        prediction_cache (PredictionCache, optional): Reuses the predictions of variants evaluated before.
+
+    Returns:
+        List[Dict[str, Any]]: Per variant the scale, window size, encoder image size, latency and metrics.
+    """
+    device = torch.device("cpu")
+    model.to(device)
+    model.eval()
+
+    # Latency is measured on one validation image with the task prompt
+    pixel_values = next(iter(val_dataloader))[0][:1]
+    decoder_input_ids = torch.tensor([[processor.tokenizer.convert_tokens_to_ids("<s_docvqa>")]])
+
+    results = []
+    for window_size in window_sizes:
+        for input_scale in input_scales:
+            try:
+                variant = create_student_reduced_resolution(
+                    model, model.config, input_scale, window_size=window_size, share_weights=True
+                )
+            except ValueError as e:
+                print(f"Skipping scale {input_scale}, window {window_size}: {e}")
+                continue
+
+            latency_ms = measure_latency(
+                variant, scale_pixel_values(pixel_values, input_scale), decoder_input_ids, decode_steps, repeats
+            )
+            metrics = evaluate_docvqa(
+                model=variant,
+                processor=processor,
+                device=device,
+                val_dataloader=val_dataloader,
+                generation_config=GenerationConfig(early_stopping=True, num_beams=1),
+                limit_val_batches=limit_val_batches,
+                prediction_cache=prediction_cache,
+                input_scale=input_scale,
+            )
+            results.append(
+                {
+                    "input_scale": input_scale,
+                    "window_size": variant.config.encoder.window_size,
+                    "image_size": list(variant.config.encoder.image_size),
+                    "latency_ms": latency_ms,
+                    **{key: float(value) for key, value in metrics.items()},
+                }
+            )
+            print(
+                f"scale {input_scale}, window {variant.config.encoder.window_size}: "
+                f"{latency_ms:.1f} ms, ANLS {results[-1]['eval/anls']:.4f}"
+            )
+
+    # Relative to the first variant (usually the full resolution)
+    if results:
+        base = results[0]
+        for result in results:
+            result["speedup"] = base["latency_ms"] / result["latency_ms"]
+            result["anls_delta"] = result["eval/anls"] - base["eval/anls"]
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import donut_distill.config.config as CONFIG
+    from donut_distill.config.loader import load_config
+    from donut_distill.training.utils import prepare_val_dataloader
+
+    parser = argparse.ArgumentParser(description="Latency/ANLS trade-off of reduced input resolutions and window sizes on CPU")
+    parser.add_argument("--config", help="Path to the config file", type=str, default=None)
+    parser.add_argument("--model_path", help="Checkpoint to evaluate (model and processor)", type=str, required=True)
+    parser.add_argument("--input_scales", type=float, nargs="+", default=[1.0, 0.875, 0.75, 0.625, 0.5])
+    parser.add_argument("--window_sizes", type=int, nargs="+", default=None, help="Swin window sizes (default: the model's)")
+    parser.add_argument("--limit_val_batches", type=float, default=None)
+    parser.add_argument("--decode_steps", type=int, default=32, help="Generated tokens per latency measurement")
+    parser.add_argument("--num_threads", type=int, default=None, help="Torch intra-op threads")
+    parser.add_argument("--output", help="Optional path for the JSON report", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.config:
+        load_config(args.config)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    processor = DonutProcessor.from_pretrained(args.model_path)
+    model = VisionEncoderDecoderModel.from_pretrained(args.model_path)
+    val_dataloader = prepare_val_dataloader(model, processor, task="docvqa")
+
+    results = evaluate_resolution_tradeoff(
+        model,
+        processor,
+        val_dataloader,
+        input_scales=args.input_scales,
+        window_sizes=args.window_sizes or [None],
+        limit_val_batches=args.limit_val_batches,
+        decode_steps=args.decode_steps,
+        # Reruns on the same checkpoint (e.g. with more scales) only generate for new variants
+        prediction_cache=PredictionCache(CONFIG.PREDICTION_CACHE_DIR) if CONFIG.PREDICTION_CACHE_DIR else None,
+    )
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,498 @@
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import resource
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import torch
+from transformers import VisionEncoderDecoderConfig, VisionEncoderDecoderModel
+from donut_distill.models.student import create_student_small, create_student_small_with_encoder
+from donut_distill.training.losses import calculate_loss_and_accuracy_distillation
+from donut_distill.training.profiling import cpu_rss_bytes
+import donut_distill.config.config as CONFIG
+
+
+def decoder_layer_maps(num_teacher_layers: int, min_layers: int = 1, max_layers: Optional[int] = None) -> List[List[int]]:
+    """
+    Enumerates all decoder layer maps (ordered subsets of the teacher layers) with `min_layers` to `max_layers` layers.
+    """
+    max_layers = num_teacher_layers if max_layers is None else min(max_layers, num_teacher_layers)
+    return [
+        list(layers)
+        for num_layers in range(min_layers, max_layers + 1)
+        for layers in itertools.combinations(range(num_teacher_layers), num_layers)
+    ]
+
+
+def encoder_stage_blocks(teacher_depth: int, depth: int) -> List[int]:
+    """
+    Picks `depth` evenly spaced blocks (1-indexed, as in `copy_encoder_layers`) of a Swin stage.
+
+    Swin blocks alternate between regular and shifted windows, so blocks are kept in
+    (regular, shifted) pairs and `depth` must be even (or equal to the teacher depth).
+    """
+    if depth == teacher_depth:
+        return list(range(1, teacher_depth + 1))
+    if depth % 2 != 0 or depth > teacher_depth:
+        raise ValueError(f"Invalid depth {depth} for a stage with {teacher_depth} blocks")
+    pairs = np.round(np.linspace(0, teacher_depth // 2 - 1, depth // 2)).astype(int)
+    return [int(block) for pair in pairs for block in (2 * pair + 1, 2 * pair + 2)]
+
+
+def encoder_layer_maps(
+    teacher_depths: Sequence[int], stage_depths: Optional[Sequence[Sequence[int]]] = None
+) -> List[List[List[int]]]:
+    """
+    Enumerates encoder layer maps from the allowed depths of each stage.
+
+    Args:
+        teacher_depths (Sequence[int]): Blocks per stage of the teacher, e.g. [2, 2, 14, 2].
+        stage_depths (Sequence[Sequence[int]], optional): Allowed student depths per stage,
+            e.g. [[2], [2], [6, 10, 14], [2]]. If None, the encoder is kept as is.
+
+    Returns:
+        List[List[List[int]]]: Encoder layer maps, `[]` stands for the unchanged encoder.
+    """
+    if stage_depths is None:
+        return [[]]
+
+    maps = []
+    for depths in itertools.product(*stage_depths):
+        if list(depths) == list(teacher_depths):
+            maps.append([])
+        else:
+            maps.append([encoder_stage_blocks(t, d) for t, d in zip(teacher_depths, depths)])
+    return maps
+
+
+def _num_parameters(module: torch.nn.Module) -> int:
+    return sum(parameter.numel() for parameter in module.parameters())
+
+
+def count_parameters(
+    teacher: VisionEncoderDecoderModel, encoder_layer_map: List[List[int]], decoder_layer_map: List[int]
+) -> int:
+    """
+    Counts the parameters of a student without building it: the teacher's count minus the
+    removed decoder layers and encoder blocks (all layers of a decoder/encoder stage have the same shapes).
+    """
+    decoder_layers = teacher.decoder.model.decoder.layers
+    num_parameters = _num_parameters(teacher)
+    num_parameters -= (len(decoder_layers) - len(decoder_layer_map)) * _num_parameters(decoder_layers[0])
+    for stage, mapping in zip(teacher.encoder.encoder.layers, encoder_layer_map):
+        num_parameters -= (len(stage.blocks) - len(mapping)) * _num_parameters(stage.blocks[0])
+    return num_parameters
+
+
+def build_student(
+    teacher: VisionEncoderDecoderModel,
+    teacher_config: VisionEncoderDecoderConfig,
+    encoder_layer_map: List[List[int]],
+    decoder_layer_map: List[int],
+    share_weights: bool = False,
+) -> VisionEncoderDecoderModel:
+    """
+    Creates a student the same way training does.
+    """
+    create = create_student_small_with_encoder if encoder_layer_map else create_student_small
+    return create(
+        teacher=teacher,
+        teacher_config=teacher_config,
+        encoder_layer_map=encoder_layer_map,
+        decoder_layer_map=decoder_layer_map,
+        share_weights=share_weights,
+    )
+
+
+def teacher_forcing_batch(batch, processor, ignore_id: int = -100) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Turns a training batch (pixel_values, input_ids, labels) or a validation batch
+    (pixel_values, input_ids, prompt_end_index, gt_parse) into shifted model inputs.
+    """
+    pixel_values, input_ids = batch[0], batch[1]
+    if len(batch) == 3:
+        labels = batch[2]
+    else:
+        # Validation batches have no labels, mask the padding and the prompt like DonutDataset does
+        labels = input_ids.clone()
+        labels[labels == processor.tokenizer.pad_token_id] = ignore_id
+        for row, prompt_end_index in enumerate(batch[2]):
+            labels[row, : int(prompt_end_index) + 1] = ignore_id
+    return pixel_values, input_ids[:, :-1], labels[:, 1:]
+
+
+def proxy_loss(
+    student: VisionEncoderDecoderModel,
+    teacher: VisionEncoderDecoderModel,
+    train_batches: List[Tuple[torch.Tensor, ...]],
+    heldout_batches: List[Tuple[torch.Tensor, ...]],
+    decoder_layer_map: List[int],
+    device: torch.device,
+    steps: int = 0,
+    lr: float = 1e-4,
+) -> Dict[str, float]:
+    """
+    Fast quality proxy of a student: logit KL divergence to the teacher on held-out batches,
+    optionally after `steps` distillation steps on the training batches.
+
+    The intermediate (attention/hidden state) terms depend on the layer map and aren't
+    comparable between candidates, so only the logits are scored.
+
+    Returns:
+        Dict[str, float]: proxy_loss (KL divergence) and proxy_ce (cross entropy with the labels).
+    """
+    student.to(device)
+
+    # Short distillation on the training batches
+    if steps > 0:
+        optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+        student.train()
+        for step in range(steps):
+            pixel_values, decoder_input_ids, labels = (t.to(device) for t in train_batches[step % len(train_batches)])
+            with torch.no_grad():
+                teacher_outputs = teacher(
+                    pixel_values,
+                    decoder_input_ids=decoder_input_ids,
+                    labels=labels,
+                    output_attentions=True,
+                    output_hidden_states=True,
+                )
+            outputs = student(
+                pixel_values,
+                decoder_input_ids=decoder_input_ids,
+                labels=labels,
+                output_attentions=True,
+                output_hidden_states=True,
+            )
+            loss = calculate_loss_and_accuracy_distillation(
+                outputs=outputs,
+                teacher_outputs=teacher_outputs,
+                is_first_distillation_phase=True,
+                is_1phase_distillation=True,
+                decoder_layer_map=decoder_layer_map,
+                device=device,
+                alpha=CONFIG.ALPHA,
+                beta=CONFIG.BETA,
+                gamma=CONFIG.GAMMA,
+                delta=CONFIG.DELTA,
+            )
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+
+    # Score on the held-out batches
+    student.eval()
+    kl_losses, ce_losses = [], []
+    with torch.no_grad():
+        for batch in heldout_batches:
+            pixel_values, decoder_input_ids, labels = (t.to(device) for t in batch)
+            teacher_outputs = teacher(pixel_values, decoder_input_ids=decoder_input_ids, labels=labels)
+            outputs = student(pixel_values, decoder_input_ids=decoder_input_ids, labels=labels)
+            kl_losses.append(
+                calculate_loss_and_accuracy_distillation(
+                    outputs=outputs,
+                    teacher_outputs=teacher_outputs,
+                    is_first_distillation_phase=False,
+                    is_1phase_distillation=False,
+                    decoder_layer_map=decoder_layer_map,
+                    device=device,
+                ).item()
+            )
+            ce_losses.append(outputs.loss.item())
+
+    student.cpu()
+    return {"proxy_loss": float(np.mean(kl_losses)), "proxy_ce": float(np.mean(ce_losses))}
+
+
+def measure_latency(
+    model: VisionEncoderDecoderModel,
+    pixel_values: torch.Tensor,
+    decoder_input_ids: torch.Tensor,
+    decode_steps: int,
+    repeats: int = 3,
+) -> float:
+    """
+    Measures the mean greedy `generate` latency in milliseconds for exactly `decode_steps` new tokens,
+    so candidates are compared on the same amount of work.
+    """
+    model.eval()
+
+    def generate():
+        with torch.no_grad():
+            model.generate(
+                pixel_values,
+                decoder_input_ids=decoder_input_ids,
+                min_new_tokens=decode_steps,
+                max_new_tokens=decode_steps,
+                num_beams=1,
+                use_cache=True,
+            )
+
+    generate()  # Warmup
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        generate()
+        times.append(1000 * (time.perf_counter() - start))
+    return float(np.mean(times))
+
+
+def _measure_worker(
+    model_dir: str,
+    pixel_values: torch.Tensor,
+    decoder_input_ids: torch.Tensor,
+    decode_steps: int,
+    repeats: int,
+    num_threads: int,
+) -> Dict[str, float]:
+    """
+    Worker: loads only the student, so neither the teacher nor earlier candidates affect
+    its latency and peak memory.
+    """
+    torch.set_num_threads(num_threads)
+    rss_before = cpu_rss_bytes()
+    model = VisionEncoderDecoderModel.from_pretrained(model_dir)
+    latency_ms = measure_latency(model, pixel_values, decoder_input_ids, decode_steps, repeats)
+    # ru_maxrss is in kilobytes on Linux and includes the imports, rss_mb only the model and inference
+    return {
+        "latency_ms": latency_ms,
+        "rss_mb": (cpu_rss_bytes() - rss_before) / 2**20,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def pareto_front(candidates: List[Dict[str, Any]], keys: Tuple[str, str] = ("latency_ms", "proxy_loss")) -> List[Dict[str, Any]]:
+    """
+    Returns the candidates not dominated by any other candidate (lower is better for both keys),
+    sorted by the first key.
+    """
+    front = []
+    best_second = float("inf")
+    for candidate in sorted(candidates, key=lambda c: (c[keys[0]], c[keys[1]])):
+        if candidate[keys[1]] < best_second:
+            front.append(candidate)
+            best_second = candidate[keys[1]]
+    return front
+
+
+def write_config(base_config_path: str, output_path: Path, candidate: Dict[str, Any]):
+    """
+    Writes a copy of the base YAML config with the candidate's layer maps (comments are kept).
+    """
+    with open(base_config_path, "r") as f:
+        text = f.read()
+
+    for key in ("decoder_layer_map", "encoder_layer_map"):
+        line = f"{key}: {json.dumps(candidate[key])}"
+        text, count = re.subn(rf"^{key}:.*$", line, text, flags=re.MULTILINE)
+        if count == 0:
+            text += f"\n{line}\n"
+
+    header = (
+        f"# Architecture search candidate: {candidate['latency_ms']:.1f} ms, proxy loss {candidate['proxy_loss']:.4f}, "
+        f"{candidate['num_parameters'] / 1e6:.1f}M parameters\n"
+    )
+    with open(output_path, "w") as f:
+        f.write(header + text)
+
+
+def search(
+    teacher: VisionEncoderDecoderModel,
+    teacher_config: VisionEncoderDecoderConfig,
+    train_batches: List[Tuple[torch.Tensor, ...]],
+    heldout_batches: List[Tuple[torch.Tensor, ...]],
+    prompt_token_id: int,
+    min_decoder_layers: int = 1,
+    max_decoder_layers: Optional[int] = None,
+    encoder_stage_depths: Optional[Sequence[Sequence[int]]] = None,
+    max_params_ratio: float = 1.0,
+    max_candidates: Optional[int] = None,
+    proxy_steps: int = 0,
+    decode_steps: int = 32,
+    repeats: int = 3,
+    num_threads: int = 1,
+    device: Optional[torch.device] = None,
+    seed: int = 42,
+) -> List[Dict[str, Any]]:
+    """
+    Enumerates student layer maps within a budget and measures each candidate.
+
+    For every candidate the CPU latency (greedy generation of `decode_steps` tokens at batch
+    size 1, in a fresh process with `num_threads` threads), the memory of that process
+    and a quality proxy (see `proxy_loss`) are recorded.
+
+    Args:
+        teacher (VisionEncoderDecoderModel): The teacher.
+        teacher_config (VisionEncoderDecoderConfig): Its configuration.
+        train_batches (List[Tuple[torch.Tensor, ...]]): Teacher-forcing batches for the short distillation.
+        heldout_batches (List[Tuple[torch.Tensor, ...]]): Teacher-forcing batches for scoring.
+        prompt_token_id (int): Task start token the generation starts with.
+        min_decoder_layers (int): Minimum student decoder layers.
+        max_decoder_layers (int, optional): Maximum student decoder layers (default: teacher layers).
+        encoder_stage_depths (Sequence[Sequence[int]], optional): Allowed depths per encoder stage (see `encoder_layer_maps`).
+        max_params_ratio (float): Skip candidates with more than this fraction of the teacher's parameters.
+        max_candidates (int, optional): Evaluate a seeded random sample of this size if there are more candidates.
+        proxy_steps (int): Distillation steps before scoring.
+        decode_steps (int): Generated tokens per latency measurement.
+        repeats (int): Timed generations per candidate.
+        num_threads (int): CPU threads of the measurement process.
+        device (torch.device, optional): Device for the proxy loss (default: CUDA if available).
+        seed (int): Seed for sampling the candidates.
+
+    Returns:
+        List[Dict[str, Any]]: One entry per candidate with the layer maps and measurements.
+    """
+    device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher.eval()
+    teacher.to(device)
+
+    # Enumerate the candidates within the parameter budget
+    teacher_parameters = _num_parameters(teacher)
+    num_teacher_layers = teacher_config.decoder.decoder_layers
+    candidates = []
+    for encoder_layer_map in encoder_layer_maps(teacher_config.encoder.depths, encoder_stage_depths):
+        for decoder_layer_map in decoder_layer_maps(num_teacher_layers, min_decoder_layers, max_decoder_layers):
+            if not encoder_layer_map and len(decoder_layer_map) == num_teacher_layers:
+                continue  # That's the teacher
+            num_parameters = count_parameters(teacher, encoder_layer_map, decoder_layer_map)
+            if num_parameters <= max_params_ratio * teacher_parameters:
+                candidates.append(
+                    {
+                        "encoder_layer_map": encoder_layer_map,
+                        "decoder_layer_map": decoder_layer_map,
+                        "num_parameters": num_parameters,
+                    }
+                )
+
+    if max_candidates is not None and len(candidates) > max_candidates:
+        candidates = random.Random(seed).sample(candidates, max_candidates)
+    print(f"Evaluating {len(candidates)} candidates")
+
+    pixel_values = heldout_batches[0][0][:1].cpu()
+    decoder_input_ids = torch.tensor([[prompt_token_id]])
+    context = multiprocessing.get_context("spawn")
+
+    for idx, candidate in enumerate(candidates):
+        # Without distillation steps the student is never trained and can share the teacher's weights
+        student = build_student(
+            teacher,
+            teacher_config,
+            candidate["encoder_layer_map"],
+            candidate["decoder_layer_map"],
+            share_weights=proxy_steps == 0,
+        )
+
+        # Latency and memory in a fresh process
+        with tempfile.TemporaryDirectory() as model_dir:
+            student.save_pretrained(model_dir)
+            with context.Pool(1) as pool:
+                candidate.update(
+                    pool.apply(
+                        _measure_worker,
+                        (model_dir, pixel_values, decoder_input_ids, decode_steps, repeats, num_threads),
+                    )
+                )
+
+        candidate.update(
+            proxy_loss(
+                student,
+                teacher,
+                train_batches,
+                heldout_batches,
+                candidate["decoder_layer_map"],
+                device,
+                steps=proxy_steps,
+            )
+        )
+        candidate["model_mb"] = sum(p.numel() * p.element_size() for p in student.parameters()) / 2**20
+        print(
+            f"[{idx + 1}/{len(candidates)}] encoder={candidate['encoder_layer_map']} "
+            f"decoder={candidate['decoder_layer_map']}: {candidate['latency_ms']:.1f} ms, "
+            f"proxy loss {candidate['proxy_loss']:.4f}"
+        )
+        del student
+
+    return candidates
+
+
+if __name__ == "__main__":
+    import argparse
+    from donut_distill.config.loader import load_config
+    from donut_distill.models.helpers import prepare_model_and_processor
+    from donut_distill.training.utils import prepare_dataloader
+
+    parser = argparse.ArgumentParser(description="Search student layer maps by measured CPU latency and a distillation proxy")
+    parser.add_argument("--config", help="Distillation config (teacher, dataset), also the template of the output configs", type=str, required=True)
+    parser.add_argument("--output_dir", help="Directory for the report and the Pareto front configs", type=str, default="./result/architecture_search")
+    parser.add_argument("--min_decoder_layers", type=int, default=1)
+    parser.add_argument("--max_decoder_layers", type=int, default=None)
+    parser.add_argument(
+        "--encoder_stage_depths",
+        type=json.loads,
+        default=None,
+        help='Allowed depths per encoder stage as JSON, e.g. "[[2], [2], [6, 10, 14], [2]]" (default: keep the encoder)',
+    )
+    parser.add_argument("--max_params_ratio", type=float, default=1.0, help="Parameter budget relative to the teacher")
+    parser.add_argument("--max_latency_ms", type=float, default=None, help="Latency budget for the reported front")
+    parser.add_argument("--max_candidates", type=int, default=None)
+    parser.add_argument("--proxy_steps", type=int, default=0, help="Distillation steps before scoring each candidate")
+    parser.add_argument("--num_train_batches", type=int, default=2)
+    parser.add_argument("--num_heldout_batches", type=int, default=2)
+    parser.add_argument("--decode_steps", type=int, default=32, help="Generated tokens per latency measurement")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=1, help="CPU threads of the latency measurement")
+    args = parser.parse_args()
+
+    load_config(args.config)
+
+    teacher, processor, teacher_config = prepare_model_and_processor(
+        special_tokens=["<yes/>", "<no/>"], return_config=True, load_teacher=True
+    )
+    train_dataloader, val_dataloader = prepare_dataloader(teacher, processor)
+    teacher_config.decoder.vocab_size = len(processor.tokenizer)
+
+    train_batches = [
+        teacher_forcing_batch(batch, processor)
+        for batch in itertools.islice(train_dataloader, args.num_train_batches)
+    ]
+    heldout_batches = [
+        teacher_forcing_batch(batch, processor)
+        for batch in itertools.islice(val_dataloader, args.num_heldout_batches)
+    ]
+
+    candidates = search(
+        teacher,
+        teacher_config,
+        train_batches,
+        heldout_batches,
+        prompt_token_id=processor.tokenizer.convert_tokens_to_ids("<s_docvqa>"),
+        min_decoder_layers=args.min_decoder_layers,
+        max_decoder_layers=args.max_decoder_layers,
+        encoder_stage_depths=args.encoder_stage_depths,
+        max_params_ratio=args.max_params_ratio,
+        max_candidates=args.max_candidates,
+        proxy_steps=args.proxy_steps,
+        decode_steps=args.decode_steps,
+        repeats=args.repeats,
+        num_threads=args.num_threads,
+    )
+
+    front = pareto_front(candidates)
+    if args.max_latency_ms is not None:
+        front = [candidate for candidate in front if candidate["latency_ms"] <= args.max_latency_ms]
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for rank, candidate in enumerate(front):
+        config_path = output_dir / f"student_{rank:02d}.yaml"
+        write_config(args.config, config_path, candidate)
+        candidate["config"] = str(config_path)
+        print(f"{config_path}: {candidate['latency_ms']:.1f} ms, proxy loss {candidate['proxy_loss']:.4f}")
+
+    with open(output_dir / "search_results.json", "w") as f:
+        json.dump({"candidates": candidates, "pareto_front": front}, f, indent=2)
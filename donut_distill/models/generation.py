@@ -0,0 +1,207 @@
+import re
+from typing import Dict, List, Optional, Tuple
+import torch
+from transformers import (
+    DonutProcessor,
+    LogitsProcessor,
+    LogitsProcessorList,
+    VisionEncoderDecoderModel,
+)
+
+# Matches the structural special tokens created by `json2token`, e.g. <s_answer> and </s_answer>
+SPECIAL_KEY_TOKEN_PATTERN = re.compile(r"^<(/?)s_(.+)>$")
+
+
+def build_structure_schema(processor: DonutProcessor) -> Tuple[Dict[int, str], Dict[int, str]]:
+    """
+    Collects the opening and closing special tokens of the JSON schema from the tokenizer.
+
+    Only keys that were registered with both `<s_key>` and `</s_key>` (as `json2token` does)
+    are part of the schema, so task start tokens like `<s_docvqa>` are ignored.
+
+    Args:
+        processor (DonutProcessor): Processor whose tokenizer holds the added special tokens.
+
+    Returns:
+        Tuple[Dict[int, str], Dict[int, str]]: Token id -> key for opening and for closing tokens.
+    """
+    open_tokens: Dict[str, int] = {}
+    close_tokens: Dict[str, int] = {}
+    for token, token_id in processor.tokenizer.get_added_vocab().items():
+        match = SPECIAL_KEY_TOKEN_PATTERN.match(token)
+        if match is None:
+            continue
+        is_closing, key = match.groups()
+        (close_tokens if is_closing else open_tokens)[key] = token_id
+
+    keys = open_tokens.keys() & close_tokens.keys()
+    return (
+        {open_tokens[key]: key for key in keys},
+        {close_tokens[key]: key for key in keys},
+    )
+
+
+class DonutStructureLogitsProcessor(LogitsProcessor):
+    """
+    Logits processor that keeps generations well-formed `<s_key>...</s_key>` sequences.
+
+    For every sequence the stack of open keys is rebuilt from the tokens generated so far
+    (including the prompt). Then:
+    - only the closing token matching the innermost open key is allowed,
+    - if the top-level structure has just been closed, only EOS is allowed.
+
+    The stack is rebuilt on every step instead of being tracked incrementally, because beam
+    search reorders the rows between steps. With at most `MAX_LENGTH` tokens this is cheap
+    compared to the decoder forward pass.
+
+    Args:
+        processor (DonutProcessor): Processor whose tokenizer holds the schema tokens.
+        eos_token_id (int, optional): EOS token id. Defaults to the tokenizer's EOS token.
+    """
+
+    def __init__(self, processor: DonutProcessor, eos_token_id: Optional[int] = None):
+        self.open_tokens, self.close_tokens = build_structure_schema(processor)
+        self.close_token_ids = torch.tensor(sorted(self.close_tokens), dtype=torch.long)
+        self.close_token_by_key = {key: token_id for token_id, key in self.close_tokens.items()}
+        self.eos_token_id = (
+            eos_token_id if eos_token_id is not None else processor.tokenizer.eos_token_id
+        )
+
+    def open_stack(self, token_ids: List[int]) -> Tuple[List[str], bool]:
+        """
+        Returns the stack of open keys and whether the last token closed the top-level structure.
+        """
+        stack: List[str] = []
+        closed_top_level = False
+        for token_id in token_ids:
+            if token_id in self.open_tokens:
+                stack.append(self.open_tokens[token_id])
+                closed_top_level = False
+            elif token_id in self.close_tokens:
+                if stack and stack[-1] == self.close_tokens[token_id]:
+                    stack.pop()
+                closed_top_level = not stack
+            else:
+                closed_top_level = False
+        return stack, closed_top_level
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if len(self.close_tokens) == 0:
+            return scores
+
+        close_token_ids = self.close_token_ids.to(scores.device)
+        for row, token_ids in enumerate(input_ids.tolist()):
+            stack, closed_top_level = self.open_stack(token_ids)
+
+            if closed_top_level:
+                # The structure is complete, end the generation
+                eos_score = scores[row, self.eos_token_id].clone()
+                scores[row, :] = -float("inf")
+                scores[row, self.eos_token_id] = eos_score if torch.isfinite(eos_score) else 0.0
+                continue
+
+            # Only the closing token of the innermost open key is allowed
+            allowed_close = self.close_token_by_key[stack[-1]] if stack else None
+            banned = close_token_ids[close_token_ids != allowed_close] if allowed_close is not None else close_token_ids
+            scores[row, banned] = -float("inf")
+
+        return scores
+
+
+def _select_batch_rows(past_key_values, row_idx: torch.LongTensor):
+    """
+    Keeps only the given batch rows of a KV-cache (legacy tuples or `Cache` objects).
+    """
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(row_idx)
+        return past_key_values
+    return tuple(
+        tuple(past_state.index_select(0, row_idx) for past_state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+@torch.no_grad()
+def generate_with_early_exit(
+    model: VisionEncoderDecoderModel,
+    pixel_values: torch.Tensor,
+    decoder_input_ids: torch.LongTensor,
+    stop_token_id: int,
+    max_length: int,
+    pad_token_id: int,
+    eos_token_id: int,
+    bad_words_ids: Optional[List[List[int]]] = None,
+    logits_processor: Optional[LogitsProcessorList] = None,
+) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    """
+    Greedy generation that ends a sequence as soon as `stop_token_id` (e.g. `</s_answer>`) or EOS is emitted.
+
+    Finished sequences are removed from the active batch, so the encoder states and the KV-cache
+    shrink and the remaining sequences decode faster.
+
+    Args:
+        model (VisionEncoderDecoderModel): The Donut model.
+        pixel_values (torch.Tensor): Input images.
+        decoder_input_ids (torch.LongTensor): Decoder prompts (batch_size, prompt_length).
+        stop_token_id (int): Token that ends a sequence in addition to EOS.
+        max_length (int): Maximum total length including the prompt.
+        pad_token_id (int): Padding token for finished sequences.
+        eos_token_id (int): EOS token id.
+        bad_words_ids (List[List[int]], optional): Single-token sequences that must not be generated.
+        logits_processor (LogitsProcessorList, optional): Additional logits processors.
+
+    Returns:
+        Tuple[torch.LongTensor, torch.LongTensor]:
+            - sequences (batch_size, <= max_length): Prompts followed by the generated tokens, padded with `pad_token_id`.
+            - decode_steps (batch_size,): Number of generated tokens per sequence.
+    """
+    batch_size, prompt_length = decoder_input_ids.shape
+    device = decoder_input_ids.device
+    banned_ids = [ids[0] for ids in (bad_words_ids or []) if len(ids) == 1]
+    logits_processor = logits_processor or LogitsProcessorList()
+
+    sequences = torch.full((batch_size, max_length), pad_token_id, dtype=torch.long, device=device)
+    sequences[:, :prompt_length] = decoder_input_ids
+    decode_steps = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    # Run the encoder once, only the decoder is stepped
+    encoder_hidden_states = model.encoder(pixel_values=pixel_values, return_dict=True).last_hidden_state
+
+    active_rows = torch.arange(batch_size, device=device)
+    next_input_ids = decoder_input_ids
+    past_key_values = None
+
+    for cur_len in range(prompt_length, max_length):
+        outputs = model(
+            encoder_outputs=(encoder_hidden_states,),
+            decoder_input_ids=next_input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        next_token_logits = outputs.logits[:, -1, :].float()
+        next_token_logits[:, banned_ids] = -float("inf")
+        next_token_logits = logits_processor(sequences[active_rows, :cur_len], next_token_logits)
+        next_tokens = next_token_logits.argmax(dim=-1)
+
+        sequences[active_rows, cur_len] = next_tokens
+        decode_steps[active_rows] += 1
+
+        # Drop finished sequences from the active batch
+        unfinished = (next_tokens != eos_token_id) & (next_tokens != stop_token_id)
+        if not unfinished.any():
+            break
+        if not unfinished.all():
+            keep = unfinished.nonzero().squeeze(-1)
+            active_rows = active_rows[keep]
+            next_tokens = next_tokens[keep]
+            encoder_hidden_states = encoder_hidden_states.index_select(0, keep)
+            past_key_values = _select_batch_rows(outputs.past_key_values, keep)
+        else:
+            past_key_values = outputs.past_key_values
+
+        next_input_ids = next_tokens[:, None]
+
+    # Trim trailing padding shared by all sequences
+    final_length = prompt_length + int(decode_steps.max())
+    return sequences[:, :final_length], decode_steps
@@ -0,0 +1,354 @@
+import itertools
+import json
+import math
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import torch
+from torch import nn
+from transformers import VisionEncoderDecoderConfig, VisionEncoderDecoderModel
+from transformers.pytorch_utils import prune_linear_layer
+
+# Decoder config attribute with the removed heads, e.g. {"self_attn": {"0": [1, 5]}, "encoder_attn": {}}.
+# Head indices refer to the unpruned layer. (`pruned_heads` is avoided on purpose: transformers would
+# call `_prune_heads` when loading, which mBART doesn't implement.)
+PRUNED_HEADS_ATTRIBUTE = "pruned_attention_heads"
+ATTENTION_TYPES = ("self_attn", "encoder_attn")
+
+PrunedHeads = Dict[str, Dict[int, List[int]]]
+
+
+def _decoder_layers(model: VisionEncoderDecoderModel) -> nn.ModuleList:
+    return model.decoder.model.decoder.layers
+
+
+def get_pruned_heads(config) -> PrunedHeads:
+    """
+    Returns the removed heads stored in a decoder config, with integer layer indices.
+    """
+    stored = getattr(config, PRUNED_HEADS_ATTRIBUTE, None) or {}
+    return {
+        attention_type: {int(layer): sorted(heads) for layer, heads in stored.get(attention_type, {}).items() if heads}
+        for attention_type in ATTENTION_TYPES
+    }
+
+
+def remap_pruned_heads(pruned_heads: PrunedHeads, decoder_layer_map: Sequence[int]) -> PrunedHeads:
+    """
+    Renumbers removed heads from teacher layers to the student layers of `decoder_layer_map`.
+    Layer indices may be strings (as in JSON/YAML).
+    """
+    remapped = {}
+    for attention_type in ATTENTION_TYPES:
+        layers = {int(layer): heads for layer, heads in pruned_heads.get(attention_type, {}).items()}
+        remapped[attention_type] = {
+            student_layer: list(layers[teacher_layer])
+            for student_layer, teacher_layer in enumerate(decoder_layer_map)
+            if teacher_layer in layers
+        }
+    return remapped
+
+
+def _prune_attention(attention: nn.Module, heads: Sequence[int]):
+    """
+    Removes heads (indices of the current heads) from an mBART attention by slicing its projections.
+    """
+    keep = [head for head in range(attention.num_heads) if head not in set(heads)]
+    if not keep:
+        raise ValueError("At least one head per attention has to be kept")
+    index = torch.cat(
+        [torch.arange(head * attention.head_dim, (head + 1) * attention.head_dim) for head in keep]
+    ).long()
+
+    attention.q_proj = prune_linear_layer(attention.q_proj, index, dim=0)
+    attention.k_proj = prune_linear_layer(attention.k_proj, index, dim=0)
+    attention.v_proj = prune_linear_layer(attention.v_proj, index, dim=0)
+    attention.out_proj = prune_linear_layer(attention.out_proj, index, dim=1)
+
+    # mBART only uses embed_dim for the concatenated heads (the scaling depends on head_dim)
+    attention.num_heads = len(keep)
+    attention.embed_dim = len(keep) * attention.head_dim
+
+
+def prune_attention_heads(model: VisionEncoderDecoderModel, heads_to_prune: PrunedHeads) -> VisionEncoderDecoderModel:
+    """
+    Physically removes decoder self- and cross-attention heads (in place).
+
+    The q/k/v projections lose the rows and the output projection the columns of the removed
+    heads, so the attention cost shrinks proportionally. The removed heads are recorded in the
+    decoder config (see `PRUNED_HEADS_ATTRIBUTE`), so saved checkpoints can be rebuilt with
+    `load_head_pruned_model`. Heads that were already removed are skipped.
+
+    Args:
+        model (VisionEncoderDecoderModel): The Donut model.
+        heads_to_prune (PrunedHeads): Heads to remove per attention type ("self_attn", "encoder_attn") and
+            layer, indexed as in the unpruned layer.
+
+    Returns:
+        VisionEncoderDecoderModel: The same model with fewer heads.
+    """
+    num_heads = model.config.decoder.decoder_attention_heads
+    pruned_heads = get_pruned_heads(model.config.decoder)
+
+    for attention_type in ATTENTION_TYPES:
+        for layer_idx, heads in heads_to_prune.get(attention_type, {}).items():
+            layer_idx = int(layer_idx)
+            already_pruned = pruned_heads[attention_type].get(layer_idx, [])
+            new_heads = sorted(set(heads) - set(already_pruned))
+            if not new_heads:
+                continue
+
+            # Translate the original head indices to the indices of the remaining heads
+            remaining = [head for head in range(num_heads) if head not in already_pruned]
+            attention = getattr(_decoder_layers(model)[layer_idx], attention_type)
+            _prune_attention(attention, [remaining.index(head) for head in new_heads])
+            pruned_heads[attention_type][layer_idx] = sorted(set(already_pruned) | set(new_heads))
+
+    setattr(
+        model.config.decoder,
+        PRUNED_HEADS_ATTRIBUTE,
+        {
+            attention_type: {str(layer): heads for layer, heads in layers.items()}
+            for attention_type, layers in pruned_heads.items()
+        },
+    )
+    return model
+
+
+def restore_head_pruning(model: VisionEncoderDecoderModel) -> VisionEncoderDecoderModel:
+    """
+    Applies the head pruning stored in the config to a freshly built (unpruned) model, so the
+    weights of a head-pruned checkpoint fit.
+    """
+    pruned_heads = get_pruned_heads(model.config.decoder)
+    setattr(model.config.decoder, PRUNED_HEADS_ATTRIBUTE, None)
+    return prune_attention_heads(model, pruned_heads)
+
+
+def is_head_pruned_checkpoint(model_dir: str | Path) -> bool:
+    """
+    Returns True if the checkpoint's decoder has pruned attention heads.
+    """
+    config_path = Path(model_dir) / "config.json"
+    if not config_path.is_file():
+        return False
+    with open(config_path, "r") as f:
+        pruned_heads = json.load(f).get("decoder", {}).get(PRUNED_HEADS_ATTRIBUTE) or {}
+    return any(pruned_heads.get(attention_type) for attention_type in ATTENTION_TYPES)
+
+
+def load_head_pruned_model(
+    model_dir: str | Path, config: Optional[VisionEncoderDecoderConfig] = None
+) -> VisionEncoderDecoderModel:
+    """
+    Loads a checkpoint with pruned attention heads.
+
+    `from_pretrained` builds all heads and fails on the smaller projections, so the model is built
+    from the config, pruned as recorded there and then filled with the saved weights.
+
+    Args:
+        model_dir (str | Path): Directory containing the checkpoint.
+        config (VisionEncoderDecoderConfig, optional): Config to use instead of the saved one.
+
+    Returns:
+        VisionEncoderDecoderModel: The model.
+    """
+    # Imported here, student.py imports this module
+    from donut_distill.models.student import init_empty_weights
+
+    model_dir = Path(model_dir)
+    config = config or VisionEncoderDecoderConfig.from_pretrained(model_dir)
+    with init_empty_weights():
+        model = VisionEncoderDecoderModel(config=config)
+        restore_head_pruning(model)
+
+    if (model_dir / "model.safetensors").is_file():
+        from safetensors.torch import load_file
+
+        state_dict = load_file(model_dir / "model.safetensors")
+    else:
+        state_dict = torch.load(model_dir / "pytorch_model.bin", map_location="cpu")
+
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    # The tied LM head isn't stored separately
+    missing = [key for key in missing if key != "decoder.lm_head.weight"]
+    if missing or unexpected:
+        raise ValueError(f"Checkpoint doesn't match the pruned model (missing: {missing}, unexpected: {unexpected})")
+    model.decoder.tie_weights()
+    model.eval()
+    return model
+
+
+def compute_head_importance(
+    model: VisionEncoderDecoderModel,
+    batches: Sequence[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+    device: torch.device,
+    normalize: bool = True,
+) -> Dict[str, torch.Tensor]:
+    """
+    Scores every decoder self- and cross-attention head on calibration batches.
+
+    The importance of a head is the expected absolute gradient of the loss with respect to a
+    mask on its output (Michel et al., 2019, "Are Sixteen Heads Really Better than One?"),
+    i.e. the first-order estimate of the loss change when the head is removed.
+
+    Args:
+        model (VisionEncoderDecoderModel): The model to score (unpruned).
+        batches (Sequence[Tuple]): Teacher forcing batches (pixel_values, decoder_input_ids, labels),
+            see `teacher_forcing_batch`.
+        device (torch.device): Device to run on.
+        normalize (bool): Normalize the scores of each layer to unit L2 norm, so layers are comparable.
+
+    Returns:
+        Dict[str, torch.Tensor]: Importance of shape (layers, heads) per attention type.
+    """
+    if any(get_pruned_heads(model.config.decoder)[attention_type] for attention_type in ATTENTION_TYPES):
+        raise ValueError("Head importance can only be computed for models without pruned heads")
+
+    model.to(device)
+    model.eval()
+    num_layers = model.config.decoder.decoder_layers
+    num_heads = model.config.decoder.decoder_attention_heads
+    head_masks = {
+        attention_type: torch.ones(num_layers, num_heads, device=device, requires_grad=True)
+        for attention_type in ATTENTION_TYPES
+    }
+    importance = {attention_type: torch.zeros(num_layers, num_heads, device=device) for attention_type in ATTENTION_TYPES}
+
+    for pixel_values, decoder_input_ids, labels in batches:
+        outputs = model(
+            pixel_values.to(device),
+            decoder_input_ids=decoder_input_ids.to(device),
+            labels=labels.to(device),
+            decoder_head_mask=head_masks["self_attn"],
+            decoder_cross_attn_head_mask=head_masks["encoder_attn"],
+        )
+        # Only the masks need gradients, the parameters are left untouched
+        gradients = torch.autograd.grad(outputs.loss, [head_masks[attention_type] for attention_type in ATTENTION_TYPES])
+        for attention_type, gradient in zip(ATTENTION_TYPES, gradients):
+            importance[attention_type] += gradient.abs().detach()
+
+    for attention_type in ATTENTION_TYPES:
+        importance[attention_type] /= max(1, len(batches))
+        if normalize:
+            norm = importance[attention_type].norm(dim=-1, keepdim=True).clamp_min(1e-20)
+            importance[attention_type] = importance[attention_type] / norm
+    return {attention_type: scores.cpu() for attention_type, scores in importance.items()}
+
+
+def select_heads_to_prune(
+    importance: Dict[str, torch.Tensor],
+    prune_ratio: float,
+    attention_types: Sequence[str] = ATTENTION_TYPES,
+) -> PrunedHeads:
+    """
+    Selects the least important heads across all layers of the given attention types.
+
+    Args:
+        importance (Dict[str, torch.Tensor]): Output of `compute_head_importance`.
+        prune_ratio (float): Fraction of the heads to remove, e.g. 0.25.
+        attention_types (Sequence[str]): Attention types to prune.
+
+    Returns:
+        PrunedHeads: Heads to remove, at least one head per attention is always kept.
+    """
+    candidates = sorted(
+        (float(importance[attention_type][layer, head]), attention_type, layer, head)
+        for attention_type in attention_types
+        for layer in range(importance[attention_type].shape[0])
+        for head in range(importance[attention_type].shape[1])
+    )
+    num_to_prune = int(math.floor(prune_ratio * len(candidates)))
+
+    heads_to_prune: PrunedHeads = {attention_type: {} for attention_type in ATTENTION_TYPES}
+    for _, attention_type, layer, head in candidates:
+        if num_to_prune == 0:
+            break
+        layer_heads = heads_to_prune[attention_type].setdefault(layer, [])
+        if len(layer_heads) + 1 >= importance[attention_type].shape[1]:
+            continue
+        layer_heads.append(head)
+        num_to_prune -= 1
+
+    return {
+        attention_type: {layer: sorted(heads) for layer, heads in layers.items() if heads}
+        for attention_type, layers in heads_to_prune.items()
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import donut_distill.config.config as CONFIG
+    from donut_distill.config.loader import load_config
+    from donut_distill.data.donut_dataset import default_registry
+    from donut_distill.models.architecture_search import measure_latency, teacher_forcing_batch
+    from donut_distill.models.helpers import prepare_model_and_processor
+    from donut_distill.models.quantization import model_size_bytes
+    from donut_distill.training.utils import prepare_dataloader
+
+    parser = argparse.ArgumentParser(description="Score and prune mBART decoder attention heads, optionally recover by distillation")
+    parser.add_argument("--config", help="Config with the model (teacher_model_path) and dataset", type=str, required=True)
+    parser.add_argument("--output_dir", help="Directory for the pruned checkpoint and the report", type=str, required=True)
+    parser.add_argument("--prune_ratio", type=float, default=0.25, help="Fraction of the heads to remove")
+    parser.add_argument("--attention_types", nargs="+", choices=ATTENTION_TYPES, default=list(ATTENTION_TYPES))
+    parser.add_argument("--num_calibration_batches", type=int, default=8)
+    parser.add_argument("--decode_steps", type=int, default=32, help="Generated tokens per latency measurement")
+    parser.add_argument("--num_threads", type=int, default=None, help="Torch intra-op threads of the latency measurement")
+    parser.add_argument("--recover", action="store_true", help="Distill the pruned model from the unpruned one with train()")
+    args = parser.parse_args()
+
+    load_config(args.config)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model, processor = prepare_model_and_processor(special_tokens=["<yes/>", "<no/>"], load_teacher=True)
+    train_dataloader, _ = prepare_dataloader(model, processor)
+    batches = [
+        teacher_forcing_batch(batch, processor)
+        for batch in itertools.islice(train_dataloader, args.num_calibration_batches)
+    ]
+
+    # Step 1: Score the heads
+    importance = compute_head_importance(model, batches, device)
+    heads_to_prune = select_heads_to_prune(importance, args.prune_ratio, args.attention_types)
+
+    # Step 2: Latency before and after pruning (CPU, greedy decoding)
+    model.to("cpu")
+    pixel_values = batches[0][0][:1]
+    prompt_ids = torch.tensor([[processor.tokenizer.convert_tokens_to_ids("<s_docvqa>")]])
+    report = {
+        "heads_to_prune": heads_to_prune,
+        "importance": {attention_type: scores.tolist() for attention_type, scores in importance.items()},
+        "original": {
+            "latency_ms": measure_latency(model, pixel_values, prompt_ids, args.decode_steps),
+            "size_bytes": model_size_bytes(model),
+        },
+    }
+    prune_attention_heads(model, heads_to_prune)
+    report["pruned"] = {
+        "latency_ms": measure_latency(model, pixel_values, prompt_ids, args.decode_steps),
+        "size_bytes": model_size_bytes(model),
+    }
+    report["speedup"] = report["original"]["latency_ms"] / report["pruned"]["latency_ms"]
+
+    # Step 3: Save and reload to make sure the checkpoint is usable
+    output_dir = Path(args.output_dir)
+    model.save_pretrained(output_dir)
+    processor.save_pretrained(output_dir)
+    default_registry.save_pretrained(output_dir)
+    load_head_pruned_model(output_dir)
+
+    print(json.dumps({key: value for key, value in report.items() if key != "importance"}, indent=2))
+    with open(output_dir / "head_pruning_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+    # Step 4: Optionally recover with a distillation run (unpruned teacher, pruned student)
+    if args.recover:
+        from donut_distill.training.train import train
+
+        CONFIG.DISTILL = True
+        CONFIG.DECODER_LAYER_MAP = list(range(model.config.decoder.decoder_layers))
+        CONFIG.ENCODER_LAYER_MAP = []
+        CONFIG.STUDENT_PRUNED_HEADS = heads_to_prune
+        del model
+        train()
@@ -4,6 +4,10 @@ from transformers import (
     VisionEncoderDecoderConfig,
 )
 import donut_distill.config.config as CONFIG
+from donut_distill.data.donut_dataset import SpecialTokenRegistry, default_registry
+from donut_distill.models.head_pruning import is_head_pruned_checkpoint, load_head_pruned_model
+from donut_distill.models.onnx_export import is_onnx_checkpoint
+from donut_distill.models.quantization import is_quantized_checkpoint, load_quantized_model, quantize_model
 from typing import List, Optional, Tuple
 from typing import Dict, List, Optional
 import torch
@@ -14,6 +18,7 @@ def prepare_model_and_processor(
     special_tokens: Optional[List[str]] = None,
     return_config: bool = False,
     load_teacher: bool = False,
+    quantize: bool = False,
 ) -> Tuple[VisionEncoderDecoderModel, DonutProcessor] | Tuple[VisionEncoderDecoderModel, DonutProcessor, VisionEncoderDecoderConfig]:
     """
     Loads and configures the Donut model and processor.
@@ -22,6 +27,8 @@ def prepare_model_and_processor(
         special_tokens (Optional[List[str]]): Additional special tokens to add to the tokenizer.
         return_config (bool): Whether to return the model configuration along with the model and processor.
         load_teacher (bool): If True, loads the teacher model instead of the default model.
+        quantize (bool): If True, applies dynamic int8 quantization for CPU inference
+            (see `donut_distill.models.quantization`). Not meant for training.
 
     Returns:
         Tuple: A tuple containing:
@@ -40,14 +47,27 @@ def prepare_model_and_processor(
 
     # Load processor and model
     processor: DonutProcessor = DonutProcessor.from_pretrained(model_dir)
-    model: VisionEncoderDecoderModel = VisionEncoderDecoderModel.from_pretrained(
-        model_dir, config=donut_config
-    )
-
-    # Add special tokens if provided
-    if special_tokens:
-        add_tokens(model, processor, special_tokens)
-        donut_config.decoder.vocab_size = len(processor.tokenizer)  # Update vocabulary size
+    # Special tokens registered by the datasets the checkpoint was trained with
+    default_registry.add(SpecialTokenRegistry.from_pretrained(model_dir))
+    if is_quantized_checkpoint(model_dir):
+        # The packed int8 weights can't be resized, so special tokens must already be part of the checkpoint
+        model: VisionEncoderDecoderModel = load_quantized_model(model_dir)
+    else:
+        if is_head_pruned_checkpoint(model_dir):
+            model: VisionEncoderDecoderModel = load_head_pruned_model(model_dir, config=donut_config)
+        else:
+            model: VisionEncoderDecoderModel = VisionEncoderDecoderModel.from_pretrained(
+                model_dir, config=donut_config
+            )
+
+        # Add special tokens if provided
+        if special_tokens:
+            add_tokens(model, processor, special_tokens)
+            donut_config.decoder.vocab_size = len(processor.tokenizer)  # Update vocabulary size
+
+        # Quantize after resizing the embeddings
+        if quantize:
+            model = quantize_model(model, quantize_encoder=CONFIG.QUANTIZE_ENCODER)
 
     # Update image processing settings
     processor.image_processor.size = CONFIG.INPUT_SIZE[::-1]  # Reverse (height, width) format
@@ -57,6 +77,41 @@ def prepare_model_and_processor(
     return (model, processor, donut_config) if return_config else (model, processor)
 
 
+def load_inference_model(model_dir: str, quantize: bool = False, num_threads: Optional[int] = None):
+    """
+    Loads a model for inference, picking the backend from the checkpoint directory.
+
+    - Directories with ONNX graphs (see `donut_distill.models.onnx_export`) run on ONNX Runtime.
+    - Directories with a quantized checkpoint are loaded as dynamic int8 model.
+    - Checkpoints with pruned attention heads are rebuilt with `load_head_pruned_model`.
+    - Everything else is loaded with `from_pretrained` and optionally quantized.
+
+    Args:
+        model_dir (str): Path to the checkpoint.
+        quantize (bool): Whether to quantize a regular fp32 checkpoint for CPU inference.
+        num_threads (int, optional): Intra-op threads of the ONNX Runtime sessions. PyTorch models use
+            `torch.set_num_threads` instead.
+
+    Returns:
+        VisionEncoderDecoderModel | OnnxDonutModel: A model exposing `generate`.
+    """
+    if is_onnx_checkpoint(model_dir):
+        # Imported lazily, so onnxruntime is only needed when ONNX checkpoints are used
+        from donut_distill.models.onnx_runtime import OnnxDonutModel
+
+        return OnnxDonutModel.from_pretrained(model_dir, num_threads=num_threads)
+    if is_quantized_checkpoint(model_dir):
+        return load_quantized_model(model_dir)
+
+    if is_head_pruned_checkpoint(model_dir):
+        model = load_head_pruned_model(model_dir)
+    else:
+        model = VisionEncoderDecoderModel.from_pretrained(model_dir)
+    if quantize:
+        model = quantize_model(model, quantize_encoder=CONFIG.QUANTIZE_ENCODER)
+    return model
+
+
 # https://github.com/NielsRogge/Transformers-Tutorials/blob/master/Donut/DocVQA/Fine_tune_Donut_on_DocVQA.ipynb
 def add_tokens(model: VisionEncoderDecoderModel, processor: DonutProcessor, list_of_tokens: List[str]):
     """
@@ -0,0 +1,231 @@
+from pathlib import Path
+from typing import List, Tuple
+import torch
+from torch import nn
+from transformers import DonutProcessor, VisionEncoderDecoderModel
+
+ENCODER_ONNX_NAME = "encoder_model.onnx"
+DECODER_ONNX_NAME = "decoder_model.onnx"
+DECODER_WITH_PAST_ONNX_NAME = "decoder_with_past_model.onnx"
+
+
+def is_onnx_checkpoint(model_dir: str | Path) -> bool:
+    """
+    Returns True if the directory contains graphs exported by `export_onnx`.
+    """
+    return (Path(model_dir) / ENCODER_ONNX_NAME).is_file()
+
+
+def past_key_value_names(num_layers: int, prefix: str, with_cross_attention: bool = True) -> List[str]:
+    """
+    Returns the flattened input/output names of the KV-cache.
+
+    Each decoder layer has a self-attention key/value pair and (optionally) a cross-attention
+    key/value pair, e.g. "present.0.self.key", "present.0.self.value", "present.0.cross.key", ...
+    """
+    names = []
+    for layer_idx in range(num_layers):
+        names += [f"{prefix}.{layer_idx}.self.key", f"{prefix}.{layer_idx}.self.value"]
+        if with_cross_attention:
+            names += [f"{prefix}.{layer_idx}.cross.key", f"{prefix}.{layer_idx}.cross.value"]
+    return names
+
+
+class DonutEncoderWrapper(nn.Module):
+    """
+    Swin encoder including the optional projection into the decoder's hidden size.
+    """
+
+    def __init__(self, model: VisionEncoderDecoderModel):
+        super().__init__()
+        self.encoder = model.encoder
+        self.enc_to_dec_proj = getattr(model, "enc_to_dec_proj", None)
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        encoder_hidden_states = self.encoder(pixel_values=pixel_values, return_dict=True).last_hidden_state
+        if self.enc_to_dec_proj is not None:
+            encoder_hidden_states = self.enc_to_dec_proj(encoder_hidden_states)
+        return encoder_hidden_states
+
+
+class DonutDecoderWrapper(nn.Module):
+    """
+    mBART decoder with a flat KV-cache interface.
+
+    Without past the full cache (self- and cross-attention) is returned. With past only the
+    updated self-attention cache is returned, since the cross-attention cache doesn't change
+    between steps.
+    """
+
+    def __init__(self, model: VisionEncoderDecoderModel, use_past: bool):
+        super().__init__()
+        self.decoder = model.decoder
+        self.use_past = use_past
+
+    def forward(self, input_ids: torch.Tensor, encoder_hidden_states: torch.Tensor, *past_key_values: torch.Tensor):
+        past = None
+        if self.use_past:
+            past = tuple(
+                tuple(past_key_values[i : i + 4]) for i in range(0, len(past_key_values), 4)
+            )
+
+        outputs = self.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            past_key_values=past,
+            use_cache=True,
+            return_dict=True,
+        )
+
+        present = []
+        for layer_past in outputs.past_key_values:
+            present += layer_past[:2] if self.use_past else layer_past
+        return (outputs.logits, *present)
+
+
+def _dummy_inputs(
+    model: VisionEncoderDecoderModel, batch_size: int = 1, prompt_length: int = 2
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Creates dummy pixel values and decoder input ids for tracing.
+    """
+    height, width = model.config.encoder.image_size
+    pixel_values = torch.randn(batch_size, model.config.encoder.num_channels, height, width)
+    input_ids = torch.full(
+        (batch_size, prompt_length), model.config.decoder_start_token_id or 0, dtype=torch.long
+    )
+    return pixel_values, input_ids
+
+
+def export_onnx(
+    model: VisionEncoderDecoderModel,
+    output_dir: str | Path,
+    processor: DonutProcessor = None,
+    opset_version: int = 17,
+):
+    """
+    Exports a Donut (teacher or distilled student) model into three ONNX graphs:
+    - encoder_model.onnx: pixel_values -> encoder_hidden_states
+    - decoder_model.onnx: first decoder pass over the prompt, returns logits and the full KV-cache
+    - decoder_with_past_model.onnx: incremental decoder step consuming and returning the KV-cache
+
+    Args:
+        model (VisionEncoderDecoderModel): The model to export (e.g. as saved by `train()`).
+        output_dir (str | Path): Directory to write the graphs, config and processor to.
+        processor (DonutProcessor, optional): If given, the processor is saved next to the graphs.
+        opset_version (int): ONNX opset version.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    model = model.to("cpu").eval()
+    num_layers = model.config.decoder.decoder_layers
+    pixel_values, input_ids = _dummy_inputs(model)
+
+    with torch.no_grad():
+        # Encoder
+        encoder = DonutEncoderWrapper(model).eval()
+        torch.onnx.export(
+            encoder,
+            (pixel_values,),
+            output_dir / ENCODER_ONNX_NAME,
+            input_names=["pixel_values"],
+            output_names=["encoder_hidden_states"],
+            dynamic_axes={
+                "pixel_values": {0: "batch_size"},
+                "encoder_hidden_states": {0: "batch_size", 1: "encoder_sequence_length"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        encoder_hidden_states = encoder(pixel_values)
+
+        # Decoder without past
+        present_names = past_key_value_names(num_layers, "present")
+        decoder = DonutDecoderWrapper(model, use_past=False).eval()
+        cache_axes = {0: "batch_size", 2: "past_sequence_length"}
+        cross_axes = {0: "batch_size", 2: "encoder_sequence_length"}
+        torch.onnx.export(
+            decoder,
+            (input_ids, encoder_hidden_states),
+            output_dir / DECODER_ONNX_NAME,
+            input_names=["input_ids", "encoder_hidden_states"],
+            output_names=["logits", *present_names],
+            dynamic_axes={
+                "input_ids": {0: "batch_size", 1: "sequence_length"},
+                "encoder_hidden_states": {0: "batch_size", 1: "encoder_sequence_length"},
+                "logits": {0: "batch_size", 1: "sequence_length"},
+                **{
+                    name: cross_axes if ".cross." in name else cache_axes
+                    for name in present_names
+                },
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+        _, *past_key_values = decoder(input_ids, encoder_hidden_states)
+
+        # Decoder with past
+        past_names = past_key_value_names(num_layers, "past_key_values")
+        self_present_names = past_key_value_names(num_layers, "present", with_cross_attention=False)
+        decoder_with_past = DonutDecoderWrapper(model, use_past=True).eval()
+        torch.onnx.export(
+            decoder_with_past,
+            (input_ids[:, -1:], encoder_hidden_states, *past_key_values),
+            output_dir / DECODER_WITH_PAST_ONNX_NAME,
+            input_names=["input_ids", "encoder_hidden_states", *past_names],
+            output_names=["logits", *self_present_names],
+            dynamic_axes={
+                "input_ids": {0: "batch_size"},
+                "encoder_hidden_states": {0: "batch_size", 1: "encoder_sequence_length"},
+                "logits": {0: "batch_size"},
+                **{
+                    name: cross_axes if ".cross." in name else cache_axes
+                    for name in past_names
+                },
+                **{name: {0: "batch_size", 2: "present_sequence_length"} for name in self_present_names},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+    model.config.save_pretrained(output_dir)
+    if processor is not None:
+        processor.save_pretrained(output_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from donut_distill.config.loader import load_config
+    from donut_distill.data.donut_dataset import SpecialTokenRegistry, default_registry
+    from donut_distill.models.onnx_runtime import OnnxDonutModel, check_parity, compare_latency
+    from donut_distill.training.utils import prepare_val_dataloader
+
+    parser = argparse.ArgumentParser(description="Export a Donut checkpoint to ONNX and compare it against PyTorch")
+    parser.add_argument("--config", help="Path to the config file", type=str, default=None)
+    parser.add_argument("--model_path", help="Checkpoint to export (model and processor)", type=str, required=True)
+    parser.add_argument("--output_path", help="Where to save the ONNX graphs", type=str, required=True)
+    parser.add_argument("--num_samples", help="Number of validation samples for the parity and latency check", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.config:
+        load_config(args.config)
+
+    processor = DonutProcessor.from_pretrained(args.model_path)
+    model = VisionEncoderDecoderModel.from_pretrained(args.model_path)
+    default_registry.add(SpecialTokenRegistry.from_pretrained(args.model_path))
+    # The dataset may add tokens and resize the embeddings, so it is built before the graphs are exported
+    val_dataloader = prepare_val_dataloader(model, processor, task="docvqa")
+    export_onnx(model, args.output_path, processor=processor)
+    default_registry.save_pretrained(args.output_path)
+
+    onnx_model = OnnxDonutModel.from_pretrained(args.output_path)
+
+    report = {
+        "parity": check_parity(model, onnx_model, processor, val_dataloader, args.num_samples),
+        "latency": compare_latency(model, onnx_model, processor, val_dataloader, args.num_samples),
+    }
+    print(json.dumps(report, indent=2))
+    with open(Path(args.output_path) / "onnx_report.json", "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,396 @@
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import onnxruntime as ort
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
+from transformers import (
+    DonutProcessor,
+    GenerationConfig,
+    LogitsProcessorList,
+    VisionEncoderDecoderConfig,
+    VisionEncoderDecoderModel,
+)
+from transformers.generation import GenerateEncoderDecoderOutput
+
+from donut_distill.models.onnx_export import (
+    DECODER_ONNX_NAME,
+    DECODER_WITH_PAST_ONNX_NAME,
+    ENCODER_ONNX_NAME,
+    past_key_value_names,
+)
+import donut_distill.config.config as CONFIG
+
+
+def _process_logits(
+    logits_processor: LogitsProcessorList, input_ids: np.ndarray, next_logits: np.ndarray
+) -> np.ndarray:
+    if len(logits_processor) == 0:
+        return next_logits
+    return logits_processor(torch.from_numpy(input_ids), torch.from_numpy(next_logits)).numpy()
+
+
+def _log_softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+class OnnxDonutModel:
+    """
+    Runs exported Donut graphs on ONNX Runtime.
+
+    The class mimics the parts of `VisionEncoderDecoderModel` that are used for inference
+    (`generate`, `eval`, `to`), so it can be passed to `evaluate_docvqa`/`evaluate_funsd`
+    instead of the PyTorch model.
+
+    Args:
+        model_dir (str | Path): Directory written by `export_onnx`.
+        num_threads (int, optional): Intra-op threads for ONNX Runtime. Defaults to ONNX Runtime's choice.
+    """
+
+    def __init__(self, model_dir: str | Path, num_threads: Optional[int] = None):
+        model_dir = Path(model_dir)
+        self.config: VisionEncoderDecoderConfig = VisionEncoderDecoderConfig.from_pretrained(model_dir)
+        self.num_layers = self.config.decoder.decoder_layers
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+
+        providers = ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(str(model_dir / ENCODER_ONNX_NAME), session_options, providers=providers)
+        self.decoder = ort.InferenceSession(str(model_dir / DECODER_ONNX_NAME), session_options, providers=providers)
+        self.decoder_with_past = ort.InferenceSession(
+            str(model_dir / DECODER_WITH_PAST_ONNX_NAME), session_options, providers=providers
+        )
+
+        self.past_names = past_key_value_names(self.num_layers, "past_key_values")
+        # The exporter drops inputs that aren't used, e.g. the encoder states once the cross-attention cache exists
+        self.with_past_input_names = {node.name for node in self.decoder_with_past.get_inputs()}
+
+    @classmethod
+    def from_pretrained(cls, model_dir: str | Path, **kwargs) -> "OnnxDonutModel":
+        return cls(model_dir, **kwargs)
+
+    def eval(self) -> "OnnxDonutModel":
+        return self
+
+    def to(self, device) -> "OnnxDonutModel":
+        # ONNX Runtime sessions always run on the CPU provider
+        return self
+
+    def encode(self, pixel_values: np.ndarray) -> np.ndarray:
+        return self.encoder.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+
+    def _first_step(self, input_ids: np.ndarray, encoder_hidden_states: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+        logits, *past = self.decoder.run(
+            None, {"input_ids": input_ids, "encoder_hidden_states": encoder_hidden_states}
+        )
+        return logits[:, -1, :], past
+
+    def _next_step(
+        self, next_tokens: np.ndarray, encoder_hidden_states: np.ndarray, past: List[np.ndarray]
+    ) -> Tuple[np.ndarray, List[np.ndarray]]:
+        inputs = {"input_ids": next_tokens[:, None], "encoder_hidden_states": encoder_hidden_states}
+        inputs.update(zip(self.past_names, past))
+        inputs = {name: value for name, value in inputs.items() if name in self.with_past_input_names}
+        logits, *self_present = self.decoder_with_past.run(None, inputs)
+
+        # Only the self-attention cache is returned, the cross-attention cache stays the same
+        for layer_idx in range(self.num_layers):
+            past[4 * layer_idx] = self_present[2 * layer_idx]
+            past[4 * layer_idx + 1] = self_present[2 * layer_idx + 1]
+        return logits[:, -1, :], past
+
+    def generate(
+        self,
+        pixel_values: torch.Tensor,
+        decoder_input_ids: torch.Tensor,
+        max_length: Optional[int] = None,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+        bad_words_ids: Optional[List[List[int]]] = None,
+        generation_config: Optional[GenerationConfig] = None,
+        num_beams: Optional[int] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        **kwargs,
+    ) -> GenerateEncoderDecoderOutput:
+        """
+        Greedy or beam search generation with the same arguments `evaluate_docvqa` passes to
+        `model.generate`. Arguments that only affect the output format (`use_cache`,
+        `return_dict_in_generate`, ...) are accepted and ignored.
+        """
+        generation_config = generation_config or GenerationConfig()
+        max_length = max_length or generation_config.max_length or CONFIG.MAX_LENGTH
+        pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
+        eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
+        num_beams = num_beams or generation_config.num_beams or 1
+        banned_ids = [ids[0] for ids in (bad_words_ids or []) if len(ids) == 1]
+        logits_processor = logits_processor or LogitsProcessorList()
+
+        encoder_hidden_states = self.encode(pixel_values.detach().cpu().numpy())
+        input_ids = decoder_input_ids.detach().cpu().numpy().astype(np.int64)
+
+        if num_beams == 1:
+            sequences = self._greedy_search(
+                input_ids, encoder_hidden_states, max_length, pad_token_id, eos_token_id, banned_ids, logits_processor
+            )
+        else:
+            sequences = self._beam_search(
+                input_ids,
+                encoder_hidden_states,
+                max_length,
+                pad_token_id,
+                eos_token_id,
+                banned_ids,
+                logits_processor,
+                num_beams,
+                length_penalty=generation_config.length_penalty,
+                early_stopping=bool(generation_config.early_stopping),
+            )
+
+        return GenerateEncoderDecoderOutput(sequences=torch.from_numpy(sequences))
+
+    def _greedy_search(
+        self,
+        input_ids: np.ndarray,
+        encoder_hidden_states: np.ndarray,
+        max_length: int,
+        pad_token_id: int,
+        eos_token_id: int,
+        banned_ids: List[int],
+        logits_processor: LogitsProcessorList,
+    ) -> np.ndarray:
+        next_logits, past = self._first_step(input_ids, encoder_hidden_states)
+        finished = np.zeros(input_ids.shape[0], dtype=bool)
+
+        while input_ids.shape[1] < max_length:
+            next_logits[:, banned_ids] = -np.inf
+            next_logits = _process_logits(logits_processor, input_ids, next_logits)
+            next_tokens = next_logits.argmax(axis=-1)
+            next_tokens = np.where(finished, pad_token_id, next_tokens)
+
+            input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == eos_token_id
+            if finished.all() or input_ids.shape[1] >= max_length:
+                break
+
+            next_logits, past = self._next_step(next_tokens, encoder_hidden_states, past)
+
+        return input_ids
+
+    def _beam_search(
+        self,
+        input_ids: np.ndarray,
+        encoder_hidden_states: np.ndarray,
+        max_length: int,
+        pad_token_id: int,
+        eos_token_id: int,
+        banned_ids: List[int],
+        logits_processor: LogitsProcessorList,
+        num_beams: int,
+        length_penalty: float = 1.0,
+        early_stopping: bool = True,
+    ) -> np.ndarray:
+        batch_size, prompt_length = input_ids.shape
+
+        # Expand every input to num_beams rows
+        input_ids = np.repeat(input_ids, num_beams, axis=0)
+        encoder_hidden_states = np.repeat(encoder_hidden_states, num_beams, axis=0)
+
+        # Only the first beam is active in the beginning, otherwise all beams would be identical
+        beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+
+        hypotheses: List[List[Tuple[float, np.ndarray]]] = [[] for _ in range(batch_size)]
+        done = np.zeros(batch_size, dtype=bool)
+
+        def hypothesis_score(sum_logprobs: float, length: int) -> float:
+            return sum_logprobs / (max(1, length - prompt_length) ** length_penalty)
+
+        next_logits, past = self._first_step(input_ids, encoder_hidden_states)
+
+        while input_ids.shape[1] < max_length:
+            next_logits[:, banned_ids] = -np.inf
+            next_logits = _process_logits(logits_processor, input_ids, next_logits)
+            vocab_size = next_logits.shape[-1]
+            scores = _log_softmax(next_logits) + beam_scores[:, None]
+            scores = scores.reshape(batch_size, num_beams * vocab_size)
+
+            # Take twice as many candidates, so we still have num_beams after removing finished ones
+            top_k = np.argsort(-scores, axis=1)[:, : 2 * num_beams]
+
+            next_beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+            next_beam_tokens = np.full((batch_size, num_beams), pad_token_id, dtype=np.int64)
+            next_beam_indices = np.zeros((batch_size, num_beams), dtype=np.int64)
+
+            for batch_idx in range(batch_size):
+                if done[batch_idx]:
+                    next_beam_indices[batch_idx] = batch_idx * num_beams
+                    continue
+
+                beam_idx = 0
+                for rank, candidate in enumerate(top_k[batch_idx]):
+                    score = scores[batch_idx, candidate]
+                    source_beam = batch_idx * num_beams + candidate // vocab_size
+                    token = candidate % vocab_size
+
+                    if token == eos_token_id:
+                        if rank >= num_beams:
+                            continue
+                        hypothesis = np.append(input_ids[source_beam], token)
+                        hypotheses[batch_idx].append((hypothesis_score(score, len(hypothesis)), hypothesis))
+                        hypotheses[batch_idx] = sorted(hypotheses[batch_idx], key=lambda h: -h[0])[:num_beams]
+                    else:
+                        next_beam_scores[batch_idx, beam_idx] = score
+                        next_beam_tokens[batch_idx, beam_idx] = token
+                        next_beam_indices[batch_idx, beam_idx] = source_beam
+                        beam_idx += 1
+
+                    if beam_idx == num_beams:
+                        break
+
+                # Check whether the search for this input is finished
+                if len(hypotheses[batch_idx]) >= num_beams:
+                    if early_stopping:
+                        done[batch_idx] = True
+                    else:
+                        best_open = next_beam_scores[batch_idx].max()
+                        worst_closed = hypotheses[batch_idx][-1][0]
+                        done[batch_idx] = hypothesis_score(best_open, input_ids.shape[1] + 1) <= worst_closed
+
+            beam_indices = next_beam_indices.reshape(-1)
+            beam_scores = next_beam_scores.reshape(-1)
+            next_tokens = next_beam_tokens.reshape(-1)
+            input_ids = np.concatenate([input_ids[beam_indices], next_tokens[:, None]], axis=1)
+
+            if done.all() or input_ids.shape[1] >= max_length:
+                break
+
+            past = [layer_past[beam_indices] for layer_past in past]
+            next_logits, past = self._next_step(next_tokens, encoder_hidden_states, past)
+
+        # Inputs without enough finished hypotheses keep their best open beams
+        for batch_idx in range(batch_size):
+            if done[batch_idx]:
+                continue
+            for beam_idx in range(num_beams):
+                row = batch_idx * num_beams + beam_idx
+                hypotheses[batch_idx].append((hypothesis_score(beam_scores[row], input_ids.shape[1]), input_ids[row]))
+
+        best = [max(batch_hypotheses, key=lambda h: h[0])[1] for batch_hypotheses in hypotheses]
+        sequences = np.full((batch_size, max(len(seq) for seq in best)), pad_token_id, dtype=np.int64)
+        for batch_idx, sequence in enumerate(best):
+            sequences[batch_idx, : len(sequence)] = sequence
+        return sequences
+
+
+def _iterate_prompts(val_dataloader: DataLoader, num_samples: int) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Yields pixel values and decoder prompts (up to the prompt end token) like `evaluate_docvqa` builds them.
+    """
+    seen = 0
+    for pixel_values, decoder_input_ids, prompt_end_idxs, _ in val_dataloader:
+        decoder_prompts = pad_sequence(
+            [
+                input_id[: end_idx + 1]
+                for input_id, end_idx in zip(decoder_input_ids, prompt_end_idxs)
+            ],
+            batch_first=True,
+        )
+        yield pixel_values, decoder_prompts
+
+        seen += pixel_values.shape[0]
+        if seen >= num_samples:
+            break
+
+
+def _generate(model, processor: DonutProcessor, pixel_values: torch.Tensor, decoder_prompts: torch.Tensor, generation_config: GenerationConfig):
+    with torch.no_grad():
+        return model.generate(
+            pixel_values,
+            decoder_input_ids=decoder_prompts,
+            max_length=CONFIG.MAX_LENGTH,
+            pad_token_id=processor.tokenizer.pad_token_id,
+            eos_token_id=processor.tokenizer.eos_token_id,
+            use_cache=True,
+            bad_words_ids=[[processor.tokenizer.unk_token_id]],
+            return_dict_in_generate=True,
+            generation_config=generation_config,
+        ).sequences
+
+
+def check_parity(
+    model: VisionEncoderDecoderModel,
+    onnx_model: OnnxDonutModel,
+    processor: DonutProcessor,
+    val_dataloader: DataLoader,
+    num_samples: int = 8,
+    num_beams: int = 1,
+) -> Dict[str, float]:
+    """
+    Compares the generated sequences of ONNX Runtime and `model.generate`.
+
+    Returns:
+        Dict[str, float]: Fraction of samples with identical sequences and of identical decoded strings.
+    """
+    model.to("cpu").eval()
+    generation_config = GenerationConfig(early_stopping=True, num_beams=num_beams)
+
+    exact_sequences, exact_strings, total = 0, 0, 0
+    for pixel_values, decoder_prompts in _iterate_prompts(val_dataloader, num_samples):
+        expected = _generate(model, processor, pixel_values, decoder_prompts, generation_config)
+        actual = _generate(onnx_model, processor, pixel_values, decoder_prompts, generation_config)
+
+        for expected_seq, actual_seq in zip(
+            processor.tokenizer.batch_decode(expected, skip_special_tokens=True),
+            processor.tokenizer.batch_decode(actual, skip_special_tokens=True),
+        ):
+            exact_strings += int(expected_seq == actual_seq)
+        for expected_ids, actual_ids in zip(expected, actual):
+            length = max(len(expected_ids), len(actual_ids))
+            expected_ids = torch.nn.functional.pad(expected_ids, (0, length - len(expected_ids)), value=processor.tokenizer.pad_token_id)
+            actual_ids = torch.nn.functional.pad(actual_ids, (0, length - len(actual_ids)), value=processor.tokenizer.pad_token_id)
+            exact_sequences += int(torch.equal(expected_ids, actual_ids))
+        total += len(expected)
+
+    return {
+        "parity/exact_sequences": exact_sequences / max(1, total),
+        "parity/exact_strings": exact_strings / max(1, total),
+    }
+
+
+def compare_latency(
+    model: VisionEncoderDecoderModel,
+    onnx_model: OnnxDonutModel,
+    processor: DonutProcessor,
+    val_dataloader: DataLoader,
+    num_samples: int = 8,
+    num_beams: int = 1,
+) -> Dict[str, float]:
+    """
+    Measures the average generation latency per sample of PyTorch and ONNX Runtime on CPU.
+    """
+    model.to("cpu").eval()
+    generation_config = GenerationConfig(early_stopping=True, num_beams=num_beams)
+    batches = list(_iterate_prompts(val_dataloader, num_samples))
+    total = sum(pixel_values.shape[0] for pixel_values, _ in batches)
+
+    results = {}
+    for name, backend in (("pytorch", model), ("onnxruntime", onnx_model)):
+        # Warmup
+        _generate(backend, processor, *batches[0], generation_config)
+
+        start = time.perf_counter()
+        for pixel_values, decoder_prompts in batches:
+            _generate(backend, processor, pixel_values, decoder_prompts, generation_config)
+        results[f"latency/{name}_seconds_per_sample"] = (time.perf_counter() - start) / total
+
+    results["latency/speedup"] = (
+        results["latency/pytorch_seconds_per_sample"] / results["latency/onnxruntime_seconds_per_sample"]
+    )
+    return results
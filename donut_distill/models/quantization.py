@@ -0,0 +1,211 @@
+import io
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import torch
+from torch import nn
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+from transformers import (
+    DonutProcessor,
+    GenerationConfig,
+    VisionEncoderDecoderConfig,
+    VisionEncoderDecoderModel,
+)
+import donut_distill.config.config as CONFIG
+from donut_distill.models.head_pruning import restore_head_pruning
+
+QUANTIZED_WEIGHTS_NAME = "quantized_model.pt"
+QUANTIZATION_CONFIG_NAME = "quantization.json"
+
+
+def _encoder_mlp_module_names(model: VisionEncoderDecoderModel) -> List[str]:
+    """
+    Collect the names of the MLP projections (intermediate and output dense layers)
+    of every Swin block in the encoder.
+    """
+    names = []
+    for name, module in model.encoder.named_modules():
+        if not isinstance(module, nn.Linear) or "attention" in name:
+            continue
+        if name.endswith("intermediate.dense") or name.endswith("output.dense"):
+            names.append(f"encoder.{name}")
+    return names
+
+
+def quantize_model(
+    model: VisionEncoderDecoderModel,
+    quantize_encoder: bool = False,
+    dtype: torch.dtype = torch.qint8,
+) -> VisionEncoderDecoderModel:
+    """
+    Applies dynamic int8 quantization for CPU inference.
+
+    All `Linear` layers of the mBART decoder (including the LM head) are quantized.
+    Optionally the MLPs of the Swin encoder blocks are quantized as well; attention
+    projections of the encoder stay in fp32 because they are sensitive to quantization.
+
+    Args:
+        model (VisionEncoderDecoderModel): The fp32 model. It is moved to CPU and quantized in place.
+        quantize_encoder (bool): Whether to quantize the encoder MLPs as well.
+        dtype (torch.dtype): Quantized weight type (default: torch.qint8).
+
+    Returns:
+        VisionEncoderDecoderModel: The quantized model (CPU only).
+    """
+    model.to("cpu")
+    model.eval()
+
+    qconfig_spec = {"decoder": default_dynamic_qconfig}
+    if quantize_encoder:
+        for name in _encoder_mlp_module_names(model):
+            qconfig_spec[name] = default_dynamic_qconfig
+
+    return quantize_dynamic(model, qconfig_spec=qconfig_spec, dtype=dtype, inplace=True)
+
+
+def save_quantized_model(
+    model: VisionEncoderDecoderModel,
+    save_directory: str | Path,
+    quantize_encoder: bool = False,
+    processor: Optional[DonutProcessor] = None,
+):
+    """
+    Saves a dynamically quantized model.
+
+    `save_pretrained` can't serialize the packed int8 weights, so the state dict is stored with
+    `torch.save` next to the model config and the quantization settings.
+
+    Args:
+        model (VisionEncoderDecoderModel): The quantized model.
+        save_directory (str | Path): Output directory.
+        quantize_encoder (bool): Whether the encoder MLPs were quantized.
+        processor (Optional[DonutProcessor]): If given, the processor is saved as well.
+    """
+    save_directory = Path(save_directory)
+    save_directory.mkdir(parents=True, exist_ok=True)
+
+    model.config.save_pretrained(save_directory)
+    torch.save(model.state_dict(), save_directory / QUANTIZED_WEIGHTS_NAME)
+    with open(save_directory / QUANTIZATION_CONFIG_NAME, "w") as f:
+        json.dump({"dtype": "qint8", "quantize_encoder": quantize_encoder}, f)
+
+    if processor is not None:
+        processor.save_pretrained(save_directory)
+
+
+def is_quantized_checkpoint(model_dir: str | Path) -> bool:
+    """
+    Returns True if the directory contains a checkpoint saved by `save_quantized_model`.
+    """
+    return (Path(model_dir) / QUANTIZATION_CONFIG_NAME).is_file()
+
+
+def load_quantized_model(model_dir: str | Path) -> VisionEncoderDecoderModel:
+    """
+    Loads a checkpoint saved by `save_quantized_model`.
+
+    The fp32 architecture is built from the saved config, quantized with the stored settings
+    and then filled with the saved int8 weights.
+
+    Args:
+        model_dir (str | Path): Directory containing the quantized checkpoint.
+
+    Returns:
+        VisionEncoderDecoderModel: The quantized model (CPU only).
+    """
+    model_dir = Path(model_dir)
+    with open(model_dir / QUANTIZATION_CONFIG_NAME, "r") as f:
+        quantization_config: Dict[str, Any] = json.load(f)
+
+    config = VisionEncoderDecoderConfig.from_pretrained(model_dir)
+    model = VisionEncoderDecoderModel(config=config)
+    # Checkpoints with pruned attention heads have smaller projections
+    restore_head_pruning(model)
+    model = quantize_model(model, quantize_encoder=quantization_config["quantize_encoder"])
+
+    state_dict = torch.load(model_dir / QUANTIZED_WEIGHTS_NAME, map_location="cpu")
+    model.load_state_dict(state_dict, strict=True)
+    model.eval()
+
+    return model
+
+
+def model_size_bytes(model: nn.Module) -> int:
+    """
+    Returns the serialized size of the model's state dict in bytes.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def evaluate_with_latency(model, processor, val_dataloader, task: str) -> Dict[str, float]:
+    """
+    Runs the task evaluation on CPU and measures the average wall time per sample.
+    """
+    from donut_distill.evaluation.evaluate import evaluate_docvqa, evaluate_funsd
+
+    generation_config = GenerationConfig(early_stopping=True, num_beams=1)
+    evaluate_fn = evaluate_docvqa if task == "docvqa" else evaluate_funsd
+
+    start = time.perf_counter()
+    results = evaluate_fn(
+        model=model,
+        processor=processor,
+        device=torch.device("cpu"),
+        val_dataloader=val_dataloader,
+        generation_config=generation_config,
+    )
+    elapsed = time.perf_counter() - start
+
+    # evaluate_docvqa only walks a fraction of the validation batches
+    num_batches = len(val_dataloader)
+    if task == "docvqa":
+        num_batches = max(1, int(num_batches * CONFIG.LIMIT_VAL_BATCHES))
+    num_samples = min(len(val_dataloader.dataset), num_batches * val_dataloader.batch_size)
+
+    results = {key: float(value) for key, value in results.items()}
+    results["latency/seconds_per_sample"] = elapsed / num_samples
+    results["size/bytes"] = model_size_bytes(model)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    from donut_distill.config.loader import load_config
+    from donut_distill.training.utils import prepare_val_dataloader
+
+    parser = argparse.ArgumentParser(description="Quantize a Donut model and compare it against the fp32 baseline on CPU")
+    parser.add_argument("--config", help="Path to the config file", type=str, default=None)
+    parser.add_argument("--model_path", help="Checkpoint to quantize (model and processor)", type=str, required=True)
+    parser.add_argument("--output_path", help="Where to save the quantized checkpoint", type=str, required=True)
+    parser.add_argument("--task", choices=["docvqa", "funsd"], default="docvqa")
+    parser.add_argument("--quantize_encoder", action="store_true", help="Also quantize the Swin encoder MLPs")
+    args = parser.parse_args()
+
+    if args.config:
+        load_config(args.config)
+
+    processor = DonutProcessor.from_pretrained(args.model_path)
+    model = VisionEncoderDecoderModel.from_pretrained(args.model_path)
+    model.eval()
+
+    val_dataloader = prepare_val_dataloader(model, processor, task=args.task)
+
+    # fp32 baseline
+    report = {"fp32": evaluate_with_latency(model, processor, val_dataloader, args.task)}
+
+    # Quantize, save and reload to make sure the saved checkpoint is usable
+    model = quantize_model(model, quantize_encoder=args.quantize_encoder)
+    save_quantized_model(model, args.output_path, quantize_encoder=args.quantize_encoder, processor=processor)
+    model = load_quantized_model(args.output_path)
+
+    report["int8"] = evaluate_with_latency(model, processor, val_dataloader, args.task)
+    report["speedup"] = (
+        report["fp32"]["latency/seconds_per_sample"] / report["int8"]["latency/seconds_per_sample"]
+    )
+
+    print(json.dumps(report, indent=2))
+    with open(Path(args.output_path) / "quantization_report.json", "w") as f:
+        json.dump(report, f, indent=2)
@@ -1,12 +1,28 @@
+import math
+from contextlib import contextmanager
 from copy import deepcopy
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from transformers import (
+    DonutProcessor,
     VisionEncoderDecoderModel,
     VisionEncoderDecoderConfig,
 )
+from transformers.modeling_utils import no_init_weights
 import re
 import donut_distill.config.config as CONFIG
+from donut_distill.models.head_pruning import (
+    PRUNED_HEADS_ATTRIBUTE,
+    get_pruned_heads,
+    remap_pruned_heads,
+    restore_head_pruning,
+)
 import torch
+from torch import nn
+import torch.nn.functional as F
+
+# Keys of the full VisionEncoderDecoderModel state dict
+ENCODER_BLOCK_PATTERN = re.compile(r"^(encoder\.encoder\.layers\.)(\d+)(\.blocks\.)(\d+)(\..+)$")
+DECODER_LAYER_PATTERN = re.compile(r"^(decoder\.model\.decoder\.layers\.)(\d+)(\..+)$")
 
 def copy_encoder_layers(
     student_encoder_state_dict: Dict[str, torch.Tensor],
@@ -125,11 +141,174 @@ def print_config(config, indent=0):
         print(f"{spacing}{config}")
 
 
+@contextmanager
+def init_empty_weights():
+    """
+    Creates all parameters registered inside the context on the meta device and skips the weight
+    initialization, so building a model neither allocates nor initializes its weights. Buffers
+    (e.g. Swin's relative position indices) are small and still created normally.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module: nn.Module, name: str, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            parameter = module._parameters[name]
+            module._parameters[name] = nn.Parameter(
+                parameter.to("meta"), requires_grad=parameter.requires_grad
+            )
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        with no_init_weights():
+            yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def teacher_key(
+    student_key: str,
+    encoder_layer_map: List[List[int]],
+    decoder_layer_map: List[int],
+) -> str:
+    """
+    Maps a key of the student's state dict to the teacher key its tensor comes from.
+
+    Args:
+        student_key (str): Key of the student's (full model) state dict.
+        encoder_layer_map (List[List[int]]): Teacher blocks (1-indexed) per encoder stage, empty to keep the encoder.
+        decoder_layer_map (List[int]): Teacher decoder layer of each student layer.
+
+    Returns:
+        str: The teacher key.
+    """
+    m = DECODER_LAYER_PATTERN.match(student_key)
+    if m:
+        prefix, s_layer_str, suffix = m.groups()
+        return f"{prefix}{decoder_layer_map[int(s_layer_str)]}{suffix}"
+
+    m = ENCODER_BLOCK_PATTERN.match(student_key)
+    if m and encoder_layer_map:
+        prefix, stage_str, block_prefix, s_block_str, suffix = m.groups()
+        # The encoder mapping is 1-indexed
+        t_block_idx = encoder_layer_map[int(stage_str)][int(s_block_str)] - 1
+        return f"{prefix}{stage_str}{block_prefix}{t_block_idx}{suffix}"
+
+    # Embeddings, norms, patch merging, lm_head, ... are the same in both models
+    return student_key
+
+
+def interpolate_relative_position_bias(bias_table: torch.Tensor, window_size: int) -> torch.Tensor:
+    """
+    Resizes a Swin relative position bias table ((2W-1)^2, heads) to another window size
+    by bicubic interpolation over the (2W-1) x (2W-1) grid of relative offsets.
+    """
+    num_heads = bias_table.shape[1]
+    teacher_side = math.isqrt(bias_table.shape[0])
+    student_side = 2 * window_size - 1
+    grid = bias_table.T.reshape(1, num_heads, teacher_side, teacher_side).float()
+    grid = F.interpolate(grid, size=(student_side, student_side), mode="bicubic", align_corners=False)
+    return grid.reshape(num_heads, student_side * student_side).T.contiguous().to(bias_table.dtype)
+
+
+def _adapt_teacher_tensor(s_key: str, s_tensor: torch.Tensor, t_tensor: torch.Tensor) -> Optional[torch.Tensor]:
+    """
+    Adapts a teacher tensor whose shape depends on the window size. Returns None if it can't be adapted.
+    """
+    if s_key.endswith("relative_position_bias_table"):
+        return interpolate_relative_position_bias(t_tensor, (math.isqrt(s_tensor.shape[0]) + 1) // 2)
+    if s_key.endswith("relative_position_index"):
+        # Only depends on the window size, the student computed its own
+        return s_tensor.to(t_tensor.device)
+    return None
+
+
+def build_student_from_teacher(
+    teacher: VisionEncoderDecoderModel,
+    config: VisionEncoderDecoderConfig,
+    encoder_layer_map: List[List[int]],
+    decoder_layer_map: List[int],
+    share_weights: bool = False,
+) -> VisionEncoderDecoderModel:
+    """
+    Builds a student with `config` whose weights are taken directly from the teacher.
+
+    The student is instantiated on the meta device (no allocation, no random init) and every
+    parameter is materialized from the mapped teacher tensor, so peak memory is the teacher plus
+    the selected student weights. With `share_weights` the student even uses the teacher's
+    storage and costs no extra memory. That's only safe as long as neither model is trained
+    (e.g. for latency measurements or serving), since an optimizer step on one changes the other.
+
+    The student ends up on the device and in the dtype of the teacher.
+
+    Args:
+        teacher (VisionEncoderDecoderModel): The teacher model.
+        config (VisionEncoderDecoderConfig): Configuration of the student.
+        encoder_layer_map (List[List[int]]): Teacher blocks (1-indexed) per encoder stage, empty to keep the encoder.
+        decoder_layer_map (List[int]): Teacher decoder layer of each student layer.
+        share_weights (bool): Share the storage with the teacher instead of copying.
+
+    Returns:
+        VisionEncoderDecoderModel: The student.
+
+    Tensors that depend on the Swin window size (relative position bias tables and indices)
+    are interpolated or recomputed if the student uses another window size. If the teacher has
+    pruned attention heads (see `donut_distill.models.head_pruning`), the student layers keep
+    the heads of their teacher layers.
+
+    Raises:
+        ValueError: If there is a shape mismatch between the student and teacher tensors.
+        KeyError: If a teacher key is not found in the teacher state dict.
+    """
+    # Pruned heads are recorded per teacher layer
+    setattr(
+        config.decoder,
+        PRUNED_HEADS_ATTRIBUTE,
+        remap_pruned_heads(get_pruned_heads(config.decoder), decoder_layer_map),
+    )
+    with init_empty_weights():
+        student = VisionEncoderDecoderModel(config=config)
+        restore_head_pruning(student)
+
+    # state_dict() returns views of the teacher's tensors, nothing is copied here
+    t_state_dict = teacher.state_dict()
+    s_state_dict = {}
+    for s_key, s_tensor in student.state_dict().items():
+        t_key = teacher_key(s_key, encoder_layer_map, decoder_layer_map)
+        if t_key not in t_state_dict:
+            raise KeyError(f"Teacher key {t_key} not found in teacher state dict")
+        t_tensor = t_state_dict[t_key]
+        if s_tensor.shape != t_tensor.shape:
+            adapted = _adapt_teacher_tensor(s_key, s_tensor, t_tensor)
+            if adapted is None:
+                raise ValueError(
+                    f"Shape mismatch: Student key {s_key} {s_tensor.shape} and Teacher key {t_key} {t_tensor.shape} don't match."
+                )
+            s_state_dict[s_key] = adapted
+        else:
+            s_state_dict[s_key] = t_tensor if share_weights else t_tensor.clone()
+
+    # assign=True replaces the meta parameters instead of copying into them
+    student.load_state_dict(s_state_dict, strict=True, assign=True)
+    # Separate copies of tied weights (lm_head/embed_tokens) must be tied again
+    student.decoder.tie_weights()
+    # Non-persistent buffers were created on the CPU
+    student.to(next(teacher.parameters()).device)
+
+    if CONFIG.VERBOSE:
+        print(
+            f"Created student with encoder map {encoder_layer_map or 'unchanged'} and decoder map {decoder_layer_map} "
+            f"({'shared with' if share_weights else 'copied from'} the teacher)"
+        )
+    return student
+
+
 def create_student_small_with_encoder(
     teacher: VisionEncoderDecoderModel,
     teacher_config: VisionEncoderDecoderConfig,
     encoder_layer_map: List[List[int]],  # e.g. [[1,2], [1,2], [1,2,4,5,7,8,10,11,13,14], [1,2]] (Teacher: [2,2,14,2])
     decoder_layer_map: List[int],  # Maps teacher's decoder layers to the student (Teacher has 4 layers)
+    share_weights: bool = False,
 ) -> VisionEncoderDecoderModel:
     """
     Creates a smaller student model by selecting and copying layers from the teacher model.
@@ -140,6 +319,7 @@ def create_student_small_with_encoder(
         teacher_config (VisionEncoderDecoderConfig): The configuration of the teacher model.
         encoder_layer_map (List[List[int]]): Mapping of teacher encoder layers to student layers.
         decoder_layer_map (List[int]): Mapping of teacher decoder layers to student layers.
+        share_weights (bool): Share the teacher's storage instead of copying (see `build_student_from_teacher`).
 
     Returns:
         VisionEncoderDecoderModel: A smaller student model with selected layers from the teacher.
@@ -154,27 +334,7 @@ def create_student_small_with_encoder(
     config.decoder.decoder_layers = len(decoder_layer_map)
     config.encoder.depths = [len(mapping) for mapping in encoder_layer_map]
 
-    student = VisionEncoderDecoderModel(config=config)
-
-    # Get state dictionaries for weight transfer
-    t_state_dict = teacher.state_dict()
-    t_encoder_state_dict = teacher.encoder.state_dict()
-    t_decoder_state_dict = teacher.decoder.state_dict()
-
-    # Load all available weights from teacher into student (some layers will be missing)
-    student.load_state_dict(t_state_dict, strict=False)
-
-    # Copy selected encoder block weights based on the provided mapping
-    s_encoder_state_dict = student.encoder.state_dict()
-    copy_encoder_layers(s_encoder_state_dict, t_encoder_state_dict, encoder_layer_map)
-    student.encoder.load_state_dict(s_encoder_state_dict, strict=True)
-
-    # Copy selected decoder weights based on the provided mapping
-    s_decoder_state_dict = student.decoder.state_dict()
-    copy_decoder_layers(s_decoder_state_dict, t_decoder_state_dict, decoder_layer_map)
-    student.decoder.load_state_dict(s_decoder_state_dict, strict=True)
-
-    return student
+    return build_student_from_teacher(teacher, config, encoder_layer_map, decoder_layer_map, share_weights)
 
 
 def create_student_small(
@@ -182,16 +342,19 @@ def create_student_small(
     teacher_config: VisionEncoderDecoderConfig,
     encoder_layer_map: List[List[int]],  # e.g. [[1,2], [1,2], [1,2,4,5,7,8,10,11,13,14], [1,2]] (Teacher: [2,2,14,2])
     decoder_layer_map: List[int],  # Maps teacher's decoder layers to the student (Teacher has 4 layers)
+    share_weights: bool = False,
 ) -> VisionEncoderDecoderModel:
     """
     Creates a smaller student model by selecting and copying layers from the teacher model.
     This function does NOT perform distillation, it only initializes a reduced version of the model.
+    The encoder is kept as is.
 
     Args:
         teacher (VisionEncoderDecoderModel): The pre-trained teacher model.
         teacher_config (VisionEncoderDecoderConfig): The configuration of the teacher model.
-        encoder_layer_map (List[List[int]]): Mapping of teacher encoder layers to student layers.
+        encoder_layer_map (List[List[int]]): Unused, the encoder is copied completely.
         decoder_layer_map (List[int]): Mapping of teacher decoder layers to student layers.
+        share_weights (bool): Share the teacher's storage instead of copying (see `build_student_from_teacher`).
 
     Returns:
         VisionEncoderDecoderModel: A smaller student model with selected layers from the teacher.
@@ -205,32 +368,116 @@ def create_student_small(
     # Reduce the number of decoder layers according to the provided mapping
     config.decoder.decoder_layers = len(decoder_layer_map)
 
-    student = VisionEncoderDecoderModel(config=config)
+    return build_student_from_teacher(teacher, config, [], decoder_layer_map, share_weights)
 
-    # Get state dictionaries for weight transfer
-    t_state_dict = teacher.state_dict()
-    t_encoder_state_dict = teacher.encoder.state_dict()
-    t_decoder_state_dict = teacher.decoder.state_dict()
+def scaled_input_size(input_size: List[int], input_scale: float) -> List[int]:
+    """
+    Scales an image size, rounded to a multiple of 32 (the total downsampling of the Swin encoder).
+    """
+    return [max(32, int(round(size * input_scale / 32)) * 32) for size in input_size]
 
-    # Load all available weights from teacher into student (some layers will be missing)
-    student.load_state_dict(t_state_dict, strict=False)
 
-    # Get the newly initialized student decoder state dict
-    s_decoder_state_dict = student.decoder.state_dict()
+def scale_pixel_values(pixel_values: torch.Tensor, input_scale: float) -> torch.Tensor:
+    """
+    Resizes a batch of preprocessed images to the working resolution of a reduced student.
+    The padded canvas is scaled as a whole, so the document layout is the same as the teacher's.
+    """
+    if input_scale == 1:
+        return pixel_values
+    size = scaled_input_size(list(pixel_values.shape[-2:]), input_scale)
+    return F.interpolate(pixel_values, size=size, mode="bilinear", align_corners=False, antialias=True)
+
+
+def scaled_processor(processor: DonutProcessor, input_scale: float) -> DonutProcessor:
+    """
+    Returns a copy of the processor that produces images at the student's working resolution.
+    """
+    processor = deepcopy(processor)
+    size = processor.image_processor.size
+    if isinstance(size, dict):
+        height, width = scaled_input_size([size["height"], size["width"]], input_scale)
+        processor.image_processor.size = {"height": height, "width": width}
+    else:
+        processor.image_processor.size = scaled_input_size(list(size), input_scale)
+    return processor
 
-    # Copy selected decoder weights based on the provided mapping
-    copy_decoder_layers(s_decoder_state_dict, t_decoder_state_dict, decoder_layer_map)
 
-    # Load the exact encoder weights from the teacher
-    student.encoder.load_state_dict(t_encoder_state_dict, strict=True)
+def swin_output_grid(encoder_config, height: int, width: int) -> Tuple[int, int]:
+    """
+    Returns the (height, width) grid of the last Swin stage for an input image of `height` x `width`.
+    Odd sizes are padded before each patch merging.
+    """
+    height, width = math.ceil(height / encoder_config.patch_size), math.ceil(width / encoder_config.patch_size)
+    for _ in range(len(encoder_config.depths) - 1):
+        height, width = math.ceil(height / 2), math.ceil(width / 2)
+    return height, width
 
-    # Load the modified decoder weights into the student model
-    student.decoder.load_state_dict(s_decoder_state_dict, strict=True)
 
-    return student
+def create_student_reduced_resolution(
+    teacher: VisionEncoderDecoderModel,
+    teacher_config: VisionEncoderDecoderConfig,
+    input_scale: float,
+    window_size: Optional[int] = None,
+    encoder_layer_map: Optional[List[List[int]]] = None,
+    decoder_layer_map: Optional[List[int]] = None,
+    share_weights: bool = False,
+) -> VisionEncoderDecoderModel:
+    """
+    Creates a student that works at a reduced input resolution and/or with smaller Swin windows.
+
+    The Swin encoder's cost grows with the number of patches and the window area, so scaling the
+    input by 0.75 saves about 44% of the encoder FLOPs. All weights are taken from the teacher
+    (see `build_student_from_teacher`), the relative position bias tables are interpolated to the
+    new window size. Inputs have to be resized with `scale_pixel_values` (training) or a processor
+    from `scaled_processor` (inference).
+
+    Args:
+        teacher (VisionEncoderDecoderModel): The pre-trained teacher model.
+        teacher_config (VisionEncoderDecoderConfig): The configuration of the teacher model.
+        input_scale (float): Scale of the student's input resolution relative to the teacher's.
+        window_size (int, optional): Swin window size of the student, defaults to the teacher's.
+        encoder_layer_map (List[List[int]], optional): Additionally drop encoder blocks (see `create_student_small_with_encoder`).
+        decoder_layer_map (List[int], optional): Mapping of teacher decoder layers to student layers, defaults to all layers.
+        share_weights (bool): Share the teacher's storage instead of copying (see `build_student_from_teacher`).
+
+    Returns:
+        VisionEncoderDecoderModel: The reduced student.
+
+    Raises:
+        ValueError: If the last encoder stage would be smaller than the window.
+    """
+    encoder_layer_map = encoder_layer_map or []
+    if decoder_layer_map is None:
+        decoder_layer_map = list(range(teacher_config.decoder.decoder_layers))
+
+    config = deepcopy(teacher_config)
+    config.decoder = deepcopy(teacher_config.decoder)
+    config.encoder = deepcopy(teacher_config.encoder)
+
+    config.decoder.decoder_layers = len(decoder_layer_map)
+    if encoder_layer_map:
+        config.encoder.depths = [len(mapping) for mapping in encoder_layer_map]
+    image_size = teacher_config.encoder.image_size
+    if isinstance(image_size, int):
+        image_size = [image_size, image_size]
+    config.encoder.image_size = scaled_input_size(list(image_size), input_scale)
+    if window_size is not None:
+        config.encoder.window_size = window_size
+
+    # DonutSwin can't shrink the window below its configured size (the bias table wouldn't fit)
+    last_grid = swin_output_grid(config.encoder, *config.encoder.image_size)
+    if min(last_grid) < config.encoder.window_size:
+        raise ValueError(
+            f"The last encoder stage ({last_grid[0]}x{last_grid[1]}) is smaller than the window size "
+            f"{config.encoder.window_size}, use a larger input scale or a smaller window"
+        )
+
+    return build_student_from_teacher(teacher, config, encoder_layer_map, decoder_layer_map, share_weights)
+
 
 if __name__ == "__main__":
 
+    from donut_distill.data.donut_dataset import default_registry
     from donut_distill.models.helpers import prepare_model_and_processor
 
     model, processor, donut_config = prepare_model_and_processor(
@@ -249,4 +496,5 @@ if __name__ == "__main__":
 
     student_model.save_pretrained(model_dir)
     processor.save_pretrained(model_dir)
+    default_registry.save_pretrained(model_dir)
     donut_config.save_pretrained(model_dir)
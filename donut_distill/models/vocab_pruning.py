@@ -0,0 +1,298 @@
+import json
+import string
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+import torch
+from tokenizers import Tokenizer
+from transformers import AutoTokenizer, DonutProcessor, PreTrainedTokenizerFast, VisionEncoderDecoderModel
+from donut_distill.data.donut_dataset import SpecialTokenRegistry, default_registry, json2token
+
+# Written next to the pruned checkpoint: the original id of every kept token
+VOCAB_PRUNING_FILE = "vocab_pruning.json"
+METASPACE = "▁"
+
+# Config attributes holding token ids, remapped to the pruned vocabulary
+TOKEN_ID_ATTRIBUTES = (
+    "bos_token_id",
+    "eos_token_id",
+    "pad_token_id",
+    "decoder_start_token_id",
+    "forced_bos_token_id",
+    "forced_eos_token_id",
+)
+
+
+def ground_truth_sequences(
+    metadata_paths: Iterable[str | Path],
+    sort_json_key: bool = True,
+    registry: Optional[SpecialTokenRegistry] = None,
+) -> List[str]:
+    """
+    Reads the ground truths of `metadata.jsonl` files and converts them to the target sequences
+    used in training (see `DonutDataset`).
+
+    Args:
+        metadata_paths (Iterable[str | Path]): `metadata.jsonl` files with a "ground_truth" JSON string per line.
+        sort_json_key (bool): Whether the keys are sorted (as in `DonutDataset`).
+        registry (SpecialTokenRegistry, optional): Categorical tokens of the checkpoint, defaults to `default_registry`.
+
+    Returns:
+        List[str]: All target sequences (every ground truth of samples with several).
+    """
+    sequences = []
+    for metadata_path in metadata_paths:
+        with open(metadata_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                ground_truth = json.loads(json.loads(line)["ground_truth"])
+                gt_jsons = ground_truth["gt_parses"] if "gt_parses" in ground_truth else [ground_truth["gt_parse"]]
+                sequences += [json2token(gt_json, sort_json_key=sort_json_key, registry=registry) for gt_json in gt_jsons]
+    return sequences
+
+
+def collect_vocabulary(
+    tokenizer: PreTrainedTokenizerFast,
+    sequences: Sequence[str],
+    keep_single_characters: bool = True,
+) -> List[int]:
+    """
+    Collects the token ids needed to tokenize `sequences`.
+
+    Kept are:
+    - all special and added tokens (task tokens, <s_key> tokens, categorical tokens, ...)
+    - every token of the tokenized sequences
+    - with `keep_single_characters`, the single character pieces of all characters in the
+      sequences and of printable ASCII. Unseen words made of these characters can then still
+      be tokenized without <unk>, even if the character was only seen inside longer pieces.
+
+    The Unigram segmentation only picks among kept pieces, so the sequences are tokenized
+    exactly as with the full vocabulary.
+
+    Args:
+        tokenizer (PreTrainedTokenizerFast): The full tokenizer.
+        sequences (Sequence[str]): Target sequences, e.g. from `ground_truth_sequences`.
+        keep_single_characters (bool): Whether to keep single character pieces (see above).
+
+    Returns:
+        List[int]: Sorted ids of the tokens to keep.
+    """
+    keep_ids = set(tokenizer.all_special_ids) | set(tokenizer.get_added_vocab().values())
+
+    batch_size = 1024
+    for start in range(0, len(sequences), batch_size):
+        encodings = tokenizer(list(sequences[start : start + batch_size]), add_special_tokens=False)["input_ids"]
+        for input_ids in encodings:
+            keep_ids.update(input_ids)
+
+    if keep_single_characters:
+        characters = set(string.printable.strip()) | {char for sequence in sequences for char in sequence}
+        for piece, token_id in tokenizer.get_vocab().items():
+            character = piece.lstrip(METASPACE)
+            if len(character) == 1 and character in characters or piece == METASPACE:
+                keep_ids.add(token_id)
+
+    return sorted(keep_ids)
+
+
+def _fast_tokenizer(tokenizer) -> PreTrainedTokenizerFast:
+    if tokenizer.is_fast:
+        return tokenizer
+    # Converts the sentencepiece model (including the added tokens) to a tokenizers backend
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokenizer.save_pretrained(tmp_dir)
+        return AutoTokenizer.from_pretrained(tmp_dir, use_fast=True)
+
+
+def prune_tokenizer(tokenizer, keep_ids: Sequence[int]) -> PreTrainedTokenizerFast:
+    """
+    Builds a tokenizer with only the tokens in `keep_ids`.
+
+    The kept tokens are renumbered in their original order, so token `keep_ids[i]` gets id `i`.
+    Normalization, pre-tokenization and decoding are unchanged, so `json2token`, `token2json` and
+    the DocVQA/FUNSD postprocessing work as before.
+
+    Args:
+        tokenizer (PreTrainedTokenizer | PreTrainedTokenizerFast): The full (Unigram/sentencepiece) tokenizer.
+        keep_ids (Sequence[int]): Sorted ids of the tokens to keep (see `collect_vocabulary`).
+
+    Returns:
+        PreTrainedTokenizerFast: The pruned tokenizer. It has no sentencepiece model, so it is always loaded as fast tokenizer.
+
+    Raises:
+        ValueError: If the tokenizer is not a Unigram tokenizer or a special token would be removed.
+    """
+    tokenizer = _fast_tokenizer(tokenizer)
+    state = json.loads(tokenizer.backend_tokenizer.to_str())
+    if state["model"]["type"] != "Unigram":
+        raise ValueError(f"Only Unigram tokenizers can be pruned, got {state['model']['type']}")
+    missing = set(tokenizer.all_special_ids) - set(keep_ids)
+    if missing:
+        raise ValueError(f"Special tokens {tokenizer.convert_ids_to_tokens(sorted(missing))} have to be kept")
+
+    id_map = {old_id: new_id for new_id, old_id in enumerate(keep_ids)}
+
+    # Step 1: Base vocabulary (ids below its size), added tokens come after it
+    vocab = state["model"]["vocab"]
+    state["model"]["vocab"] = [vocab[old_id] for old_id in keep_ids if old_id < len(vocab)]
+    state["model"]["unk_id"] = id_map[state["model"]["unk_id"]]
+    state["added_tokens"] = [
+        {**token, "id": id_map[token["id"]]} for token in state["added_tokens"] if token["id"] in id_map
+    ]
+
+    # Step 2: Special tokens of the post processor (<s> ... </s>)
+    post_processor = state.get("post_processor") or {}
+    for token in post_processor.get("special_tokens", {}).values():
+        token["ids"] = [id_map[token_id] for token_id in token["ids"]]
+    for key in ("sep", "cls"):
+        if key in post_processor:
+            post_processor[key][1] = id_map[post_processor[key][1]]
+
+    special_tokens = {key: value for key, value in tokenizer.special_tokens_map.items() if isinstance(value, str)}
+    pruned = type(tokenizer)(tokenizer_object=Tokenizer.from_str(json.dumps(state)), **special_tokens)
+    pruned.model_max_length = tokenizer.model_max_length
+    return pruned
+
+
+def _remap_token_ids(config, id_map: Dict[int, int]):
+    for attribute in TOKEN_ID_ATTRIBUTES:
+        token_id = getattr(config, attribute, None)
+        if isinstance(token_id, int):
+            if token_id not in id_map:
+                raise ValueError(f"{attribute} {token_id} is not part of the pruned vocabulary")
+            setattr(config, attribute, id_map[token_id])
+
+
+def prune_model_vocabulary(model: VisionEncoderDecoderModel, keep_ids: Sequence[int]) -> VisionEncoderDecoderModel:
+    """
+    Slices the decoder's token embeddings and LM head to `keep_ids` (in place).
+
+    The output projection and softmax over the vocabulary dominate the per-token decoder cost,
+    so this speeds up every generation step and shrinks the checkpoint. Token ids in the model,
+    decoder and generation configs are remapped.
+
+    Args:
+        model (VisionEncoderDecoderModel): The Donut model.
+        keep_ids (Sequence[int]): Sorted ids of the tokens to keep (see `collect_vocabulary`).
+
+    Returns:
+        VisionEncoderDecoderModel: The same model with the pruned vocabulary.
+    """
+    id_map = {old_id: new_id for new_id, old_id in enumerate(keep_ids)}
+    embeddings = model.decoder.get_input_embeddings()
+    lm_head = model.decoder.get_output_embeddings()
+    index = torch.tensor(keep_ids, dtype=torch.long, device=embeddings.weight.device)
+    tied = lm_head is not None and lm_head.weight is embeddings.weight
+
+    # Step 1: Embeddings (the module is kept, e.g. MBart's scaled embedding)
+    embeddings.weight = torch.nn.Parameter(embeddings.weight.data[index].clone())
+    embeddings.num_embeddings = len(keep_ids)
+    if embeddings.padding_idx is not None:
+        embeddings.padding_idx = id_map[embeddings.padding_idx]
+
+    # Step 2: LM head
+    if lm_head is not None:
+        if tied:
+            lm_head.weight = embeddings.weight
+        else:
+            lm_head.weight = torch.nn.Parameter(lm_head.weight.data[index].clone())
+        if lm_head.bias is not None:
+            lm_head.bias = torch.nn.Parameter(lm_head.bias.data[index].clone())
+        lm_head.out_features = len(keep_ids)
+
+    # Step 3: Configs
+    model.config.decoder.vocab_size = len(keep_ids)
+    model.config.vocab_size = len(keep_ids)
+    for config in (model.config, model.config.decoder, model.generation_config):
+        _remap_token_ids(config, id_map)
+    return model
+
+
+def prune_vocabulary(
+    model: VisionEncoderDecoderModel,
+    processor: DonutProcessor,
+    sequences: Sequence[str],
+    keep_single_characters: bool = True,
+) -> List[int]:
+    """
+    Prunes the vocabulary of a Donut model and its processor to the tokens of `sequences` (in place).
+
+    To distill with a pruned vocabulary, prune the teacher checkpoint and use it as
+    `TEACHER_MODEL_PATH`. Students created from it share the pruned vocabulary, so their logits
+    and token ids match the teacher's.
+
+    Args:
+        model (VisionEncoderDecoderModel): The Donut model.
+        processor (DonutProcessor): Its processor, the tokenizer is replaced by the pruned one.
+        sequences (Sequence[str]): Target sequences, e.g. from `ground_truth_sequences`.
+        keep_single_characters (bool): See `collect_vocabulary`.
+
+    Returns:
+        List[int]: Original ids of the kept tokens (the new id is the position in the list).
+    """
+    tokenizer = _fast_tokenizer(processor.tokenizer)
+    keep_ids = collect_vocabulary(tokenizer, sequences, keep_single_characters)
+    if len(tokenizer) != model.decoder.get_input_embeddings().num_embeddings:
+        raise ValueError(
+            f"The tokenizer has {len(tokenizer)} tokens, but the model {model.decoder.get_input_embeddings().num_embeddings}"
+        )
+
+    processor.tokenizer = prune_tokenizer(tokenizer, keep_ids)
+    prune_model_vocabulary(model, keep_ids)
+    return keep_ids
+
+
+if __name__ == "__main__":
+    import argparse
+    import donut_distill.config.config as CONFIG
+    from donut_distill.config.loader import load_config
+
+    parser = argparse.ArgumentParser(description="Prune the vocabulary of a Donut checkpoint to the tokens of a dataset")
+    parser.add_argument("--config", help="Path to the config file", type=str, default=None)
+    parser.add_argument("--model_path", help="Checkpoint to prune (model and processor)", type=str, required=True)
+    parser.add_argument("--output", help="Directory for the pruned checkpoint", type=str, required=True)
+    parser.add_argument("--datasets", nargs="+", default=None, help="Dataset directories (default: CONFIG.DATASET)")
+    parser.add_argument(
+        "--splits", nargs="+", default=None, help="Splits to scan for metadata.jsonl (default: CONFIG.DATASET_NAME_TRAINING)"
+    )
+    parser.add_argument("--extra_tokens", nargs="*", default=[], help="Additional tokens to add and keep, e.g. task tokens")
+    parser.add_argument(
+        "--no_single_characters", action="store_true", help="Don't keep single character pieces of the seen characters"
+    )
+    args = parser.parse_args()
+
+    if args.config:
+        load_config(args.config)
+
+    processor = DonutProcessor.from_pretrained(args.model_path)
+    model = VisionEncoderDecoderModel.from_pretrained(args.model_path)
+    # Categorical tokens of the checkpoint, so the sequences match training and the pruned checkpoint keeps them
+    default_registry.add(SpecialTokenRegistry.from_pretrained(args.model_path))
+    if args.extra_tokens:
+        from donut_distill.models.helpers import add_tokens
+
+        add_tokens(model, processor, args.extra_tokens)
+
+    metadata_paths = [
+        metadata_path
+        for dataset in args.datasets or [CONFIG.DATASET]
+        for split in args.splits or [CONFIG.DATASET_NAME_TRAINING]
+        for metadata_path in sorted(Path(dataset, split).rglob("metadata.jsonl"))
+    ]
+    if not metadata_paths:
+        raise FileNotFoundError("No metadata.jsonl found for the given datasets and splits")
+    sequences = ground_truth_sequences(metadata_paths)
+
+    original_size = len(processor.tokenizer)
+    keep_ids = prune_vocabulary(model, processor, sequences, keep_single_characters=not args.no_single_characters)
+    print(
+        f"Kept {len(keep_ids)} of {original_size} tokens ({len(sequences)} sequences from {len(metadata_paths)} files)"
+    )
+
+    model.save_pretrained(args.output)
+    processor.save_pretrained(args.output)
+    default_registry.save_pretrained(args.output)
+    with open(Path(args.output) / VOCAB_PRUNING_FILE, "w") as f:
+        json.dump({"original_vocab_size": original_size, "kept_ids": keep_ids}, f)
+    print(f"Saved the pruned checkpoint to {args.output}")
@@ -0,0 +1,114 @@
+from typing import Dict, List, Optional, Tuple
+import torch
+from torch import nn
+from transformers import VisionEncoderDecoderModel
+
+
+def mapped_teacher_blocks(encoder_layer_map: List[List[int]]) -> List[List[int]]:
+    """
+    Converts an encoder layer map (1-indexed teacher blocks per stage) to 0-indexed block indices.
+    """
+    return [[block_idx - 1 for block_idx in stage_map] for stage_map in encoder_layer_map]
+
+
+def all_blocks(model: VisionEncoderDecoderModel) -> List[List[int]]:
+    """
+    Returns the indices of all Swin blocks of the model's encoder, per stage.
+    """
+    return [list(range(depth)) for depth in model.config.encoder.depths]
+
+
+class SwinBlockRecorder:
+    """
+    Records the outputs of selected DonutSwin blocks with forward hooks.
+
+    Only the selected blocks are hooked, so the encoder forward stays unchanged and nothing is
+    kept for the other blocks (in contrast to `output_hidden_states`, which only returns the stage
+    outputs anyway). Per block the recorder stores:
+    - hidden_states[(stage, block)]: block output (batch, height * width, channels)
+    - grids[(stage, block)]: (height, width) of the stage
+    - shifts[(stage, block)]: shift size of the block's windows
+    - attentions[(stage, block)]: attention probabilities (batch * windows, heads, window^2, window^2),
+      only with `record_attentions`
+
+    The attention probabilities are taken from the input of the attention dropout, so they are
+    recorded without `output_attentions` and before dropout.
+
+    Args:
+        model (VisionEncoderDecoderModel): Donut model whose encoder blocks are recorded.
+        blocks (List[List[int]]): 0-indexed block indices to record, per stage.
+        record_attentions (bool): Also record the attention probabilities.
+    """
+
+    def __init__(self, model: VisionEncoderDecoderModel, blocks: List[List[int]], record_attentions: bool = True):
+        self.hidden_states: Dict[Tuple[int, int], torch.Tensor] = {}
+        self.attentions: Dict[Tuple[int, int], torch.Tensor] = {}
+        self.grids: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        self.shifts: Dict[Tuple[int, int], int] = {}
+        self._handles = []
+
+        stages = model.encoder.encoder.layers
+        for stage_idx, block_indices in enumerate(blocks):
+            for block_idx in block_indices:
+                block = stages[stage_idx].blocks[block_idx]
+                key = (stage_idx, block_idx)
+                self._handles.append(block.register_forward_hook(self._block_hook(key)))
+                if record_attentions:
+                    self._handles.append(
+                        block.attention.self.dropout.register_forward_hook(self._attention_hook(key))
+                    )
+
+    def _block_hook(self, key: Tuple[int, int]):
+        def hook(module: nn.Module, args, output):
+            # DonutSwinLayer.forward(hidden_states, input_dimensions, ...)
+            self.hidden_states[key] = output[0]
+            self.grids[key] = tuple(int(size) for size in args[1])
+            self.shifts[key] = int(module.shift_size)
+
+        return hook
+
+    def _attention_hook(self, key: Tuple[int, int]):
+        def hook(module: nn.Module, args, output):
+            self.attentions[key] = args[0]
+
+        return hook
+
+    def clear(self):
+        """Drops the recorded tensors (call after each step, so the graph can be freed)."""
+        self.hidden_states.clear()
+        self.attentions.clear()
+        self.grids.clear()
+        self.shifts.clear()
+
+    def remove(self):
+        """Removes the hooks."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self.clear()
+
+
+def build_encoder_recorders(
+    student: VisionEncoderDecoderModel,
+    teacher: VisionEncoderDecoderModel,
+    encoder_layer_map: List[List[int]],
+    record_attentions: bool = True,
+) -> Tuple[Optional[SwinBlockRecorder], Optional[SwinBlockRecorder]]:
+    """
+    Hooks all student blocks and the teacher blocks they were copied from.
+
+    Args:
+        student (VisionEncoderDecoderModel): Student with a pruned encoder.
+        teacher (VisionEncoderDecoderModel): The teacher.
+        encoder_layer_map (List[List[int]]): Teacher blocks (1-indexed) per student stage, empty for an unchanged encoder.
+        record_attentions (bool): Also record the attention probabilities.
+
+    Returns:
+        Tuple[SwinBlockRecorder, SwinBlockRecorder]: (student, teacher) recorders, (None, None) without a map.
+    """
+    if not encoder_layer_map:
+        return None, None
+    return (
+        SwinBlockRecorder(student, all_blocks(student), record_attentions),
+        SwinBlockRecorder(teacher, mapped_teacher_blocks(encoder_layer_map), record_attentions),
+    )
@@ -0,0 +1,223 @@
+import json
+import queue
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import torch
+
+
+def _to_python(value: Any) -> Any:
+    """
+    Converts tensors (possibly on the GPU) into Python numbers.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.item() if value.numel() == 1 else value.tolist()
+    return value
+
+
+class MetricsLogger:
+    """
+    Interface of the training metric backends.
+    """
+
+    def log(self, metrics: Dict[str, Any], step: int):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class WandbLogger(MetricsLogger):
+    """
+    Logs to Weights & Biases. wandb is imported lazily, so offline nodes don't need it.
+    """
+
+    def __init__(self, project: str, name: str, config: Optional[Dict[str, Any]] = None):
+        import wandb
+
+        self.wandb = wandb
+        self.run = wandb.init(project=project, name=name, config=config)
+
+    def log(self, metrics: Dict[str, Any], step: int):
+        self.wandb.log({key: _to_python(value) for key, value in metrics.items()}, step=step)
+
+    def close(self):
+        self.run.finish()
+
+
+class TensorBoardLogger(MetricsLogger):
+    """
+    Logs scalars to TensorBoard event files in `log_dir`.
+    """
+
+    def __init__(self, log_dir: str | Path, config: Optional[Dict[str, Any]] = None):
+        from torch.utils.tensorboard import SummaryWriter
+
+        self.writer = SummaryWriter(log_dir=str(log_dir))
+        if config:
+            self.writer.add_text("config", json.dumps(config, indent=2, default=str))
+
+    def log(self, metrics: Dict[str, Any], step: int):
+        for key, value in metrics.items():
+            value = _to_python(value)
+            if isinstance(value, (int, float)):
+                self.writer.add_scalar(key, value, global_step=step)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonlLogger(MetricsLogger):
+    """
+    Appends one JSON line per `log` call to `log_dir/metrics.jsonl`.
+    Lines are buffered and written every `buffer_size` records (and on `flush`/`close`).
+    """
+
+    def __init__(self, log_dir: str | Path, config: Optional[Dict[str, Any]] = None, buffer_size: int = 50):
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.log_dir / "metrics.jsonl"
+        self.buffer_size = buffer_size
+        self.buffer: List[str] = []
+        if config:
+            with open(self.log_dir / "config.json", "w") as f:
+                json.dump(config, f, indent=2, default=str)
+
+    def log(self, metrics: Dict[str, Any], step: int):
+        record = {"step": step, **{key: _to_python(value) for key, value in metrics.items()}}
+        self.buffer.append(json.dumps(record))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, "a") as f:
+                f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+
+
+class NullLogger(MetricsLogger):
+    def log(self, metrics: Dict[str, Any], step: int):
+        pass
+
+
+class AsyncLogger(MetricsLogger):
+    """
+    Hands metrics to a background thread, so converting device tensors (`.item()`) and writing
+    to the backend never blocks the training step.
+
+    Args:
+        backend (MetricsLogger): The logger doing the actual writing.
+    """
+
+    _STOP = object()
+
+    def __init__(self, backend: MetricsLogger):
+        self.backend = backend
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="metrics-logger", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                if item is None:
+                    self.backend.flush()
+                else:
+                    metrics, step = item
+                    self.backend.log(metrics, step)
+            except Exception as e:  # Logging must never kill the training run
+                print(f"Failed to log metrics: {e}")
+            finally:
+                self.queue.task_done()
+
+    def log(self, metrics: Dict[str, Any], step: int):
+        # Detach device tensors, so later in-place updates don't change the logged values
+        metrics = {
+            key: value.detach().clone() if isinstance(value, torch.Tensor) else value
+            for key, value in metrics.items()
+        }
+        self.queue.put((metrics, step))
+
+    def flush(self):
+        self.queue.put(None)
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(self._STOP)
+        self.thread.join()
+        self.backend.close()
+
+
+class DeviceMetricAccumulator:
+    """
+    Sums metrics on their device between logging steps, so the training step doesn't need `.item()`.
+    """
+
+    def __init__(self):
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.counts: Dict[str, int] = {}
+
+    def update(self, name: str, value: torch.Tensor):
+        value = value.detach().float()
+        if name in self.sums:
+            self.sums[name] += value
+            self.counts[name] += 1
+        else:
+            self.sums[name] = value.clone()
+            self.counts[name] = 1
+
+    def pop_means(self) -> Dict[str, torch.Tensor]:
+        """
+        Returns the means since the last call (still on the device) and resets the sums.
+        """
+        means = {name: self.sums[name] / self.counts[name] for name in self.sums}
+        self.sums = {}
+        self.counts = {}
+        return means
+
+
+def build_logger(
+    backend: str,
+    log_dir: str | Path,
+    project: str = "donut-distill-docvqa",
+    name: str = "docvqa",
+    config: Optional[Dict[str, Any]] = None,
+    asynchronous: bool = True,
+) -> MetricsLogger:
+    """
+    Creates the metrics logger for training.
+
+    Args:
+        backend (str): "wandb", "tensorboard", "jsonl" or "none".
+        log_dir (str | Path): Output directory of the local backends.
+        project (str): wandb project.
+        name (str): wandb run name.
+        config (dict, optional): Run configuration stored with the metrics.
+        asynchronous (bool): Log from a background thread.
+
+    Returns:
+        MetricsLogger: The logger.
+    """
+    if backend == "wandb":
+        logger = WandbLogger(project=project, name=name, config=config)
+    elif backend == "tensorboard":
+        logger = TensorBoardLogger(log_dir, config=config)
+    elif backend == "jsonl":
+        logger = JsonlLogger(log_dir, config=config)
+    elif backend == "none":
+        return NullLogger()
+    else:
+        raise ValueError(f"Unknown logger backend: {backend}")
+
+    return AsyncLogger(logger) if asynchronous else logger
@@ -1,8 +1,9 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from typing import List
+from typing import List, Optional, Sequence, Tuple
 from transformers.modeling_outputs import Seq2SeqLMOutput
+from donut_distill.training.encoder_hooks import SwinBlockRecorder, mapped_teacher_blocks
 
 # Define loss functions
 mse_loss_fn = nn.MSELoss()
@@ -19,7 +20,14 @@ def calculate_loss_and_accuracy_distillation(
     alpha: float = 1,
     beta: float = 1,
     gamma: float = 1,
-    delta: float = 1
+    delta: float = 1,
+    epsilon: float = 0,
+    encoder_grids: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None,
+    zeta: float = 0,
+    eta: float = 0,
+    encoder_recorders: Optional[Tuple[SwinBlockRecorder, SwinBlockRecorder]] = None,
+    encoder_layer_map: Optional[List[List[int]]] = None,
+    encoder_stage_weights: Optional[Sequence[float]] = None,
 ) -> torch.Tensor:
     """
     Calculate the distillation loss between teacher and student models.
@@ -34,6 +42,16 @@ def calculate_loss_and_accuracy_distillation(
         alpha (float): Weight for self-attention loss.
         beta (float): Weight for hidden state loss.
         gamma (float): Weight for logit-based loss.
+        delta (float): Weight for cross-attention loss.
+        epsilon (float): Weight for the pooled encoder hidden state loss (see `pooled_encoder_loss`).
+        encoder_grids (Tuple, optional): (student, teacher) grid of the last encoder stage, required if `epsilon` > 0
+            or if the student works at another resolution (cross-attentions are then pooled to a common grid).
+        zeta (float): Weight for the encoder block hidden state loss (see `encoder_block_loss`).
+        eta (float): Weight for the encoder block attention loss (see `encoder_block_loss`).
+        encoder_recorders (Tuple, optional): (student, teacher) recorders of the mapped Swin blocks, required if
+            `zeta` or `eta` > 0 (see `build_encoder_recorders`).
+        encoder_layer_map (List[List[int]], optional): Teacher blocks (1-indexed) of each student encoder stage.
+        encoder_stage_weights (Sequence[float], optional): Relative weight of each encoder stage, defaults to equal weights.
 
     Returns:
         torch.Tensor: The total computed loss for backpropagation.
@@ -41,16 +59,22 @@ def calculate_loss_and_accuracy_distillation(
 
     # Normalize alpha, beta, gamma for balanced loss contribution
     if is_1phase_distillation:
-        normalize_factor = 1 / (alpha + beta + gamma + delta)
+        normalize_factor = 1 / (alpha + beta + gamma + delta + epsilon + zeta + eta)
         alpha *= normalize_factor
         beta *= normalize_factor
         gamma *= normalize_factor
         delta *= normalize_factor
+        epsilon *= normalize_factor
+        zeta *= normalize_factor
+        eta *= normalize_factor
     elif is_first_distillation_phase:
-        normalize_factor = 1 / (alpha + beta + delta)
+        normalize_factor = 1 / (alpha + beta + delta + epsilon + zeta + eta)
         alpha *= normalize_factor
         beta *= normalize_factor
         delta *= normalize_factor
+        epsilon *= normalize_factor
+        zeta *= normalize_factor
+        eta *= normalize_factor
     else:
         gamma = 1
 
@@ -61,16 +85,26 @@ def calculate_loss_and_accuracy_distillation(
         for student_layer_idx, teacher_layer_idx in enumerate(decoder_layer_map):
             # Self-attention
             total_loss += safe_mse_loss(
-                outputs.decoder_attentions[student_layer_idx],
-                teacher_outputs.decoder_attentions[teacher_layer_idx],
+                *match_attention_heads(
+                    outputs.decoder_attentions[student_layer_idx],
+                    teacher_outputs.decoder_attentions[teacher_layer_idx],
+                ),
                 device,
                 weight=(1 / len(decoder_layer_map)) * alpha
             )
 
             # Cross-attention
-            total_loss += safe_mse_loss(
+            student_cross_attentions, teacher_cross_attentions = match_attention_heads(
                 outputs.cross_attentions[student_layer_idx],
                 teacher_outputs.cross_attentions[teacher_layer_idx],
+            )
+            if encoder_grids is not None and encoder_grids[0] != encoder_grids[1]:
+                student_cross_attentions, teacher_cross_attentions = pool_cross_attentions(
+                    student_cross_attentions, teacher_cross_attentions, *encoder_grids
+                )
+            total_loss += safe_mse_loss(
+                student_cross_attentions,
+                teacher_cross_attentions,
                 device,
                 weight=(1 / len(decoder_layer_map)) * delta
             )
@@ -91,18 +125,191 @@ def calculate_loss_and_accuracy_distillation(
             weight=(1 / (len(decoder_layer_map) + 1)) * beta
         )
 
+        # Encoder output, pooled to a common grid if the resolutions differ
+        if epsilon > 0:
+            total_loss += epsilon * pooled_encoder_loss(
+                outputs.encoder_last_hidden_state,
+                teacher_outputs.encoder_last_hidden_state,
+                *encoder_grids,
+                device=device,
+            )
+
+        # Hidden states & attentions of the mapped encoder blocks
+        if zeta > 0 or eta > 0:
+            total_loss += encoder_block_loss(
+                *encoder_recorders,
+                encoder_layer_map=encoder_layer_map,
+                device=device,
+                hidden_weight=zeta,
+                attention_weight=eta,
+                stage_weights=encoder_stage_weights,
+            )
+
     # Phase 2: Logit-based distillation (KL divergence)
     if (not is_first_distillation_phase) or is_1phase_distillation:
-        epsilon = 1e-10
+        eps = 1e-10
         logits: torch.Tensor = outputs.logits
         loss_val = gamma * kl_loss_fn(
-            F.log_softmax(logits + epsilon, dim=-1),
-            F.softmax(teacher_outputs.logits + epsilon, dim=-1)
+            F.log_softmax(logits + eps, dim=-1),
+            F.softmax(teacher_outputs.logits + eps, dim=-1)
         ).to(device)
         total_loss += loss_val
 
     return total_loss
 
+def match_attention_heads(
+    student_attentions: torch.Tensor, teacher_attentions: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Makes attentions (batch, heads, target length, source length) of layers with a different number
+    of heads (e.g. after head pruning) comparable by averaging over the heads.
+    """
+    if student_attentions.shape[1] == teacher_attentions.shape[1]:
+        return student_attentions, teacher_attentions
+    return student_attentions.mean(dim=1, keepdim=True), teacher_attentions.mean(dim=1, keepdim=True)
+
+
+def _common_grid(student_grid: Tuple[int, int], teacher_grid: Tuple[int, int]) -> Tuple[int, int]:
+    return min(student_grid[0], teacher_grid[0]), min(student_grid[1], teacher_grid[1])
+
+
+def pool_cross_attentions(
+    student_attentions: torch.Tensor,
+    teacher_attentions: torch.Tensor,
+    student_grid: Tuple[int, int],
+    teacher_grid: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Pools cross-attentions (batch, heads, target length, encoder positions) over the encoder positions
+    to the smaller of both grids. The pooled weights are renormalized, so they stay distributions.
+    """
+    target_grid = _common_grid(student_grid, teacher_grid)
+
+    def pool(attentions: torch.Tensor, grid: Tuple[int, int]) -> torch.Tensor:
+        if grid == target_grid:
+            return attentions
+        batch_size, num_heads, length, _ = attentions.shape
+        pooled = F.adaptive_avg_pool2d(attentions.reshape(batch_size * num_heads, length, *grid), target_grid)
+        pooled = pooled.reshape(batch_size, num_heads, length, -1)
+        return pooled / pooled.sum(dim=-1, keepdim=True).clamp_min(1e-12)
+
+    return pool(student_attentions, student_grid), pool(teacher_attentions, teacher_grid)
+
+
+def pooled_encoder_loss(
+    student_hidden_states: torch.Tensor,
+    teacher_hidden_states: torch.Tensor,
+    student_grid: Tuple[int, int],
+    teacher_grid: Tuple[int, int],
+    device: torch.device,
+) -> torch.Tensor:
+    """
+    MSE between encoder hidden states of different resolutions.
+
+    Both (batch, height * width, channels) sequences are reshaped to their grids and average
+    pooled to the smaller grid, so each student position is compared with the teacher features
+    of the same image region.
+
+    Args:
+        student_hidden_states (torch.Tensor): Student encoder output.
+        teacher_hidden_states (torch.Tensor): Teacher encoder output (same number of channels).
+        student_grid (Tuple[int, int]): (height, width) of the student's encoder output.
+        teacher_grid (Tuple[int, int]): (height, width) of the teacher's encoder output.
+        device: The device (CPU or CUDA).
+
+    Returns:
+        torch.Tensor: The loss.
+    """
+    target_grid = _common_grid(student_grid, teacher_grid)
+
+    def to_grid(hidden_states: torch.Tensor, grid: Tuple[int, int]) -> torch.Tensor:
+        batch_size, _, channels = hidden_states.shape
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, channels, *grid)
+        if grid != target_grid:
+            hidden_states = F.adaptive_avg_pool2d(hidden_states, target_grid)
+        return hidden_states
+
+    return safe_mse_loss(
+        to_grid(student_hidden_states, student_grid),
+        to_grid(teacher_hidden_states, teacher_grid),
+        device,
+    )
+
+
+def encoder_block_loss(
+    student_recorder: SwinBlockRecorder,
+    teacher_recorder: SwinBlockRecorder,
+    encoder_layer_map: List[List[int]],
+    device: torch.device,
+    hidden_weight: float = 1,
+    attention_weight: float = 1,
+    stage_weights: Optional[Sequence[float]] = None,
+) -> torch.Tensor:
+    """
+    Distills the Swin blocks of a pruned student encoder from the teacher blocks they were copied from.
+
+    Each student block is compared with its teacher block from `encoder_layer_map`:
+    - hidden states: MSE of the block outputs (pooled to a common grid if the resolutions differ)
+    - attentions: MSE of the window attention probabilities. Only pairs with the same windows
+      (same shift and shape) are comparable, others are skipped.
+
+    The losses are averaged over the blocks of a stage and the stages are weighted by `stage_weights`.
+
+    Args:
+        student_recorder (SwinBlockRecorder): Recorder of all student blocks.
+        teacher_recorder (SwinBlockRecorder): Recorder of the mapped teacher blocks.
+        encoder_layer_map (List[List[int]]): Teacher blocks (1-indexed) of each student stage.
+        device (torch.device): Device (CPU or GPU).
+        hidden_weight (float): Weight for the hidden state loss.
+        attention_weight (float): Weight for the attention loss.
+        stage_weights (Sequence[float], optional): Relative weight of each stage, defaults to equal weights.
+
+    Returns:
+        torch.Tensor: The weighted encoder loss.
+    """
+    teacher_blocks = mapped_teacher_blocks(encoder_layer_map)
+    if stage_weights is None:
+        stage_weights = [1.0] * len(teacher_blocks)
+    if len(stage_weights) != len(teacher_blocks):
+        raise ValueError(
+            f"Got {len(stage_weights)} encoder stage weights for {len(teacher_blocks)} encoder stages"
+        )
+    # Stages without blocks don't take part in the normalization
+    total_weight = sum(weight for weight, blocks in zip(stage_weights, teacher_blocks) if blocks)
+
+    total_loss = torch.zeros((), device=device)
+    for stage_idx, (stage_weight, stage_blocks) in enumerate(zip(stage_weights, teacher_blocks)):
+        if not stage_blocks or stage_weight == 0:
+            continue
+        weight = stage_weight / (total_weight * len(stage_blocks))
+
+        for student_block_idx, teacher_block_idx in enumerate(stage_blocks):
+            s_key = (stage_idx, student_block_idx)
+            t_key = (stage_idx, teacher_block_idx)
+
+            if hidden_weight > 0:
+                total_loss += weight * hidden_weight * pooled_encoder_loss(
+                    student_recorder.hidden_states[s_key],
+                    teacher_recorder.hidden_states[t_key],
+                    student_recorder.grids[s_key],
+                    teacher_recorder.grids[t_key],
+                    device=device,
+                )
+
+            if attention_weight > 0 and s_key in student_recorder.attentions:
+                student_attentions = student_recorder.attentions[s_key]
+                teacher_attentions = teacher_recorder.attentions[t_key]
+                if (
+                    student_recorder.shifts[s_key] == teacher_recorder.shifts[t_key]
+                    and student_attentions.shape == teacher_attentions.shape
+                ):
+                    total_loss += safe_mse_loss(
+                        student_attentions, teacher_attentions, device, weight=weight * attention_weight
+                    )
+
+    return total_loss
+
+
 def safe_mse_loss(output: torch.Tensor, target: torch.Tensor, device, weight: float = 1.0) -> torch.Tensor:
     """
     Computes MSE loss and handles NaN or Inf values.
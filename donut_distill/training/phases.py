@@ -0,0 +1,89 @@
+from typing import Any, Dict, Optional
+import donut_distill.config.config as CONFIG
+
+
+class DistillationPhases:
+    """
+    Schedules the distillation phases of `calculate_loss_and_accuracy_distillation`.
+
+    - 1 phase: all losses (attentions, hidden states, logits) are combined in every step.
+    - 2 phases: the intermediate layers (attentions, hidden states) are distilled for the first
+      `first_phase_steps` steps, then only the logits. Both phases have their own learning rate
+      and warmup, the cosine schedule of each phase ends with the phase.
+
+    Steps are counted in batches (like the `steps` counter of `train()`).
+
+    Args:
+        num_phases (int): 1 or 2.
+        first_phase_steps (int): Length of the first phase in batches (ignored with 1 phase).
+        total_steps (int): Length of the whole run in batches.
+        first_phase_lr (float, optional): Learning rate of the first phase, defaults to `CONFIG.LR`.
+        first_phase_warmup_steps (int, optional): Warmup of the first phase, defaults to `CONFIG.WARMUP_STEPS`.
+    """
+
+    def __init__(
+        self,
+        num_phases: int,
+        first_phase_steps: int,
+        total_steps: int,
+        first_phase_lr: Optional[float] = None,
+        first_phase_warmup_steps: Optional[int] = None,
+    ):
+        if num_phases not in (1, 2):
+            raise ValueError(f"DISTILLATION_PHASES has to be 1 or 2, got {num_phases}")
+        self.num_phases = num_phases
+        self.first_phase_steps = min(first_phase_steps, total_steps) if num_phases == 2 else total_steps
+        self.total_steps = total_steps
+        self.first_phase_lr = first_phase_lr
+        self.first_phase_warmup_steps = first_phase_warmup_steps
+
+    @classmethod
+    def from_config(cls, num_batches_per_epoch: int) -> "DistillationPhases":
+        """
+        Creates the schedule from `DISTILLATION_PHASES`, `FIRST_PHASE_STEPS`/`FIRST_PHASE_EPOCHS`,
+        `FIRST_PHASE_LR` and `FIRST_PHASE_WARMUP_STEPS`.
+        """
+        total_steps = CONFIG.MAX_EPOCHS * num_batches_per_epoch
+        if int(CONFIG.MAX_STEPS) > 0:
+            total_steps = min(total_steps, CONFIG.MAX_STEPS * CONFIG.ACCUMULATION_STEPS)
+        if CONFIG.FIRST_PHASE_STEPS is not None:
+            first_phase_steps = CONFIG.FIRST_PHASE_STEPS
+        else:
+            first_phase_steps = int(CONFIG.FIRST_PHASE_EPOCHS * num_batches_per_epoch)
+        return cls(
+            CONFIG.DISTILLATION_PHASES,
+            first_phase_steps,
+            total_steps,
+            first_phase_lr=CONFIG.FIRST_PHASE_LR,
+            first_phase_warmup_steps=CONFIG.FIRST_PHASE_WARMUP_STEPS,
+        )
+
+    def phase(self, step: int) -> int:
+        """Returns the phase (1 or 2) of a step."""
+        return 1 if step < self.first_phase_steps else 2
+
+    def is_first_phase(self, step: int) -> bool:
+        return self.phase(step) == 1
+
+    def is_phase_start(self, step: int) -> bool:
+        """True for the first step of the second phase, when the optimizer has to be rebuilt."""
+        return self.num_phases == 2 and step == self.first_phase_steps
+
+    def needs_intermediate_outputs(self, step: int) -> bool:
+        """Whether attentions and hidden states are needed, the logit phase only uses the logits."""
+        return self.num_phases == 1 or self.is_first_phase(step)
+
+    def optimizer_settings(self, phase: int) -> Dict[str, Any]:
+        """
+        Returns the keyword arguments of `prepare_optimizer_and_scheduler` for a phase.
+        With 1 phase, the defaults (whole run, `CONFIG.LR`, `CONFIG.WARMUP_STEPS`) are used.
+        """
+        if self.num_phases == 1:
+            return {}
+        if phase == 1:
+            return {
+                "lr": self.first_phase_lr,
+                "warmup_steps": self.first_phase_warmup_steps,
+                "training_steps": self.first_phase_steps // CONFIG.ACCUMULATION_STEPS,
+            }
+        return {"training_steps": (self.total_steps - self.first_phase_steps) // CONFIG.ACCUMULATION_STEPS}
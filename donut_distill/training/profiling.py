@@ -0,0 +1,207 @@
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+import torch
+from donut_distill.training.loggers import MetricsLogger
+
+
+def cpu_rss_bytes() -> int:
+    """
+    Returns the resident set size of the current process.
+
+    Uses psutil if installed, /proc on Linux, and the peak RSS from `getrusage` as a last resort.
+    """
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StepProfiler:
+    """
+    Lightweight timing of the training loop.
+
+    Time is measured in named spans (e.g. "data", "h2d", "forward", "backward", "optimizer").
+    `summary()` reports for the steps since the last summary:
+    - perf/<span>_ms and perf/<span>_pct: average time per step and share of the step time
+    - perf/step_ms, perf/samples_per_s, perf/tokens_per_s
+    - perf/cpu_rss_mb (and perf/gpu_max_memory_allocated_mb on CUDA)
+
+    CUDA kernels run asynchronously, so with `sync_cuda` every span synchronizes the device on
+    exit. This costs some throughput, which is why the profiler is off unless `CONFIG.PROFILE` is set.
+
+    Optionally a `torch.profiler` trace is recorded for the steps in `trace_steps` [start, end)
+    and written to `output_dir/traces` (viewable in TensorBoard).
+
+    Args:
+        enabled (bool): If False, all methods are no-ops.
+        sync_cuda (bool): Synchronize CUDA at the end of each span.
+        trace_steps (Sequence[int], optional): Step window [start, end) for a `torch.profiler` trace.
+        output_dir (str | Path, optional): Directory for torch.profiler traces.
+        logger (MetricsLogger, optional): Where `log` writes the summary.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        sync_cuda: bool = True,
+        trace_steps: Optional[Sequence[int]] = None,
+        output_dir: Optional[str | Path] = None,
+        logger: Optional[MetricsLogger] = None,
+    ):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.trace_steps = tuple(trace_steps) if trace_steps else None
+        self.output_dir = Path(output_dir) if output_dir else Path(".")
+        self.logger = logger
+
+        self.step = 0
+        self._step_start: Optional[float] = None
+        self._torch_profiler = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.span_seconds: Dict[str, float] = defaultdict(float)
+        self.window_steps = 0
+        self.window_samples = 0
+        self.window_tokens = 0
+        self.window_seconds = 0.0
+
+    def _synchronize(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+
+    def _mark_step_start(self):
+        if self._step_start is None:
+            self._synchronize()
+            self._step_start = time.perf_counter()
+            self._maybe_start_trace()
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        Times the enclosed block as span `name`.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self._mark_step_start()
+        start = time.perf_counter()
+        if self._torch_profiler is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self._synchronize()
+        self.span_seconds[name] += time.perf_counter() - start
+
+    def iterate(self, iterable: Iterable) -> Iterator:
+        """
+        Wraps a dataloader and times waiting for the next batch as span "data".
+        """
+        iterator = iter(iterable)
+        while True:
+            if self.enabled:
+                self._mark_step_start()
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                # The end of the epoch isn't part of a step
+                self._step_start = None
+                return
+            if self.enabled:
+                self.span_seconds["data"] += time.perf_counter() - start
+            yield batch
+
+    def step_end(self, num_samples: int, num_tokens: int = 0):
+        """
+        Ends the current step. `num_tokens` should be computed without a device sync (e.g. from CPU labels).
+        """
+        if not self.enabled:
+            return
+
+        self._mark_step_start()
+        self._synchronize()
+        self.window_seconds += time.perf_counter() - self._step_start
+        self._step_start = None
+        self.window_steps += 1
+        self.window_samples += num_samples
+        self.window_tokens += int(num_tokens)
+
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+        self.step += 1
+        self._maybe_stop_trace()
+
+    def _maybe_start_trace(self):
+        if self.trace_steps is None or self._torch_profiler is not None or self.step != self.trace_steps[0]:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._torch_profiler = torch.profiler.profile(
+            activities=activities,
+            record_shapes=True,
+            profile_memory=True,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(str(self.output_dir / "traces")),
+        )
+        self._torch_profiler.__enter__()
+
+    def _maybe_stop_trace(self):
+        if self._torch_profiler is not None and self.step >= self.trace_steps[1]:
+            self._torch_profiler.__exit__(None, None, None)
+            self._torch_profiler = None
+            print(f"Saved torch.profiler trace to {self.output_dir / 'traces'}")
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Returns the metrics of the steps since the last summary and starts a new window.
+        """
+        if not self.enabled or self.window_steps == 0:
+            return {}
+
+        # Time not covered by any span (e.g. logging)
+        step_seconds = self.window_seconds
+        self.span_seconds["other"] = max(0.0, step_seconds - sum(self.span_seconds.values()))
+
+        metrics = {
+            "perf/step_ms": 1000 * step_seconds / self.window_steps,
+            "perf/samples_per_s": self.window_samples / step_seconds if step_seconds > 0 else 0.0,
+            "perf/tokens_per_s": self.window_tokens / step_seconds if step_seconds > 0 else 0.0,
+            "perf/cpu_rss_mb": cpu_rss_bytes() / 2**20,
+        }
+        for name, seconds in self.span_seconds.items():
+            metrics[f"perf/{name}_ms"] = 1000 * seconds / self.window_steps
+            metrics[f"perf/{name}_pct"] = 100 * seconds / step_seconds if step_seconds > 0 else 0.0
+        if torch.cuda.is_available():
+            metrics["perf/gpu_max_memory_allocated_mb"] = torch.cuda.max_memory_allocated() / 2**20
+
+        self._reset_window()
+        return metrics
+
+    def log(self, step: int):
+        """
+        Writes the current summary to the logger.
+        """
+        metrics = self.summary()
+        if metrics and self.logger is not None:
+            self.logger.log(metrics, step=step)
+
+    def close(self):
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(None, None, None)
+            self._torch_profiler = None
@@ -2,16 +2,35 @@ import argparse
 from datetime import datetime
 from pathlib import Path
 import torch
-import wandb
 from tqdm import tqdm
 from transformers import GenerationConfig
 
 from donut_distill.config.loader import load_config
+from donut_distill.data.donut_dataset import default_registry
+from donut_distill.data.packing import SegmentPositions, packed_attention_mask
+from donut_distill.data.shard_dataset import DonutIterableDataset
+from donut_distill.models.head_pruning import prune_attention_heads, remap_pruned_heads
 from donut_distill.models.helpers import prepare_model_and_processor
-from donut_distill.models.student import create_student_small
-from donut_distill.training.utils import prepare_dataloader, prepare_optimizer_and_scheduler
+from donut_distill.models.student import (
+    create_student_reduced_resolution,
+    create_student_small,
+    create_student_small_with_encoder,
+    scale_pixel_values,
+    scaled_processor,
+    swin_output_grid,
+)
+from donut_distill.training.utils import (
+    num_train_batches,
+    optimizer_state_bytes,
+    prepare_dataloader,
+    prepare_optimizer_and_scheduler,
+)
 from donut_distill.training.losses import calculate_loss_and_accuracy_distillation
+from donut_distill.training.encoder_hooks import build_encoder_recorders
+from donut_distill.training.phases import DistillationPhases
 from donut_distill.evaluation.evaluate import evaluate_docvqa
+from donut_distill.training.loggers import DeviceMetricAccumulator, build_logger
+from donut_distill.training.profiling import StepProfiler
 import donut_distill.config.config as CONFIG
 
 TOKENIZERS_PARALLELISM = False
@@ -62,24 +81,75 @@ def train():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     if CONFIG.DISTILL:
-        student_model = create_student_small(
-            teacher=model,
-            teacher_config=donut_config,
-            encoder_layer_map=CONFIG.ENCODER_LAYER_MAP,
-            decoder_layer_map=CONFIG.DECODER_LAYER_MAP,
-        )
+        if CONFIG.STUDENT_INPUT_SCALE != 1 or CONFIG.STUDENT_WINDOW_SIZE is not None:
+            student_model = create_student_reduced_resolution(
+                teacher=model,
+                teacher_config=donut_config,
+                input_scale=CONFIG.STUDENT_INPUT_SCALE,
+                window_size=CONFIG.STUDENT_WINDOW_SIZE,
+                encoder_layer_map=CONFIG.ENCODER_LAYER_MAP,
+                decoder_layer_map=CONFIG.DECODER_LAYER_MAP,
+            )
+        elif CONFIG.ENCODER_LAYER_MAP:
+            student_model = create_student_small_with_encoder(
+                teacher=model,
+                teacher_config=donut_config,
+                encoder_layer_map=CONFIG.ENCODER_LAYER_MAP,
+                decoder_layer_map=CONFIG.DECODER_LAYER_MAP,
+            )
+        else:
+            student_model = create_student_small(
+                teacher=model,
+                teacher_config=donut_config,
+                encoder_layer_map=CONFIG.ENCODER_LAYER_MAP,
+                decoder_layer_map=CONFIG.DECODER_LAYER_MAP,
+            )
+        if CONFIG.STUDENT_PRUNED_HEADS:
+            # Head indices are given per teacher layer
+            prune_attention_heads(
+                student_model,
+                remap_pruned_heads(CONFIG.STUDENT_PRUNED_HEADS, CONFIG.DECODER_LAYER_MAP),
+            )
         student_model.to(device)
+        # The saved student checkpoint has to preprocess images at its own resolution
+        student_processor = scaled_processor(processor, CONFIG.STUDENT_INPUT_SCALE)
+
+        # Hooks on the mapped encoder blocks, only if their losses are used
+        encoder_recorders = (None, None)
+        if CONFIG.ZETA > 0 or CONFIG.ETA > 0:
+            if not CONFIG.ENCODER_LAYER_MAP:
+                print("ZETA/ETA are ignored without an ENCODER_LAYER_MAP")
+            else:
+                encoder_recorders = build_encoder_recorders(
+                    student_model, model, CONFIG.ENCODER_LAYER_MAP, record_attentions=CONFIG.ETA > 0
+                )
 
     model.to(device)
 
+    # Packed sequences: per-segment decoder positions for every model that sees them
+    segment_positions = []
+    if CONFIG.PACK_SEQUENCES:
+        segment_positions = [SegmentPositions(model)]
+        if CONFIG.DISTILL:
+            segment_positions.append(SegmentPositions(student_model))
+
+    # Distillation phases (intermediate layers, then logits) with their own optimizer settings.
+    # With streamed shards, the number of batches can change by a few per epoch, so the phase boundaries
+    # and the validation interval (both from the first epoch) are approximate in later epochs.
+    num_batches_per_epoch = num_train_batches(train_dataloader)
+    phases = DistillationPhases.from_config(num_batches_per_epoch) if CONFIG.DISTILL else None
+
     # Optimizer and Scheduler
     optimizer, scheduler = prepare_optimizer_and_scheduler(
         model=student_model if CONFIG.DISTILL else model,
-        len_trainingsdata=len(train_dataloader.dataset)
+        len_trainingsdata=len(train_dataloader.dataset),
+        **(phases.optimizer_settings(1) if CONFIG.DISTILL else {}),
     )
 
     # Logger
-    wandb.init(
+    logger = build_logger(
+        CONFIG.LOGGER,
+        log_dir=CONFIG.LOG_DIR,
         project="donut-distill-docvqa",
         name="docvqa",
         config={
@@ -95,95 +165,172 @@ def train():
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     model_dir = Path(CONFIG.RESULT_PATH) / f"donut_{timestamp}"
 
+    profiler = StepProfiler(
+        enabled=CONFIG.PROFILE,
+        trace_steps=CONFIG.PROFILE_TRACE_STEPS,
+        output_dir=CONFIG.PROFILE_DIR,
+        logger=logger,
+    )
+    # Training metrics stay on the device until they are logged
+    train_metrics = DeviceMetricAccumulator()
+
     scaler = torch.amp.GradScaler("cuda")
     best_val_metric = 0.0
     steps = 0
-    num_batches_per_epoch = len(train_dataloader)
     val_check_interval_batches = max(
         1, int(num_batches_per_epoch * CONFIG.VAL_CHECK_INTERVAL)
     )
 
     for epoch in range(CONFIG.MAX_EPOCHS):
+        if isinstance(train_dataloader.dataset, DonutIterableDataset):
+            # New shard order and shuffle buffers every epoch
+            train_dataloader.dataset.set_epoch(epoch)
+            num_batches_per_epoch = num_train_batches(train_dataloader)
         # Training phase
         if CONFIG.DISTILL:
             model.eval()
             student_model.train()
         else:
             model.train()
-        total_loss = 0
+        total_loss = torch.zeros((), device=device)
         for i, batch in enumerate(
-            tqdm(train_dataloader, desc=f"Training Epoch {epoch+1}")
+            tqdm(profiler.iterate(train_dataloader), total=num_batches_per_epoch, desc=f"Training Epoch {epoch+1}")
         ):
-            pixel_values, decoder_input_ids, labels = batch
-            pixel_values = pixel_values.to(device)
-            decoder_input_ids = decoder_input_ids[:, :-1].to(device)
-            labels = labels[:, 1:].to(device)
+            pixel_values, decoder_input_ids, labels, *packing = batch
+            # Counted on the CPU tensors, so it doesn't need a device sync
+            num_samples = pixel_values.shape[0]
+            num_tokens = int((labels[:, 1:] != -100).sum())
+
+            with profiler.span("h2d"):
+                pixel_values = pixel_values.to(device)
+                decoder_input_ids = decoder_input_ids[:, :-1].to(device)
+                labels = labels[:, 1:].to(device)
+                if packing:
+                    position_ids, segment_ids = (tensor[:, :-1].to(device) for tensor in packing)
+                    for positions in segment_positions:
+                        positions.set(position_ids)
+
+            if CONFIG.DISTILL and phases.is_phase_start(steps):
+                # Logit phase: new optimizer and schedule with the phase's settings
+                print(f"Starting distillation phase 2 at step {steps}")
+                optimizer.zero_grad()
+                optimizer, scheduler = prepare_optimizer_and_scheduler(
+                    model=student_model,
+                    len_trainingsdata=len(train_dataloader.dataset),
+                    **phases.optimizer_settings(2),
+                )
 
             with torch.autocast(device_type="cuda"):
                 if CONFIG.DISTILL:
-                    teacher_outputs = model(
-                        pixel_values,
-                        decoder_input_ids=decoder_input_ids,
-                        labels=labels,
-                        output_attentions=True,
-                        output_hidden_states=True,
-                    )
-                    student_outputs = student_model(
-                        pixel_values,
-                        decoder_input_ids=decoder_input_ids,
-                        labels=labels,
-                        output_attentions=True,
-                        output_hidden_states=True,
-                    )
-                    loss = calculate_loss_and_accuracy_distillation(
-                        outputs=student_outputs, 
-                        teacher_outputs=teacher_outputs,
-                        is_first_distillation_phase=True,
-                        is_1phase_distillation=True,
-                        decoder_layer_map=CONFIG.DECODER_LAYER_MAP,  # Teacher has 4 Layers
-                        device=device,
-                        alpha=CONFIG.ALPHA,
-                        beta=CONFIG.BETA,
-                        gamma=CONFIG.GAMMA,
-                        delta=CONFIG.DELTA,
-                    )
+                    # The logit phase doesn't need attentions and hidden states
+                    intermediate_outputs = phases.needs_intermediate_outputs(steps)
+                    with profiler.span("teacher_forward"), torch.no_grad():
+                        teacher_outputs = model(
+                            pixel_values,
+                            decoder_input_ids=decoder_input_ids,
+                            decoder_attention_mask=(
+                                packed_attention_mask(segment_ids, model, intermediate_outputs) if packing else None
+                            ),
+                            labels=labels,
+                            output_attentions=intermediate_outputs,
+                            output_hidden_states=intermediate_outputs,
+                        )
+                    with profiler.span("student_forward"):
+                        student_pixel_values = scale_pixel_values(pixel_values, CONFIG.STUDENT_INPUT_SCALE)
+                        student_outputs = student_model(
+                            student_pixel_values,
+                            decoder_input_ids=decoder_input_ids,
+                            decoder_attention_mask=(
+                                packed_attention_mask(segment_ids, student_model, intermediate_outputs)
+                                if packing
+                                else None
+                            ),
+                            labels=labels,
+                            output_attentions=intermediate_outputs,
+                            output_hidden_states=intermediate_outputs,
+                        )
+                    with profiler.span("loss"):
+                        loss = calculate_loss_and_accuracy_distillation(
+                            outputs=student_outputs, 
+                            teacher_outputs=teacher_outputs,
+                            is_first_distillation_phase=phases.is_first_phase(steps),
+                            is_1phase_distillation=phases.num_phases == 1,
+                            decoder_layer_map=CONFIG.DECODER_LAYER_MAP,  # Teacher has 4 Layers
+                            device=device,
+                            alpha=CONFIG.ALPHA,
+                            beta=CONFIG.BETA,
+                            gamma=CONFIG.GAMMA,
+                            delta=CONFIG.DELTA,
+                            epsilon=CONFIG.EPSILON,
+                            encoder_grids=(
+                                swin_output_grid(student_model.config.encoder, *student_pixel_values.shape[-2:]),
+                                swin_output_grid(model.config.encoder, *pixel_values.shape[-2:]),
+                            ),
+                            zeta=CONFIG.ZETA if encoder_recorders[0] else 0,
+                            eta=CONFIG.ETA if encoder_recorders[0] else 0,
+                            encoder_recorders=encoder_recorders,
+                            encoder_layer_map=CONFIG.ENCODER_LAYER_MAP,
+                            encoder_stage_weights=CONFIG.ENCODER_STAGE_WEIGHTS,
+                        )
+                        for recorder in encoder_recorders:
+                            if recorder:
+                                recorder.clear()
 
                 else:
-                    outputs = model(
-                        pixel_values, decoder_input_ids=decoder_input_ids, labels=labels
-                    )
-                    loss = outputs.loss
+                    with profiler.span("forward"):
+                        outputs = model(
+                            pixel_values,
+                            decoder_input_ids=decoder_input_ids,
+                            decoder_attention_mask=packed_attention_mask(segment_ids, model) if packing else None,
+                            labels=labels,
+                        )
+                        loss = outputs.loss
+
+            # Generation during validation uses the default positions
+            for positions in segment_positions:
+                positions.clear()
 
-            scaler.scale(loss).backward()
+            with profiler.span("backward"):
+                scaler.scale(loss).backward()
             # highest_gradient = check_gradients(model=student_model if CONFIG.DISTILL else model)
 
-            if (i + 1) % CONFIG.ACCUMULATION_STEPS == 0:
-                # Unscale gradients before clipping
-                scaler.unscale_(optimizer)
+            with profiler.span("optimizer"):
+                if (i + 1) % CONFIG.ACCUMULATION_STEPS == 0:
+                    # Unscale gradients before clipping
+                    scaler.unscale_(optimizer)
 
-                torch.nn.utils.clip_grad_norm_(
-                    student_model.parameters() if CONFIG.DISTILL else model.parameters(), CONFIG.GRADIENT_CLIP_VAL
-                )
-                scaler.step(optimizer)
-                scaler.update()
-                scheduler.step()
-                optimizer.zero_grad()
+                    torch.nn.utils.clip_grad_norm_(
+                        student_model.parameters() if CONFIG.DISTILL else model.parameters(), CONFIG.GRADIENT_CLIP_VAL
+                    )
+                    scaler.step(optimizer)
+                    scaler.update()
+                    scheduler.step()
+                    optimizer.zero_grad()
+
+            train_metrics.update("train/loss", loss)
 
-            # Log training metrics
+            # Log training metrics (train/loss is the mean since the last log)
             if steps % CONFIG.LOG_INTERVAL == 0:
-                wandb.log(
+                logger.log(
                     {
-                        "train/loss": loss.item(),
+                        **train_metrics.pop_means(),
                         "gpu/memory_allocated": torch.cuda.memory_allocated(),
                         "gpu/memory_reserved": torch.cuda.memory_reserved(),
                         "lr": optimizer.param_groups[0]["lr"],
+                        "optim/state_mb": optimizer_state_bytes(optimizer) / 2**20,
                         "epoch": epoch,
+                        **({"distill/phase": phases.phase(steps)} if CONFIG.DISTILL else {}),
                         # "highest_gradient": highest_gradient,
                     },
                     step=steps,
                 )
 
-            total_loss += loss.item()
+            total_loss += loss.detach()
+
+            # Logged at the same step as the training metrics of this batch
+            profiler.step_end(num_samples, num_tokens)
+            if steps % CONFIG.LOG_INTERVAL == 0:
+                profiler.log(step=steps)
             steps += 1
 
             if (i + 1) % val_check_interval_batches == 0:
@@ -204,6 +351,9 @@ def train():
                                 early_stopping=True,
                                 num_beams=1,
                             ),
+                            # The dataloader already holds the fixed validation subset
+                            limit_val_batches=1.0,
+                            input_scale=CONFIG.STUDENT_INPUT_SCALE,
                         )
                     else:
                         eval_results = evaluate_docvqa(
@@ -215,11 +365,13 @@ def train():
                                 early_stopping=True,
                                 num_beams=1,
                             ),
+                            # The dataloader already holds the fixed validation subset
+                            limit_val_batches=1.0,
                         )
 
                 eval_results.update({"epoch": epoch})
 
-                wandb.log(
+                logger.log(
                     eval_results,
                     step=steps,
                 )
@@ -229,9 +381,11 @@ def train():
                     best_val_metric = eval_results["eval/anls"]
                     if CONFIG.DISTILL:
                         student_model.save_pretrained(model_dir)
+                        student_processor.save_pretrained(model_dir)
                     else:
                         model.save_pretrained(model_dir)
-                    processor.save_pretrained(model_dir)
+                        processor.save_pretrained(model_dir)
+                    default_registry.save_pretrained(model_dir)
 
                 torch.cuda.empty_cache()
                 if CONFIG.DISTILL:
@@ -239,18 +393,21 @@ def train():
                 else:
                     model.train()
 
-        avg_train_loss = total_loss / len(train_dataloader)
+        avg_train_loss = total_loss / num_batches_per_epoch
 
         log_data = {"train/avg_loss": avg_train_loss}
         log_data.update({"epoch": epoch})
 
-        wandb.log(
+        logger.log(
             log_data,
             step=steps,
         )
 
         torch.cuda.empty_cache()
 
+    profiler.close()
+    logger.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -1,13 +1,23 @@
 import torch
 import math
+from typing import Any, Dict, List, Optional, Sequence
+from torch import nn
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
 from transformers import DonutProcessor, VisionEncoderDecoderModel
 
-from donut_distill.data.donut_dataset import DonutDataset
+from donut_distill.data.donut_dataset import DonutDataset, ValidationSubset, collate_fn_eval
+from donut_distill.data.packing import PackedDonutDataset
+from donut_distill.data.shard_dataset import DonutIterableDataset
 import donut_distill.config.config as CONFIG
 
+# Task start and prompt end tokens for each supported task
+TASK_TOKENS = {
+    "docvqa": ("<s_docvqa>", "<s_answer>"),
+    "funsd": ("<s_funsd>", None),
+}
+
 def prepare_dataloader(model: VisionEncoderDecoderModel, processor: DonutProcessor):
     """
     Prepare the training and validation dataloaders for model training.
@@ -18,21 +28,39 @@ def prepare_dataloader(model: VisionEncoderDecoderModel, processor: DonutProcess
 
     Returns:
         tuple: A tuple containing:
-            - train_dataloader (DataLoader): Dataloader for the training dataset.
-            - val_dataloader (DataLoader): Dataloader for the validation dataset.
+            - train_dataloader (DataLoader): Dataloader for the training dataset. With `PACK_SEQUENCES`, its batches
+              also hold position and segment ids (see `PackedDonutDataset`). With `TRAIN_SHARDS`, the training
+              samples are streamed from shards (see `DonutIterableDataset`).
+            - val_dataloader (DataLoader): Dataloader for the validation dataset. If `LIMIT_VAL_BATCHES` < 1,
+              it only holds a fixed, seeded subset of that size (see `ValidationSubset`).
     """
 
-    train_dataset = DonutDataset(
-        dataset_name_or_path=CONFIG.DATASET,
-        processor=processor,
-        model=model,
-        max_length=CONFIG.MAX_LENGTH,
-        split=CONFIG.DATASET_NAME_TRAINING,
-        task_start_token="<s_docvqa>",
-        prompt_end_token="<s_answer>",
-        sort_json_key=CONFIG.SORT_JSON_KEY,
-        task="docvqa",
-    )
+    if CONFIG.TRAIN_SHARDS:
+        if CONFIG.PACK_SEQUENCES:
+            raise ValueError("PACK_SEQUENCES is not supported with TRAIN_SHARDS")
+        train_dataset = DonutIterableDataset(
+            processor=processor,
+            model=model,
+            shard_dir=CONFIG.TRAIN_SHARDS,
+            max_length=CONFIG.MAX_LENGTH,
+            task_start_token="<s_docvqa>",
+            prompt_end_token="<s_answer>",
+            sort_json_key=CONFIG.SORT_JSON_KEY,
+            shuffle_buffer=CONFIG.SHUFFLE_BUFFER,
+            seed=CONFIG.SHUFFLE_SEED,
+        )
+    else:
+        train_dataset = DonutDataset(
+            dataset_name_or_path=CONFIG.DATASET,
+            processor=processor,
+            model=model,
+            max_length=CONFIG.MAX_LENGTH,
+            split=CONFIG.DATASET_NAME_TRAINING,
+            task_start_token="<s_docvqa>",
+            prompt_end_token="<s_answer>",
+            sort_json_key=CONFIG.SORT_JSON_KEY,
+            task="docvqa",
+        )
 
     val_dataset = DonutDataset(
         dataset_name_or_path=CONFIG.DATASET,
@@ -46,22 +74,93 @@ def prepare_dataloader(model: VisionEncoderDecoderModel, processor: DonutProcess
         task="docvqa",
     )
 
+    if CONFIG.PACK_SEQUENCES:
+        # Several targets of the same page per decoder sequence
+        train_dataset = PackedDonutDataset(
+            train_dataset, max_length=CONFIG.PACK_MAX_LENGTH, max_segments=CONFIG.PACK_MAX_SEGMENTS
+        )
+        if CONFIG.VERBOSE:
+            print(f"Packed {len(train_dataset.dataset)} training samples into {len(train_dataset)} sequences")
+
     train_dataloader = DataLoader(
         train_dataset,
         batch_size=CONFIG.TRAIN_BATCH_SIZES,
-        shuffle=True,
+        # Streamed shards are shuffled by the dataset
+        shuffle=not CONFIG.TRAIN_SHARDS,
         num_workers=CONFIG.NUM_WORKERS,
     )
+    if CONFIG.LIMIT_VAL_BATCHES < 1:
+        # Validate on the same samples every time instead of a random fraction of batches
+        num_val_batches = math.ceil(len(val_dataset) / CONFIG.VAL_BATCH_SIZES)
+        num_val_samples = max(1, int(num_val_batches * CONFIG.LIMIT_VAL_BATCHES)) * CONFIG.VAL_BATCH_SIZES
+        val_dataset = ValidationSubset(
+            val_dataset,
+            num_samples=num_val_samples,
+            seed=CONFIG.VAL_SUBSET_SEED,
+            materialize=CONFIG.MATERIALIZE_VAL_SUBSET,
+        )
+
     val_dataloader = DataLoader(
         val_dataset,
         batch_size=CONFIG.VAL_BATCH_SIZES,
-        shuffle=True,
+        shuffle=False,
         num_workers=CONFIG.NUM_WORKERS,
+        collate_fn=collate_fn_eval,
     )
 
     return train_dataloader, val_dataloader
 
 
+def num_train_batches(train_dataloader: DataLoader) -> int:
+    """
+    Number of batches of a training epoch.
+
+    For streamed shards, the batches are counted per DataLoader worker (see `DonutIterableDataset.num_batches`)
+    for the dataset's current epoch, `len(train_dataloader)` would ignore the incomplete last batch of each worker.
+    """
+    dataset = train_dataloader.dataset
+    if isinstance(dataset, DonutIterableDataset):
+        return dataset.num_batches(train_dataloader.batch_size, train_dataloader.num_workers, train_dataloader.drop_last)
+    return len(train_dataloader)
+
+
+def prepare_val_dataloader(
+    model: VisionEncoderDecoderModel, processor: DonutProcessor, task: str = "docvqa"
+) -> DataLoader:
+    """
+    Prepare only the validation dataloader, e.g. for standalone evaluation runs.
+
+    Args:
+        model (VisionEncoderDecoderModel): The Donut model whose tokenizer may be extended.
+        processor (DonutProcessor): The processor for tokenizing and processing input data.
+        task (str): Either "docvqa" or "funsd".
+
+    Returns:
+        DataLoader: Dataloader for the validation dataset.
+    """
+    task_start_token, prompt_end_token = TASK_TOKENS[task]
+
+    val_dataset = DonutDataset(
+        dataset_name_or_path=CONFIG.DATASET,
+        processor=processor,
+        model=model,
+        max_length=CONFIG.MAX_LENGTH,
+        split=CONFIG.DATASET_NAME_VALIDATE,
+        task_start_token=task_start_token,
+        prompt_end_token=prompt_end_token,
+        sort_json_key=CONFIG.SORT_JSON_KEY,
+        task=task,
+    )
+
+    return DataLoader(
+        val_dataset,
+        batch_size=CONFIG.VAL_BATCH_SIZES,
+        shuffle=False,
+        num_workers=CONFIG.NUM_WORKERS,
+        collate_fn=collate_fn_eval,
+    )
+
+
 def cosine_scheduler(optimizer: Optimizer, training_steps: int, warmup_steps: int) -> LambdaLR:
     """
     Creates a cosine learning rate scheduler with a linear warmup phase.
@@ -88,20 +187,17 @@ def cosine_scheduler(optimizer: Optimizer, training_steps: int, warmup_steps: in
     return LambdaLR(optimizer, lr_lambda)
 
 
-def prepare_optimizer_and_scheduler(model: VisionEncoderDecoderModel, len_trainingsdata: int) -> tuple[Optimizer, LambdaLR]:
+def total_optimizer_steps(len_trainingsdata: int) -> int:
     """
-    Prepares the optimizer and learning rate scheduler for training.
+    Computes the number of optimizer steps of the whole training run from `MAX_EPOCHS` and `MAX_STEPS`.
 
     Args:
-        model (VisionEncoderDecoderModel): The Donut model to be optimized.
         len_trainingsdata (int): The number of training samples.
 
     Returns:
-        tuple: A tuple containing:
-            - optimizer (Optimizer): Adam optimizer for model training.
-            - scheduler (LambdaLR): Cosine learning rate scheduler.
+        int: The number of optimizer steps (after gradient accumulation).
     """
-    optimizer = torch.optim.Adam(model.parameters(), lr=CONFIG.LR)
+    max_iter = None
 
     # Compute the total number of iterations based on epochs and dataset size
     if int(CONFIG.MAX_EPOCHS) > 0:
@@ -119,9 +215,147 @@ def prepare_optimizer_and_scheduler(model: VisionEncoderDecoderModel, len_traini
         )
 
     assert max_iter is not None, "max_iter must be defined before creating the scheduler."
+    return int(max_iter)
+
+
+def build_param_groups(
+    model: nn.Module,
+    weight_decay: float = 0.0,
+    freeze_modules: Sequence[str] = (),
+) -> List[Dict[str, Any]]:
+    """
+    Splits the trainable parameters into groups with and without weight decay.
+
+    Biases, norm weights and Swin's relative position bias tables get no weight decay. Parameters
+    of `freeze_modules` are frozen (`requires_grad=False`) and left out, so they get no gradients,
+    no optimizer state and their backward pass is skipped if nothing before them is trained.
+
+    Args:
+        model (nn.Module): The model to train.
+        weight_decay (float): Weight decay of the remaining weights.
+        freeze_modules (Sequence[str]): Parameter name prefixes to freeze, e.g. ["encoder"].
+
+    Returns:
+        List[Dict[str, Any]]: Parameter groups for a torch optimizer.
+    """
+    decay, no_decay = [], []
+    for name, param in model.named_parameters():
+        if any(name == prefix or name.startswith(f"{prefix}.") for prefix in freeze_modules):
+            param.requires_grad_(False)
+        if not param.requires_grad:
+            continue
+        if param.ndim < 2 or name.endswith("relative_position_bias_table"):
+            no_decay.append(param)
+        else:
+            decay.append(param)
+
+    groups = [
+        {"params": decay, "weight_decay": weight_decay},
+        {"params": no_decay, "weight_decay": 0.0},
+    ]
+    return [group for group in groups if group["params"]]
+
+
+def build_optimizer(
+    param_groups: List[Dict[str, Any]],
+    lr: float,
+    name: str = "adam",
+    implementation: str = "auto",
+) -> Optimizer:
+    """
+    Creates the optimizer.
+
+    Args:
+        param_groups (List[Dict[str, Any]]): Output of `build_param_groups`.
+        lr (float): Learning rate.
+        name (str): "adam", "adamw" or "adamw8bit" (8-bit optimizer states, requires bitsandbytes and CUDA).
+        implementation (str): Kernel of the torch optimizers: "fused" (one kernel for all parameters),
+            "foreach" (batched per tensor list), "for-loop", or "auto" (fused if the device supports it,
+            foreach otherwise).
+
+    Returns:
+        Optimizer: The optimizer.
+    """
+    if name == "adamw8bit":
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            raise ImportError("8-bit optimizer states require bitsandbytes (pip install bitsandbytes)")
+        return bnb.optim.AdamW8bit(param_groups, lr=lr)
+
+    optimizers = {"adam": torch.optim.Adam, "adamw": torch.optim.AdamW}
+    if name not in optimizers:
+        raise ValueError(f"Unknown optimizer {name}, use one of {list(optimizers) + ['adamw8bit']}")
+    optimizer_cls = optimizers[name]
+
+    if implementation == "auto":
+        try:
+            return optimizer_cls(param_groups, lr=lr, fused=True)
+        except (RuntimeError, ValueError):
+            # Fused kernels need a supported device and dtype
+            implementation = "foreach"
+    kwargs = {
+        "fused": {"fused": True},
+        "foreach": {"foreach": True},
+        "for-loop": {"foreach": False},
+    }[implementation]
+    return optimizer_cls(param_groups, lr=lr, **kwargs)
+
+
+def optimizer_state_bytes(optimizer: Optimizer) -> int:
+    """
+    Returns the memory held by the optimizer states (e.g. Adam's moments), zero before the first step.
+    """
+    return sum(
+        value.numel() * value.element_size()
+        for state in optimizer.state.values()
+        for value in state.values()
+        if torch.is_tensor(value)
+    )
+
+
+def prepare_optimizer_and_scheduler(
+    model: VisionEncoderDecoderModel,
+    len_trainingsdata: int,
+    lr: Optional[float] = None,
+    warmup_steps: Optional[int] = None,
+    training_steps: Optional[int] = None,
+) -> tuple[Optimizer, LambdaLR]:
+    """
+    Prepares the optimizer and learning rate scheduler for training.
+
+    The optimizer is configured by `OPTIMIZER`, `OPTIMIZER_IMPLEMENTATION`, `WEIGHT_DECAY` and
+    `FREEZE_MODULES` (see `build_param_groups` and `build_optimizer`).
+
+    Args:
+        model (VisionEncoderDecoderModel): The Donut model to be optimized.
+        len_trainingsdata (int): The number of training samples.
+        lr (float, optional): Learning rate, defaults to `CONFIG.LR`.
+        warmup_steps (int, optional): Warmup steps (before gradient accumulation), defaults to `CONFIG.WARMUP_STEPS`.
+        training_steps (int, optional): Optimizer steps of the cosine schedule, defaults to the whole
+            run (see `total_optimizer_steps`). Used to schedule each distillation phase separately.
+
+    Returns:
+        tuple: A tuple containing:
+            - optimizer (Optimizer): Adam(W) optimizer for model training.
+            - scheduler (LambdaLR): Cosine learning rate scheduler.
+    """
+    param_groups = build_param_groups(model, CONFIG.WEIGHT_DECAY, CONFIG.FREEZE_MODULES)
+    optimizer = build_optimizer(
+        param_groups,
+        lr=CONFIG.LR if lr is None else lr,
+        name=CONFIG.OPTIMIZER,
+        implementation=CONFIG.OPTIMIZER_IMPLEMENTATION,
+    )
+    if CONFIG.VERBOSE:
+        num_trainable = sum(param.numel() for group in param_groups for param in group["params"])
+        num_total = sum(param.numel() for param in model.parameters())
+        print(f"Optimizer {type(optimizer).__name__}: {num_trainable:,} of {num_total:,} parameters trainable")
+
+    max_iter = total_optimizer_steps(len_trainingsdata) if training_steps is None else training_steps
 
     # Adjust warmup steps for gradient accumulation
-    warmup_steps = CONFIG.WARMUP_STEPS // CONFIG.ACCUMULATION_STEPS
+    warmup_steps = (CONFIG.WARMUP_STEPS if warmup_steps is None else warmup_steps) // CONFIG.ACCUMULATION_STEPS
 
     scheduler = cosine_scheduler(optimizer, max_iter, warmup_steps)
     
@@ -0,0 +1,89 @@
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List, Set, Tuple
+
+# Allows `python scripts/benchmark_fuzzy_matching.py` besides `python -m scripts.benchmark_fuzzy_matching`
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import editdistance
+from donut_distill.evaluation.fuzzy_matching import EntityIndex
+
+
+def random_page(rng: random.Random, max_entities: int = 20, alphabet: str = "abcde ") -> Tuple[List[str], List[str]]:
+    """
+    Builds gold and predicted texts of one page, predictions are mostly edited golds.
+    """
+
+    def text() -> str:
+        return "".join(rng.choice(alphabet) for _ in range(rng.randrange(0, 16)))
+
+    def edit(gold: str) -> str:
+        chars = list(gold)
+        for _ in range(rng.randrange(0, 5)):
+            position = rng.randrange(len(chars) + 1)
+            operation = rng.randrange(3)
+            if operation == 0:
+                chars.insert(position, rng.choice(alphabet))
+            elif chars and position < len(chars):
+                if operation == 1:
+                    del chars[position]
+                else:
+                    chars[position] = rng.choice(alphabet)
+        return "".join(chars)
+
+    golds = [text() for _ in range(rng.randrange(1, max_entities))]
+    predictions = [edit(rng.choice(golds)) if rng.random() < 0.7 else text() for _ in range(rng.randrange(1, max_entities))]
+    return golds, predictions
+
+
+def brute_force(golds: List[str], text: str, threshold: float) -> Set[Tuple[int, float]]:
+    results = set()
+    for idx, gold in enumerate(golds):
+        longest = max(len(text), len(gold))
+        distance = editdistance.eval(text, gold)
+        normalized_distance = distance / longest if longest else 0.0
+        if normalized_distance <= threshold:
+            results.add((idx, normalized_distance))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare EntityIndex candidates against a brute-force edit distance check")
+    parser.add_argument("--num_pages", type=int, default=20000)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.1, 0.2, 0.3, 0.5, 0.7, 0.9, 1.0])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pages = [random_page(rng) for _ in range(args.num_pages)]
+
+    # The index must return exactly the pairs within the threshold
+    report = {"num_pages": len(pages), "thresholds": {}}
+    for threshold in args.thresholds:
+        mismatched_pages = 0
+        index_seconds, brute_force_seconds = 0.0, 0.0
+        for golds, predictions in pages:
+            start = time.perf_counter()
+            index = EntityIndex(golds, threshold)
+            indexed = [set(index.candidates(text)) for text in predictions]
+            index_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            expected = [brute_force(golds, text, threshold) for text in predictions]
+            brute_force_seconds += time.perf_counter() - start
+
+            if indexed != expected:
+                mismatched_pages += 1
+
+        report["thresholds"][str(threshold)] = {
+            "mismatched_pages": mismatched_pages,
+            "seconds_per_page": {
+                "EntityIndex": index_seconds / len(pages),
+                "brute_force": brute_force_seconds / len(pages),
+            },
+        }
+    print(json.dumps(report, indent=2))
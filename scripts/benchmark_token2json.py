@@ -0,0 +1,102 @@
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, List
+
+# Allows `python scripts/benchmark_token2json.py` besides `python -m scripts.benchmark_token2json`
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from transformers import DonutProcessor
+from donut_distill.data.postprocess_donut import token2json, token2json_from_ids
+
+
+def json2token(obj: Any, processor: DonutProcessor) -> str:
+    """
+    Converts a ground truth parse into a token sequence and registers its key tokens (like `DonutDataset.json2token`).
+    """
+    if isinstance(obj, dict):
+        output = ""
+        for key in sorted(obj.keys(), reverse=True):
+            processor.tokenizer.add_tokens([f"<s_{key}>", f"</s_{key}>"])
+            output += f"<s_{key}>" + json2token(obj[key], processor) + f"</s_{key}>"
+        return output
+    if isinstance(obj, list):
+        return "<sep/>".join(json2token(item, processor) for item in obj)
+    return str(obj)
+
+
+def build_sequences(metadata_path: str, processor: DonutProcessor, seed: int = 0) -> List[str]:
+    """
+    Builds well-formed sequences from the ground truths and malformed variants of them
+    (truncated like a generation hitting `max_length`, stray tokens, unclosed task token, an unclosed
+    key after the first element followed by <sep/>, incomplete tokens).
+    """
+    processor.tokenizer.add_tokens(["<sep/>", "<s_funsd>", "<s_question>", "</s_question>", "<s_answer>", "</s_answer>"])
+    sequences = []
+    with open(metadata_path, "r") as f:
+        for line in f:
+            ground_truth = json.loads(json.loads(line)["ground_truth"])
+            sequences.append(json2token(ground_truth["gt_parse"], processor))
+
+    rng = random.Random(seed)
+    malformed = []
+    for sequence in sequences:
+        cut = rng.randrange(1, len(sequence))
+        malformed.append("<s_funsd>" + sequence[:cut])
+        malformed.append(sequence.replace("</s_label>", "", 1))
+        malformed.append(sequence + "</s_text><sep/>")
+        malformed.append(sequence + "<s_label><sep/>")
+        malformed.append("<s_funsd>" + sequence.replace("</s_text>", "<s_</s_text>", 1))
+    # Cases where the stack is not fully closed at a top-level <sep/>
+    malformed += [
+        "a<s_question><s_answer> </s_answer><s_question><sep/>",
+        "<s_question>a<s_answer> </s_answer> <s_question> <sep/>a",
+        "a<s_answer><sep/>a<s_text></s_text><s_answer><sep/>",
+    ]
+    return ["<s_funsd>" + sequence for sequence in sequences] + malformed
+
+
+def time_fn(fn, inputs, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for item in inputs:
+            fn(item)
+    return (time.perf_counter() - start) / (repeats * len(inputs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fast token2json parser against DonutProcessor.token2json")
+    parser.add_argument("--processor_path", type=str, default="naver-clova-ix/donut-base")
+    parser.add_argument("--metadata", type=str, default="dataset_labeled_human/test/metadata.jsonl")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    processor = DonutProcessor.from_pretrained(args.processor_path)
+    sequences = build_sequences(args.metadata, processor)
+    token_ids = [processor.tokenizer(sequence, add_special_tokens=False).input_ids for sequence in sequences]
+
+    # The fast parser must return exactly the same JSON, for strings and token ids
+    mismatches = 0
+    for sequence, ids in zip(sequences, token_ids):
+        expected = processor.token2json(processor.tokenizer.decode(ids))
+        if token2json(sequence, processor) != processor.token2json(sequence):
+            mismatches += 1
+        elif token2json_from_ids(ids, processor) != expected:
+            mismatches += 1
+
+    report = {
+        "num_sequences": len(sequences),
+        "mismatches": mismatches,
+        "seconds_per_sequence": {
+            "processor.token2json": time_fn(processor.token2json, sequences, args.repeats),
+            "token2json": time_fn(lambda sequence: token2json(sequence, processor), sequences, args.repeats),
+            "batch_decode + processor.token2json": time_fn(
+                lambda ids: processor.token2json(processor.tokenizer.decode(ids)), token_ids, args.repeats
+            ),
+            "token2json_from_ids": time_fn(lambda ids: token2json_from_ids(ids, processor), token_ids, args.repeats),
+        },
+    }
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,55 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+pytest.importorskip("onnxruntime")
+
+import donut_distill.config.config as CONFIG
+from benchmarks.common import INPUT_SIZE, MAX_LENGTH, build_tiny_processor, build_tiny_teacher
+from donut_distill.data.donut_dataset import collate_fn_eval
+from donut_distill.models.onnx_export import export_onnx
+from donut_distill.models.onnx_runtime import OnnxDonutModel, check_parity
+
+NUM_SAMPLES = 4
+
+
+@pytest.fixture(scope="module")
+def exported(tmp_path_factory):
+    processor = build_tiny_processor()
+    processor.tokenizer.add_tokens(["<s_docvqa>", "<s_question>", "</s_question>", "<s_answer>", "</s_answer>"])
+    model = build_tiny_teacher(processor)
+    # With the default init the random decoder repeats a single token, larger weights make the outputs vary
+    with torch.no_grad():
+        for param in model.decoder.parameters():
+            param.add_(torch.randn(param.shape, generator=torch.Generator().manual_seed(param.numel())) * 0.5)
+    output_dir = tmp_path_factory.mktemp("onnx")
+    export_onnx(model, output_dir, processor=processor)
+    return model, processor, OnnxDonutModel.from_pretrained(output_dir)
+
+
+def prompt_dataloader(processor) -> DataLoader:
+    """
+    Validation-like batches (pixel values, input ids, prompt end index, answers) with random images.
+    """
+    generator = torch.Generator().manual_seed(0)
+    samples = []
+    for question in ["what is the date?", "who", "total", "name of the company"][:NUM_SAMPLES]:
+        input_ids = processor.tokenizer(
+            f"<s_docvqa><s_question>{question}</s_question><s_answer>",
+            add_special_tokens=False,
+            max_length=MAX_LENGTH,
+            padding="max_length",
+            return_tensors="pt",
+        ).input_ids.squeeze(0)
+        prompt_end_index = (input_ids == processor.tokenizer.convert_tokens_to_ids("<s_answer>")).nonzero().sum()
+        samples.append((torch.randn(3, *INPUT_SIZE, generator=generator), input_ids, prompt_end_index, []))
+    return DataLoader(samples, batch_size=2, collate_fn=collate_fn_eval)
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_parity(exported, num_beams, monkeypatch):
+    model, processor, onnx_model = exported
+    monkeypatch.setattr(CONFIG, "MAX_LENGTH", MAX_LENGTH)
+
+    parity = check_parity(model, onnx_model, processor, prompt_dataloader(processor), NUM_SAMPLES, num_beams=num_beams)
+    assert parity == {"parity/exact_sequences": 1.0, "parity/exact_strings": 1.0}
@@ -0,0 +1,97 @@
+import json
+from pathlib import Path
+import pytest
+from benchmarks.common import DATASET_PATH, build_tiny_processor
+from donut_distill.data.donut_dataset import SpecialTokenRegistry, json2token
+from donut_distill.data.postprocess_donut import token2json, token2json_from_ids
+
+KEYS = ["elements", "text", "label", "docvqa", "question", "answer", "funsd"]
+CATEGORICAL_TOKENS = ["<header/>", "<question/>", "<answer/>", "<other/>"]
+
+WELL_FORMED = [
+    "<s_docvqa><s_question>what is the date?</s_question><s_answer>12/08/98</s_answer>",
+    "<s_docvqa><s_question> spaced </s_question><s_answer></s_answer>",
+    "<s_text>a<sep/>b<sep/>c</s_text>",
+    "<s_label><header/></s_label>",
+    "<s_elements><s_text>x</s_text><s_label>y</s_label><sep/><s_text>z</s_text></s_elements>",
+    "<s_elements><s_label><s_text>x</s_text><sep/><s_text>y</s_text></s_label></s_elements>",
+    "<s_text>x</s_text><sep/><s_text>y</s_text>",
+]
+
+MALFORMED = [
+    # Unclosed keys (the task start token, nested and at the end)
+    "<s_funsd><s_text>x</s_text>",
+    "<s_elements><s_text>x</s_text>",
+    "<s_text>x</s_text><s_label>y",
+    # Unclosed keys after an element, followed by a top-level <sep/>
+    "a<s_question><s_answer> </s_answer><s_question><sep/>",
+    "<s_question>a<s_answer> </s_answer> <s_question> <sep/>a",
+    "a<s_answer><sep/>a<s_text></s_text><s_answer><sep/>",
+    # Stray and mismatched closing tags
+    "</s_text><s_text>x</s_text>",
+    "<s_text>x</s_text></s_text>",
+    "<s_text>x</s_label></s_text>",
+    "<s_elements><s_text>x</s_elements></s_text>",
+    "<s_text>x</s_text></s_elements><sep/>",
+    # Incomplete tokens, keys nested in themselves and no structure at all
+    "<s_text>x<s_</s_text>",
+    "<s_text><s_text>x</s_text></s_text>",
+    "<s_elements><s_elements><s_text>x</s_text></s_elements></s_elements>",
+    "just text",
+    "",
+]
+
+
+def ground_truth_sequences(processor) -> list:
+    registry = SpecialTokenRegistry(CATEGORICAL_TOKENS)
+    sequences = []
+    with open(Path(DATASET_PATH) / "test" / "metadata.jsonl", "r") as f:
+        for line in f:
+            ground_truth = json.loads(json.loads(line)["ground_truth"])
+            sequences.append("<s_funsd>" + json2token(ground_truth["gt_parse"], registry=registry))
+    return sequences
+
+
+@pytest.fixture(scope="module")
+def processor():
+    processor = build_tiny_processor()
+    processor.tokenizer.add_tokens(
+        ["<sep/>"] + CATEGORICAL_TOKENS + [token for key in KEYS for token in (f"<s_{key}>", f"</s_{key}>")]
+    )
+    return processor
+
+
+def assert_equivalent(sequence: str, processor):
+    assert token2json(sequence, processor) == processor.token2json(sequence)
+
+    token_ids = processor.tokenizer(sequence, add_special_tokens=False).input_ids
+    expected = processor.token2json(processor.tokenizer.decode(token_ids))
+    assert token2json_from_ids(token_ids, processor) == expected
+
+
+@pytest.mark.parametrize("sequence", WELL_FORMED)
+def test_well_formed(sequence, processor, monkeypatch):
+    expected = processor.token2json(sequence)
+    token_ids = processor.tokenizer(sequence, add_special_tokens=False).input_ids
+    expected_from_ids = processor.token2json(processor.tokenizer.decode(token_ids))
+
+    # Well-formed sequences are parsed without the fallback
+    def fallback(*args, **kwargs):
+        raise AssertionError("fell back to processor.token2json")
+
+    monkeypatch.setattr(processor, "token2json", fallback)
+    assert token2json(sequence, processor) == expected
+    assert token2json_from_ids(token_ids, processor) == expected_from_ids
+
+
+def test_ground_truths(processor):
+    for sequence in ground_truth_sequences(processor):
+        assert_equivalent(sequence, processor)
+        # Truncated like a generation hitting max_length
+        for cut in range(1, len(sequence), max(1, len(sequence) // 25)):
+            assert_equivalent(sequence[:cut], processor)
+
+
+@pytest.mark.parametrize("sequence", MALFORMED)
+def test_malformed(sequence, processor):
+    assert_equivalent(sequence, processor)